@@ -1,13 +1,75 @@
 import re
+import os
 import json
 import requests
 import time
-import serial
 import logging
+from Storage import load_store, journal_path_for
+from LedTopology import LedTopology
+from SerialTransport import SerialTransport
+from Metrics import STAGE_BUCKETS
+from Icons import normalize_color
+
+# Sync bytes of the variable-length strip protocol
+FRAME_SYNC = b'\xA5\x5A'
+MEMORY_FRAME_SYNC = b'\xA5\x5B'
+
+
+class FrameSender:
+    def __init__(self, write, keepalive_interval=5.0):
+        """
+        Send frames only when they change, plus a periodic keepalive refresh.
+
+        Args:
+            write (callable): Function that writes a frame and returns True on success
+            keepalive_interval (float): Seconds after which an unchanged frame is re-sent
+        """
+        self.write = write
+        self.keepalive_interval = keepalive_interval
+        self.last_frame = None
+        self.last_sent_at = 0.0
+        self.sent_frames = 0
+        self.suppressed_frames = 0
+        self.failed_frames = 0
+
+    def send(self, frame, force=False):
+        """
+        Write a frame unless it is identical to the last one sent and the
+        keepalive interval has not expired. Returns True if it was written.
+        """
+        now = time.monotonic()
+        if (not force and frame == self.last_frame and
+                now - self.last_sent_at < self.keepalive_interval):
+            self.suppressed_frames += 1
+            return False
+
+        if self.write(frame):
+            self.last_frame = frame
+            self.last_sent_at = now
+            self.sent_frames += 1
+            return True
+
+        # The device state is unknown after a failed write
+        self.last_frame = None
+        self.failed_frames += 1
+        return False
+
+    def invalidate(self):
+        """Forget the last frame so the next one is always sent."""
+        self.last_frame = None
+
+    def get_stats(self):
+        return {
+            'sent_frames': self.sent_frames,
+            'suppressed_frames': self.suppressed_frames,
+            'failed_frames': self.failed_frames
+        }
 
 
 class Arduino:
-    def __init__(self, url, memory_url, port, baudrate):
+    def __init__(self, url, memory_url, port, baudrate, events=None, interval=0.3, keepalive_interval=5.0,
+                 color_table=None, markers_file='server_storage.json', topology=None, trigger_queue=None,
+                 consumer='arduino', metrics=None):
         """
         Initialize Arduino communication class.
 
@@ -16,43 +78,82 @@ class Arduino:
             memory_url (str): URL for fetching memory triggers
             port (str): Serial port (e.g., 'COM5', '/dev/ttyUSB0')
             baudrate (int): Serial communication speed
+            events (EventChannel): In-process event channel; when given, updates are
+                pushed by the Flask routes instead of polled from url/memory_url
+            interval (float): Polling interval, or idle refresh interval with events
+            keepalive_interval (float): Seconds between re-sends of an unchanged LED frame
+            color_table (ColorTable): Shared in-process color table kept up to date by the
+                Flask routes; without it colors are reloaded from markers_file when it changes
+            markers_file (str): Storage snapshot used when there is no color table
+            topology (LedTopology): Controllers, strips and marker-to-LED mapping; defaults
+                to a single 16-LED controller on port/baudrate
+            trigger_queue (TriggerQueue): Shared in-process memory trigger queue
+            consumer (str): Name of this bridge's cursor in the trigger queue
+            metrics (MetricsRegistry): Registry for the per-stage timings (fetch, build,
+                write, read) and controller stats, or None
         """
         self.url = url
         self.memory_url = memory_url
         self.port = port
         self.baudrate = baudrate
+        self.events = events
+        self.interval = interval
+        self.color_table = color_table
+        self.markers_file = markers_file
         self.marker_colors = {}
-        self.serial_connection = None
+        self.color_overrides = {}
+        self._colors_version = None
+        self.visible_markers = []
+        self.topology = topology or LedTopology.single(port, baudrate)
+        self.keepalive_interval = keepalive_interval
+        self.transports = {}
+        self.frame_senders = {}
+        self.trigger_queue = trigger_queue
+        self.consumer = consumer
+        self.memory_seq = None
+
+        self.stage_seconds = None
+        if metrics is not None:
+            self.stage_seconds = metrics.histogram(
+                'map_arduino_stage_seconds', "Seconds per stage of the Arduino bridge loop",
+                ('stage',), buckets=STAGE_BUCKETS)
+            metrics.add_stats('map_arduino_controller', self.get_controller_stats, "Arduino controller",
+                              gauges=('connected', 'queued'), label='port')
 
         # Setup logging
         logging.basicConfig(level=logging.INFO)
         self.logger = logging.getLogger(__name__)
 
-        self.logger.info(f"Arduino class initialized - Port: {port}, Baudrate: {baudrate}")
+        self.logger.info(f"Arduino class initialized - Ports: {', '.join(self.topology.ports)}, "
+                         f"LEDs: {len(self.topology)}")
 
     def load_marker_colors(self, markers_file_path):
-        """Load marker colors from local JSON file"""
+        """Load marker colors from the local JSON snapshot and its journal"""
         try:
-            with open(markers_file_path, 'r') as file:
-                data = json.load(file)
+            if not os.path.exists(markers_file_path):
+                raise FileNotFoundError(markers_file_path)
+            data = load_store(markers_file_path)
 
             # Pattern to extract number from popup_text like "New Marker (1)"
             pattern = r'\((\d+)\)'
-            colors_loaded = 0
+            # Built from scratch so deleted markers and renumbered LEDs go dark
+            marker_colors = {}
 
             for marker_id, marker_data in data.get('markers', {}).items():
-                popup_text = marker_data.get('popup_text', '')
-                color_hex = marker_data.get('color', '#FFFFFF')
+                color = marker_data.get('color')
+
+                if 'marker_number' in marker_data:
+                    marker_number = marker_data['marker_number']
+                else:
+                    # Stores written before marker numbers were a field
+                    match = re.search(pattern, marker_data.get('popup_text', ''))
+                    marker_number = int(match.group(1)) if match else None
 
-                # Extract marker number from popup text
-                match = re.search(pattern, popup_text)
-                if match:
-                    marker_number = int(match.group(1))
-                    rgb_color = self.hex_to_rgb(color_hex)
-                    self.marker_colors[marker_number] = rgb_color
-                    colors_loaded += 1
+                if marker_number is not None:
+                    marker_colors[marker_number] = self.hex_to_rgb(color)
 
-            self.logger.info(f"Loaded {colors_loaded} marker colors from {markers_file_path}")
+            self.marker_colors = marker_colors
+            self.logger.info(f"Loaded {len(marker_colors)} marker colors from {markers_file_path}")
 
         except FileNotFoundError:
             self.logger.error(f"Marker file not found: {markers_file_path}")
@@ -71,51 +172,60 @@ class Arduino:
             response.raise_for_status()
             result = response.json()
 
-            # Extract marker numbers from names using regex
-            numbers = []
-            pattern = r'\((\d+)\)'
-
-            for name in result.get('marker_names', []):
-                match = re.search(pattern, name)
-                if match:
-                    numbers.append(int(match.group(1)))
-
-            return numbers
+            if 'marker_numbers' in result:
+                return result['marker_numbers']
+            return self.marker_numbers_from_names(result.get('marker_names', []))
 
         except requests.exceptions.RequestException as e:
             self.logger.warning(f"Failed to fetch visible markers: {e}")
             return []
 
-    def fetch_memory_trigger(self):
-        """Check for memory view trigger from Flask server"""
+    def marker_numbers_from_names(self, names):
+        """Extract marker numbers from names like "New Marker (1)" using regex"""
+        numbers = []
+        pattern = r'\((\d+)\)'
+
+        for name in names:
+            match = re.search(pattern, name)
+            if match:
+                numbers.append(int(match.group(1)))
+
+        return numbers
+
+    def fetch_memory_triggers(self):
+        """Fetch the memory triggers this bridge hasn't seen yet from the Flask server"""
         try:
-            response = requests.get(self.memory_url, timeout=5)
+            params = {'consumer': self.consumer}
+            if self.memory_seq is not None:
+                params['since'] = self.memory_seq
+            response = requests.get(self.memory_url, params=params, timeout=5)
             response.raise_for_status()
             result = response.json()
 
-            if result.get('has_trigger', False):
-                trigger_data = result.get('trigger_data', [])
-                marker_number = result.get('marker_number', 0)
-                color_rgb = result.get('color_rgb', [255, 255, 255])
-
-                self.logger.info(f"Memory trigger detected - Marker: {marker_number}, RGB: {tuple(color_rgb)}")
-                return trigger_data
+            if 'seq' in result:
+                self.memory_seq = result['seq']
+            if not result.get('has_trigger', False):
+                return []
 
-            return None
+            # Older servers only return the single latest trigger
+            triggers = [entry['trigger_data'] for entry in result.get('triggers', [])] or [result['trigger_data']]
+            for trigger_data in triggers:
+                self.logger.info(f"Memory trigger detected - Marker: {trigger_data[4]}, RGB: {tuple(trigger_data[5:8])}")
+            return triggers
 
         except requests.exceptions.RequestException as e:
             self.logger.warning(f"Memory trigger request failed: {e}")
-            return None
+            return []
 
-    def hex_to_rgb(self, hex_color):
-        """Convert hex color string to RGB tuple"""
-        if hex_color.startswith('#'):
-            hex_color = hex_color[1:]
+    def hex_to_rgb(self, color):
+        """Convert a stored marker color (name, #rgb or #rrggbb) to an RGB tuple"""
         try:
-            return tuple(int(hex_color[i:i + 2], 16) for i in (0, 2, 4))
+            # Same rules as the map, so named colors light up the way they are drawn
+            hex_color = normalize_color(color)
         except ValueError:
-            self.logger.warning(f"Invalid hex color: {hex_color}")
+            self.logger.warning(f"Invalid marker color: {color}")
             return (255, 255, 255)  # Default to white
+        return tuple(int(hex_color[i:i + 2], 16) for i in (0, 2, 4))
 
     def get_marker_color(self, marker_id):
         """Get RGB color for a specific marker ID from loaded data"""
@@ -138,27 +248,66 @@ class Arduino:
         Format: [position_high][position_low][RGB_data_48_bytes]
         """
         try:
-            # Create position mask
-            position_mask = self.create_position_mask(marker_list)
-            position_bytes = position_mask.to_bytes(2, byteorder="big")
-
-            # Create RGB data for all 16 LEDs (3 bytes each = 48 total)
-            color_data = bytearray()
-            for led_id in range(1, 17):
-                if led_id in marker_list:
-                    r, g, b = self.get_marker_color(led_id)
-                else:
-                    r, g, b = 0, 0, 0  # Off
-                color_data.extend([r, g, b])
-
-            # Combine into 50-byte packet
-            packet = position_bytes + bytes(color_data)
-            return packet
+            lit = {marker_num - 1: self.get_marker_color(marker_num)
+                   for marker_num in marker_list if 1 <= marker_num <= 16}
+            return self.create_legacy_packet(lit)
 
         except Exception as e:
             self.logger.error(f"Error creating regular packet: {e}")
             return b'\x00' * 50  # Return empty packet
 
+    def create_legacy_packet(self, lit):
+        """
+        Create the 50-byte packet from {led_index: (r, g, b)} for LEDs 0-15.
+        Format: [position_high][position_low][RGB_data_48_bytes]
+        """
+        # Create position mask, LED 0 is the most significant bit
+        position_mask = 0
+        for index in lit:
+            position_mask |= 1 << (15 - index)
+        position_bytes = position_mask.to_bytes(2, byteorder="big")
+
+        # Create RGB data for all 16 LEDs (3 bytes each = 48 total), unlit LEDs are off
+        color_data = bytearray(48)
+        for index, rgb in lit.items():
+            color_data[index * 3:index * 3 + 3] = bytes(rgb)
+
+        # Combine into 50-byte packet
+        return position_bytes + bytes(color_data)
+
+    def create_strip_frame(self, strip, length, lit):
+        """
+        Create a variable-length frame for one LED strip from {led_index: (r, g, b)}.
+        Format: [0xA5][0x5A][strip][count_high][count_low][RGB_data_3*count][checksum]
+        The checksum is the low byte of the sum of the bytes between sync and checksum.
+        """
+        color_data = bytearray(length * 3)
+        for index, rgb in lit.items():
+            color_data[index * 3:index * 3 + 3] = bytes(rgb)
+
+        body = bytes([strip]) + length.to_bytes(2, byteorder="big") + bytes(color_data)
+        return FRAME_SYNC + body + bytes([sum(body) & 0xFF])
+
+    def create_port_packets(self, marker_list):
+        """Create the regular packet of every controller in the topology: {port: packet}."""
+        packets = {}
+        groups = self.topology.group_by_port(marker_list)
+        for controller in self.topology.controllers:
+            port = controller['port']
+            strips = groups[port]
+            try:
+                if controller['protocol'] == 'legacy':
+                    lit = {index: self.get_marker_color(marker_num) for index, marker_num in strips.get(0, [])}
+                    packets[port] = self.create_legacy_packet(lit)
+                else:
+                    packets[port] = b''.join(
+                        self.create_strip_frame(strip, length, {index: self.get_marker_color(marker_num)
+                                                                for index, marker_num in strips.get(strip, [])})
+                        for strip, length in enumerate(controller['strips']))
+            except Exception as e:
+                self.logger.error(f"Error creating packet for {port}: {e}")
+        return packets
+
     def create_memory_packet(self, trigger_data):
         """
         Convert memory trigger data to bytes packet.
@@ -178,124 +327,218 @@ class Arduino:
             self.logger.error(f"Error creating memory packet: {e}")
             return None
 
-    def open_serial_connection(self):
-        """Open serial connection to Arduino"""
-        try:
-            if self.serial_connection and self.serial_connection.is_open:
-                return True
-
-            self.serial_connection = serial.Serial(self.port, self.baudrate, timeout=1)
-            time.sleep(2)  # Arduino reset delay
-            self.logger.info(f"Serial connection opened on {self.port}")
-            return True
+    def create_memory_packets(self, trigger_data):
+        """
+        Route a memory trigger to the controller that drives the marker's LED.
+        Returns {port: packet}, empty if the marker has no LED.
+        """
+        if not trigger_data or len(trigger_data) != 50:
+            self.logger.error(f"Invalid trigger data length: {len(trigger_data) if trigger_data else 0}")
+            return {}
+
+        marker_number = trigger_data[4]
+        location = self.topology.locate(marker_number)
+        if location is None:
+            self.logger.warning(f"Memory trigger for marker {marker_number} without an LED")
+            return {}
+
+        port, strip, index = location
+        if self.topology.controller(port)['protocol'] == 'legacy':
+            # Legacy controllers number their own LEDs 1-16
+            packet = self.create_memory_packet(list(trigger_data[:4]) + [index + 1] + list(trigger_data[5:]))
+        else:
+            # Format: [0xA5][0x5B][strip][index_high][index_low][R][G][B][checksum]
+            body = bytes([strip]) + index.to_bytes(2, byteorder="big") + bytes(trigger_data[5:8])
+            packet = MEMORY_FRAME_SYNC + body + bytes([sum(body) & 0xFF])
+
+        return {port: packet} if packet else {}
+
+    def start_transports(self):
+        """Start one non-blocking serial transport per controller port."""
+        for controller in self.topology.controllers:
+            port = controller['port']
+            if port in self.transports:
+                continue
+            transport = SerialTransport(port, controller['baudrate'], timer=self.observe_stage)
+            # Regular frames coalesce in the queue: only the newest LED state is worth sending
+            sender = FrameSender(lambda packet, t=transport: t.submit(packet, coalesce_key='regular'),
+                                 self.keepalive_interval)
+            # A (re)connected controller has lost its state, send the next frame regardless
+            transport.on_connect = sender.invalidate
+            self.transports[port] = transport
+            self.frame_senders[port] = sender
+            transport.start()
+
+    def observe_stage(self, stage, seconds):
+        if self.stage_seconds is not None:
+            self.stage_seconds.observe(seconds, stage)
+
+    def stop_transports(self):
+        for transport in self.transports.values():
+            transport.stop()
+        self.transports = {}
+        self.frame_senders = {}
 
-        except serial.SerialException as e:
-            self.logger.error(f"Failed to open serial connection: {e}")
-            return False
+    def open_serial_connection(self):
+        """Start the serial transports; connecting happens in the background"""
+        self.start_transports()
+        return True
 
     def close_serial_connection(self):
-        """Close serial connection"""
-        try:
-            if self.serial_connection and self.serial_connection.is_open:
-                self.serial_connection.close()
-                self.logger.info("Serial connection closed")
-        except Exception as e:
-            self.logger.error(f"Error closing serial connection: {e}")
-
-    def send_packet(self, packet):
-        """Send packet to Arduino via serial"""
-        try:
-            if not self.serial_connection or not self.serial_connection.is_open:
-                if not self.open_serial_connection():
-                    return False
-
-            self.serial_connection.write(packet)
-            return True
+        """Close serial connections"""
+        self.stop_transports()
 
-        except serial.SerialException as e:
-            self.logger.error(f"Serial communication error: {e}")
-            return False
+    def send_packet(self, packet, port=None):
+        """Queue a packet for a controller (the first one by default)"""
+        if not self.transports:
+            self.start_transports()
+        return self.transports[port or self.topology.ports[0]].submit(packet)
 
-    def read_arduino_response(self):
-        """Read response from Arduino if available"""
-        try:
-            if self.serial_connection and self.serial_connection.in_waiting > 0:
-                response = self.serial_connection.readline().decode('utf-8').strip()
-                if response:
-                    self.logger.info(f"Arduino: {response}")
-                return response
-        except Exception as e:
-            self.logger.warning(f"Error reading Arduino response: {e}")
-        return None
+    def read_arduino_response(self, port=None):
+        """Return the oldest unread response from a controller, if any"""
+        transport = self.transports.get(port or self.topology.ports[0])
+        return transport.read_response() if transport else None
 
     def run_communication_to_arduino(self):
         """Main communication loop"""
-        if not self.open_serial_connection():
-            self.logger.error("Cannot start communication - serial connection failed")
-            return
+        self.start_transports()
 
         try:
             while True:
-                time.sleep(0.3)  # Communication interval
-
-                # Priority 1: Check for memory triggers
-                memory_trigger = self.fetch_memory_trigger()
-                if memory_trigger:
-                    packet = self.create_memory_packet(memory_trigger)
-                    if packet and self.send_packet(packet):
-                        # Extract info for logging
-                        header = packet[:4].hex()
-                        marker_num = packet[4]
-                        r, g, b = packet[5], packet[6], packet[7]
-
-                        self.logger.info(f"MEMORY TRIGGER SENT - Header: {header}, "
-                                         f"Marker: {marker_num}, RGB: ({r},{g},{b})")
+                memory_triggers, markers = self.wait_for_updates()
+
+                # Priority 1: Send memory triggers
+                if memory_triggers:
+                    for memory_trigger in memory_triggers:
+                        started = time.perf_counter()
+                        packets = self.create_memory_packets(memory_trigger)
+                        self.observe_stage('build', time.perf_counter() - started)
+                        for port, packet in packets.items():
+                            if self.transports[port].submit(packet):
+                                self.logger.info(f"MEMORY TRIGGER SENT - Port: {port}, Marker: {memory_trigger[4]}, "
+                                                 f"RGB: {tuple(memory_trigger[5:8])}")
+                            # Re-send the regular frame once the memory effect is done
+                            self.frame_senders[port].invalidate()
                     continue
 
-                # Priority 2: Send regular marker data
-                markers = self.fetch_visible_markers()
-                packet = self.create_regular_packet(markers)
-
-                if self.send_packet(packet):
-                    # Extract position for logging
-                    position_mask = int.from_bytes(packet[:2], byteorder="big")
-                    active_count = bin(position_mask).count('1')
+                # Priority 2: Send regular marker data, with any color changes picked up first
+                started = time.perf_counter()
+                self.refresh_marker_colors()
+                packets = self.create_port_packets(markers)
+                self.observe_stage('build', time.perf_counter() - started)
 
-                    self.logger.info(f"REGULAR DATA SENT - Active LEDs: {active_count}, "
-                                     f"Position: 0b{position_mask:016b}")
-
-                # Check for Arduino responses
-                self.read_arduino_response()
-
-                # Reload marker colors periodically
-                self.reload_marker_colors('server_storage.json')
+                for port, packet in packets.items():
+                    # Unchanged frames are skipped until the keepalive interval expires
+                    if self.frame_senders[port].send(packet):
+                        self.logger.debug(f"REGULAR DATA SENT - Port: {port}, Bytes: {len(packet)}, "
+                                         f"Active LEDs: {len(markers)}")
 
         except KeyboardInterrupt:
             self.logger.info("Communication stopped by user")
         except Exception as e:
             self.logger.error(f"Communication error: {e}")
         finally:
-            self.close_serial_connection()
+            self.stop_transports()
+
+    def wait_for_updates(self):
+        """
+        Wait for the next batch of updates.
+
+        With an event channel this returns as soon as a route publishes
+        something (or after the idle refresh interval); otherwise it sleeps
+        and polls the HTTP endpoints.
+
+        Returns:
+            tuple: (list of memory trigger arrays, list of visible marker numbers)
+        """
+        if self.events is None:
+            time.sleep(self.interval)  # Communication interval
+            started = time.perf_counter()
+            memory_triggers = self.fetch_memory_triggers()
+            if not memory_triggers:
+                self.visible_markers = self.fetch_visible_markers()
+            self.observe_stage('fetch', time.perf_counter() - started)
+            return memory_triggers, self.visible_markers
+
+        memory_triggers = []
+        events = self.events.get_all(timeout=self.interval)
+        # Waiting for an event is idle time; only the draining counts as fetching
+        started = time.perf_counter()
+        for kind, payload in events:
+            if kind == 'memory_trigger' and self.trigger_queue is None:
+                memory_triggers.append(payload)
+            elif kind == 'visible_markers':
+                self.visible_markers = payload
+        if self.trigger_queue is not None:
+            # The event only wakes us up; the queue keeps this bridge's cursor
+            memory_triggers.extend(trigger for _, trigger in self.trigger_queue.read(self.consumer))
+        self.observe_stage('fetch', time.perf_counter() - started)
+        return memory_triggers, self.visible_markers
 
     def reload_marker_colors(self, markers_file_path):
         """Reload marker colors from file"""
         self.load_marker_colors(markers_file_path)
+        self.marker_colors.update(self.color_overrides)
+
+    def refresh_marker_colors(self):
+        """
+        Rebuild the marker colors only if they changed: from the shared color
+        table when running in-process, otherwise when the storage files'
+        modification stamps change.
+        """
+        if self.color_table is not None:
+            version, colors = self.color_table.colors()
+            if version == self._colors_version:
+                return False
+            self.marker_colors = {number: self.hex_to_rgb(color) for number, color in colors.items()}
+            self.marker_colors.update(self.color_overrides)
+        else:
+            version = self.get_store_stamp(self.markers_file)
+            if version == self._colors_version:
+                return False
+            self.reload_marker_colors(self.markers_file)
+
+        self._colors_version = version
+        return True
+
+    def get_store_stamp(self, markers_file_path):
+        """Modification stamp of a storage snapshot and its journals"""
+        journal_path = journal_path_for(markers_file_path)
+        stamp = []
+        # SQLite stores write through their -wal file first
+        for path in (markers_file_path, journal_path, journal_path + '.compacting', markers_file_path + '-wal'):
+            try:
+                stat = os.stat(path)
+                stamp.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
 
     def set_marker_color_override(self, marker_id, rgb_tuple):
         """Override a marker color temporarily"""
         if isinstance(rgb_tuple, tuple) and len(rgb_tuple) == 3:
+            self.color_overrides[marker_id] = rgb_tuple
             self.marker_colors[marker_id] = rgb_tuple
             self.logger.info(f"Color override set for marker {marker_id}: {rgb_tuple}")
         else:
             self.logger.error(f"Invalid RGB tuple for marker {marker_id}: {rgb_tuple}")
 
+    def get_controller_stats(self):
+        """Frame and transport stats per controller port"""
+        return {
+            port: dict(self.frame_senders[port].get_stats(), **transport.get_stats())
+            for port, transport in list(self.transports.items())
+        }
+
     def get_status(self):
         """Get current status of the Arduino connection"""
         return {
-            'serial_connected': self.serial_connection is not None and self.serial_connection.is_open,
+            'serial_connected': any(transport.connected for transport in self.transports.values()),
             'port': self.port,
             'baudrate': self.baudrate,
             'loaded_colors': len(self.marker_colors),
+            'push_events': self.events is not None,
+            'controllers': self.get_controller_stats(),
             'urls': {
                 'markers': self.url,
                 'memory': self.memory_url
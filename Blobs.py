@@ -0,0 +1,164 @@
+import os
+import mmap
+import uuid
+import hashlib
+import threading
+import logging
+from io import BytesIO
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+TEXT_CONTENT_TYPE = 'text/plain; charset=utf-8'
+
+# A blob written to a temp file but not yet moved into the store
+StagedBlob = namedtuple('StagedBlob', ['hash', 'size', 'tmp_path'])
+
+
+class BlobStore:
+    def __init__(self, root_dir):
+        """
+        Content-addressed blob files: each blob is stored once under its
+        SHA-256, as root_dir/ab/abcdef...
+
+        Args:
+            root_dir (str): Directory holding the blobs
+        """
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+        # Uploads interrupted by a crash
+        for name in os.listdir(root_dir):
+            if name.endswith('.tmp'):
+                os.remove(os.path.join(root_dir, name))
+
+    def path(self, blob_hash):
+        return os.path.join(self.root_dir, blob_hash[:2], blob_hash)
+
+    def exists(self, blob_hash):
+        return os.path.exists(self.path(blob_hash))
+
+    def stage(self, data):
+        """Write bytes to a temp file; returns a StagedBlob to commit() or discard()."""
+        return self.stage_stream(BytesIO(data))
+
+    def stage_stream(self, stream):
+        """Copy a file-like object to a temp file chunk by chunk, hashing as it goes."""
+        digest = hashlib.sha256()
+        size = 0
+        tmp_path = os.path.join(self.root_dir, f"upload.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, 'wb') as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        return StagedBlob(digest.hexdigest(), size, tmp_path)
+
+    def commit(self, staged):
+        """
+        Move a staged blob into place (or drop it if the content is already
+        stored). Commit and delete under the same lock as the references so a
+        blob can't be deleted while another upload of it is being committed.
+        """
+        path = self.path(staged.hash)
+        if os.path.exists(path):
+            os.remove(staged.tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(staged.tmp_path, path)
+        return staged.hash, staged.size
+
+    def discard(self, staged):
+        try:
+            os.remove(staged.tmp_path)
+        except OSError:
+            pass
+
+    def put(self, data):
+        """Store bytes and return (hash, size)."""
+        return self.commit(self.stage(data))
+
+    def read(self, blob_hash):
+        """Read a whole blob (only for small ones, e.g. text memories)."""
+        with open(self.path(blob_hash), 'rb') as f:
+            return f.read()
+
+    def iter_range(self, blob_hash, start, stop, chunk_size=CHUNK_SIZE):
+        """Yield bytes [start, stop) of a blob from a memory-mapped view of the file."""
+        if stop <= start:
+            return
+        with open(self.path(blob_hash), 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                for offset in range(start, stop, chunk_size):
+                    yield view[offset:min(offset + chunk_size, stop)]
+
+    def delete(self, blob_hash):
+        try:
+            os.remove(self.path(blob_hash))
+        except OSError as e:
+            logger.warning(f"Could not delete blob {blob_hash}: {e}")
+
+
+class MemoryIndex:
+    def __init__(self):
+        """
+        In-memory index of marker id -> (size, hash, content type) of its memory
+        blob, with a reference count per blob so unreferenced blobs can be
+        deleted. Answers "has this marker a memory, and is it a file?" without
+        touching any memory body.
+        """
+        self._entries = {}
+        self._refs = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, marker_id):
+        return marker_id in self._entries
+
+    def has_memory(self, marker_id):
+        return marker_id in self._entries
+
+    def get(self, marker_id):
+        """Return (size, hash, content_type) or None."""
+        return self._entries.get(marker_id)
+
+    def content_type(self, marker_id):
+        """Return the content type of a marker's memory, or None if it has none."""
+        entry = self._entries.get(marker_id)
+        return entry[2] if entry else None
+
+    def is_referenced(self, blob_hash):
+        return blob_hash in self._refs
+
+    def set(self, marker_id, size, blob_hash, content_type=None):
+        """
+        Point a marker at a blob.
+
+        Returns:
+            str: Hash of a blob that is no longer referenced, or None
+        """
+        with self._lock:
+            old = self._entries.get(marker_id)
+            self._entries[marker_id] = (size, blob_hash, content_type)
+            self._refs[blob_hash] = self._refs.get(blob_hash, 0) + 1
+            return self._release_locked(old[1]) if old else None
+
+    def remove(self, marker_id):
+        """Drop a marker's memory; returns the hash of a now unreferenced blob, or None."""
+        with self._lock:
+            old = self._entries.pop(marker_id, None)
+            return self._release_locked(old[1]) if old else None
+
+    def _release_locked(self, blob_hash):
+        self._refs[blob_hash] -= 1
+        if self._refs[blob_hash]:
+            return None
+        del self._refs[blob_hash]
+        return blob_hash
@@ -0,0 +1,201 @@
+import os
+import re
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_SAFE_KEY = re.compile(r'^[A-Za-z0-9@._-]{1,100}$')
+
+
+class LRUCache:
+    def __init__(self, max_entries=128):
+        """
+        Thread-safe, size-bounded in-memory LRU cache.
+
+        Args:
+            max_entries (int): Entries kept before the least recently used is evicted
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DiskLRUCache:
+    def __init__(self, cache_dir, max_entries=None, max_bytes=None):
+        """
+        Size-bounded on-disk LRU cache of byte strings, one file per key.
+
+        Recency is kept in memory and mirrored to file mtimes, so the LRU
+        order survives a restart.
+
+        Args:
+            cache_dir (str): Directory holding the cached files
+            max_entries (int): Maximum number of files (None for no limit)
+            max_bytes (int): Maximum total size in bytes (None for no limit)
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # filename -> size, oldest first
+        self._total_bytes = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        """Rebuild the LRU order from the files already on disk."""
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp') or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, name, stat.st_size))
+
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._total_bytes += size
+
+        with self._lock:
+            self._evict_locked()
+
+    def _filename(self, key):
+        if _SAFE_KEY.match(key):
+            return key
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self._filename(key) in self._entries
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def get(self, key):
+        """Return the cached bytes for key, or None."""
+        name = self._filename(key)
+        path = os.path.join(self.cache_dir, name)
+        with self._lock:
+            if name not in self._entries:
+                return None
+            self._entries.move_to_end(name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except OSError:
+            # Removed behind our back
+            with self._lock:
+                size = self._entries.pop(name, None)
+                if size is not None:
+                    self._total_bytes -= size
+            return None
+
+    def put(self, key, data):
+        """Store bytes under key, evicting least recently used entries if needed."""
+        name = self._filename(key)
+        path = os.path.join(self.cache_dir, name)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            old_size = self._entries.pop(name, None)
+            if old_size is not None:
+                self._total_bytes -= old_size
+            self._entries[name] = len(data)
+            self._total_bytes += len(data)
+            self._evict_locked()
+
+    def _evict_locked(self):
+        while self._entries and (
+                (self.max_entries is not None and len(self._entries) > self.max_entries) or
+                (self.max_bytes is not None and self._total_bytes > self.max_bytes)):
+            name, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError as e:
+                logger.warning(f"Could not evict cache file {name}: {e}")
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        """
+        Request coalescing: while a call for a key is running, other callers
+        with the same key wait for it and share its result (or exception)
+        instead of running it again.
+        """
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0  # calls that waited for another caller's result
+
+    def do(self, key, fn, *args):
+        """Run fn(*args) unless a call for key is already running, then return its result."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn(*args)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
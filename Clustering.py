@@ -0,0 +1,174 @@
+import math
+import threading
+
+TILE_SIZE = 256  # pixels per map tile at every zoom
+MAX_LAT = 85.05112878  # Web Mercator limit
+
+
+def project(lat, lon):
+    """Web Mercator position of a point as fractions (0..1) of the world width/height."""
+    lat = max(-MAX_LAT, min(MAX_LAT, lat))
+    sin_lat = math.sin(math.radians(lat))
+    x = (lon + 180.0) / 360.0
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return x, y
+
+
+class ClusterIndex:
+    def __init__(self, radius=60, min_zoom=0, max_zoom=16):
+        """
+        Marker clusters for every zoom level, kept up to date incrementally.
+
+        At zoom z the world is cut into square cells of `radius` screen
+        pixels; the markers of a cell form one cluster. Cells double in
+        resolution with every zoom level, so each cell has exactly four
+        children one level down and the levels form a quadtree. Each level
+        only keeps a count and coordinate sums per cell; the marker ids are
+        kept at max_zoom. Positions are not kept: the caller passes a
+        marker's stored position to remove() (the storage has it anyway).
+        Insert and remove cost O(zoom levels), and a query returns at most
+        one cluster per `radius` pixels of the view, however many markers it
+        holds.
+
+        Args:
+            radius (int): Cluster cell size in screen pixels
+            min_zoom (int): Coarsest clustered zoom level
+            max_zoom (int): Finest clustered zoom level; beyond it markers are not clustered
+        """
+        self.radius = radius
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self._scales = {z: (2 ** z) * TILE_SIZE / radius for z in range(min_zoom, max_zoom + 1)}
+        self._levels = {z: {} for z in self._scales}  # zoom -> {cell: [count, sum_lat, sum_lon]}
+        self._members = {}  # cell at max_zoom -> {marker_id}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(entry[0] for entry in self._levels[self.min_zoom].values())
+
+    def _cell_of(self, x, y, zoom):
+        scale = self._scales[zoom]
+        return (math.floor(x * scale), math.floor(y * scale))
+
+    # ------------------------------------------------------------- updates
+
+    def insert(self, marker_id, lat, lon):
+        """Add a marker. A marker that moved must be removed at its old position first."""
+        with self._lock:
+            x, y = project(lat, lon)
+            members = self._members.setdefault(self._cell_of(x, y, self.max_zoom), set())
+            if marker_id in members:
+                return
+            members.add(marker_id)
+            for zoom, cells in self._levels.items():
+                cell = self._cell_of(x, y, zoom)
+                entry = cells.get(cell)
+                if entry is None:
+                    cells[cell] = [1, lat, lon]
+                else:
+                    entry[0] += 1
+                    entry[1] += lat
+                    entry[2] += lon
+
+    def remove(self, marker_id, lat, lon):
+        """Remove a marker indexed at (lat, lon). Returns False if it was not indexed there."""
+        with self._lock:
+            x, y = project(lat, lon)
+            cell = self._cell_of(x, y, self.max_zoom)
+            members = self._members.get(cell)
+            if not members or marker_id not in members:
+                return False
+            members.remove(marker_id)
+            if not members:
+                del self._members[cell]
+            for zoom, cells in self._levels.items():
+                cell = self._cell_of(x, y, zoom)
+                entry = cells[cell]
+                entry[0] -= 1
+                if entry[0]:
+                    entry[1] -= lat
+                    entry[2] -= lon
+                else:
+                    del cells[cell]
+            return True
+
+    def rebuild(self, items):
+        """Replace the index contents with (marker_id, lat, lon) tuples."""
+        with self._lock:
+            for cells in self._levels.values():
+                cells.clear()
+            self._members.clear()
+        for marker_id, lat, lon in items:
+            self.insert(marker_id, lat, lon)
+
+    # ------------------------------------------------------------- queries
+
+    def clamp_zoom(self, zoom):
+        return max(self.min_zoom, min(self.max_zoom, int(zoom)))
+
+    def query(self, west, south, east, north, zoom):
+        """
+        Return the clusters whose cell overlaps a bounding box at a zoom level.
+
+        Returns:
+            list: Dicts with id ('zoom/x/y'), lat/lon (the members' centroid),
+                  count, expansion_zoom (the zoom at which the cluster splits)
+                  and marker_id when the cluster is a single marker
+        """
+        zoom = self.clamp_zoom(zoom)
+        x0, y0 = project(north, west)
+        x1, y1 = project(south, east)
+        min_cell = self._cell_of(x0, y0, zoom)
+        max_cell = self._cell_of(x1, y1, zoom)
+
+        with self._lock:
+            cells = self._levels[zoom]
+            span = (max_cell[0] - min_cell[0] + 1) * (max_cell[1] - min_cell[1] + 1)
+            if span <= len(cells):
+                found = ((cell, cells.get(cell)) for cell in (
+                    (cx, cy) for cx in range(min_cell[0], max_cell[0] + 1)
+                    for cy in range(min_cell[1], max_cell[1] + 1)))
+            else:
+                found = ((cell, entry) for cell, entry in cells.items()
+                         if min_cell[0] <= cell[0] <= max_cell[0] and min_cell[1] <= cell[1] <= max_cell[1])
+
+            clusters = []
+            for cell, entry in found:
+                if entry is None:
+                    continue
+                count, sum_lat, sum_lon = entry
+                cluster = {
+                    'id': f"{zoom}/{cell[0]}/{cell[1]}",
+                    'lat': sum_lat / count,
+                    'lon': sum_lon / count,
+                    'count': count
+                }
+                if count == 1:
+                    cluster['marker_id'] = self._single_member_locked(zoom, cell)
+                else:
+                    cluster['expansion_zoom'] = self._expansion_zoom_locked(zoom, cell)
+                clusters.append(cluster)
+            return clusters
+
+    def _children_locked(self, zoom, cell):
+        cells = self._levels[zoom + 1]
+        cx, cy = cell
+        return [child for child in ((2 * cx, 2 * cy), (2 * cx + 1, 2 * cy), (2 * cx, 2 * cy + 1),
+                                    (2 * cx + 1, 2 * cy + 1)) if child in cells]
+
+    def _single_member_locked(self, zoom, cell):
+        """Follow a one-marker cell down the quadtree to the member ids."""
+        while zoom < self.max_zoom:
+            cell = self._children_locked(zoom, cell)[0]
+            zoom += 1
+        return next(iter(self._members[cell]))
+
+    def _expansion_zoom_locked(self, zoom, cell):
+        """First zoom level at which a cluster's markers fall into more than one cell."""
+        while zoom < self.max_zoom:
+            children = self._children_locked(zoom, cell)
+            zoom += 1
+            if len(children) > 1:
+                return zoom
+            cell = children[0]
+        return self.max_zoom + 1
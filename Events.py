@@ -0,0 +1,214 @@
+import time
+import threading
+from collections import deque
+
+
+class EventChannel:
+    def __init__(self, max_events=256):
+        """
+        Thread-safe in-process channel from the Flask routes to the Arduino bridge.
+
+        Events are (kind, payload) tuples. The channel is bounded; if nobody
+        consumes it the oldest events are dropped.
+
+        Args:
+            max_events (int): Events kept before the oldest is dropped
+        """
+        self._events = deque(maxlen=max_events)
+        self._cond = threading.Condition()
+        self.stats = {'published': 0, 'dropped': 0}
+
+    def __len__(self):
+        return len(self._events)
+
+    def publish(self, kind, payload=None):
+        """Publish an event and wake up any waiting consumer."""
+        with self._cond:
+            self.stats['published'] += 1
+            if len(self._events) == self._events.maxlen:
+                self.stats['dropped'] += 1
+            self._events.append((kind, payload))
+            self._cond.notify_all()
+
+    def get_all(self, timeout=None):
+        """
+        Wait until at least one event is available (or timeout expires) and
+        return every pending event in publish order.
+        """
+        with self._cond:
+            if not self._events:
+                self._cond.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+            return events
+
+    def get_stats(self):
+        return dict(self.stats, pending=len(self._events))
+
+
+class ColorTable:
+    def __init__(self):
+        """
+        Shared, versioned marker color table.
+
+        The Flask routes update it as markers change; the Arduino bridge
+        compares the version with the one it last saw and only rebuilds
+        its LED colors when it changed.
+        """
+        self._entries = {}  # marker_id -> (marker_number, color)
+        self._lock = threading.Lock()
+        self._colors = {}
+        self._colors_version = 0
+        self.version = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def set(self, marker_id, marker_number, color):
+        """Set the LED number and color of a marker (marker_number None removes it)."""
+        with self._lock:
+            entry = (marker_number, color) if marker_number is not None else None
+            if self._entries.get(marker_id) == entry:
+                return
+            if entry is None:
+                self._entries.pop(marker_id, None)
+            else:
+                self._entries[marker_id] = entry
+            self.version += 1
+
+    def remove(self, marker_id):
+        with self._lock:
+            if self._entries.pop(marker_id, None) is not None:
+                self.version += 1
+
+    def rebuild(self, entries):
+        """Replace the table with (marker_id, marker_number, color) tuples."""
+        with self._lock:
+            self._entries = {marker_id: (number, color) for marker_id, number, color in entries
+                             if number is not None}
+            self.version += 1
+
+    def colors(self):
+        """Return (version, {marker_number: color})."""
+        with self._lock:
+            if self._colors_version != self.version:
+                self._colors = {number: color for number, color in self._entries.values()}
+                self._colors_version = self.version
+            return self.version, dict(self._colors)
+
+
+class TriggerQueue:
+    def __init__(self, max_triggers=64, coalesce_window=0.5, max_batch=4):
+        """
+        Bounded, thread-safe queue of memory triggers with per-consumer cursors.
+
+        Every trigger gets an increasing sequence number. Each consumer (an
+        Arduino bridge, a polling client) keeps its own cursor, so several
+        consumers all see every trigger instead of the first reader clearing it.
+
+        Coalescing keeps a burst of clicks from flooding the serial line: a
+        repeat trigger for the same marker within coalesce_window replaces the
+        pending one, and a read returns the newest trigger per marker. A read
+        returns at most max_batch markers; the rest stay pending for the
+        next read instead of being lost.
+
+        Args:
+            max_triggers (int): Triggers kept before the oldest is dropped
+            coalesce_window (float): Seconds in which a repeat for the same marker is merged
+            max_batch (int): Most triggers handed to a consumer per read
+        """
+        self.max_triggers = max_triggers
+        self.coalesce_window = coalesce_window
+        self.max_batch = max_batch
+        self._triggers = deque(maxlen=max_triggers)  # (seq, key, trigger, pushed_at)
+        self._cursors = {}  # consumer -> last seq read
+        self._cond = threading.Condition()
+        self.seq = 0
+        # overwritten: pending triggers replaced by a repeat, dropped: pushed out of the full buffer,
+        # deferred: markers left for the next read because a batch was full
+        self.stats = {'pushed': 0, 'coalesced': 0, 'overwritten': 0, 'dropped': 0, 'missed': 0, 'deferred': 0}
+
+    def __len__(self):
+        return len(self._triggers)
+
+    def push(self, key, trigger):
+        """
+        Add a trigger for key (the marker id) and wake up waiting consumers.
+
+        Returns:
+            int: Sequence number of the trigger
+        """
+        now = time.monotonic()
+        with self._cond:
+            self.stats['pushed'] += 1
+            if self._triggers:
+                seq, last_key, _, pushed_at = self._triggers[-1]
+                if last_key == key and now - pushed_at < self.coalesce_window and \
+                        all(cursor < seq for cursor in self._cursors.values()):
+                    # Nobody has seen it yet, just refresh it
+                    self._triggers[-1] = (seq, key, trigger, now)
+                    self.stats['coalesced'] += 1
+                    self.stats['overwritten'] += 1
+                    return seq
+
+            if len(self._triggers) == self.max_triggers:
+                self.stats['dropped'] += 1
+            self.seq += 1
+            self._triggers.append((self.seq, key, trigger, now))
+            self._cond.notify_all()
+            return self.seq
+
+    def read(self, consumer, since=None, timeout=None):
+        """
+        Return the triggers a consumer hasn't seen yet and advance its cursor.
+
+        A new consumer starts at the current end of the queue, so a restarted
+        bridge doesn't replay old triggers. Passing since overrides the stored
+        cursor (for stateless HTTP consumers).
+
+        Args:
+            consumer (str): Consumer name
+            since (int): Last sequence number the consumer has seen
+            timeout (float): Seconds to wait for a new trigger (None returns at once)
+
+        Returns:
+            list: (seq, trigger) tuples in push order
+        """
+        with self._cond:
+            if since is not None:
+                self._cursors[consumer] = since
+            cursor = self._cursors.setdefault(consumer, self.seq)
+            if timeout and self.seq <= cursor:
+                self._cond.wait_for(lambda: self.seq > self._cursors.get(consumer, cursor), timeout)
+                cursor = self._cursors.get(consumer, cursor)
+
+            pending = [(seq, key, trigger) for seq, key, trigger, _ in self._triggers if seq > cursor]
+            if pending and pending[0][0] > cursor + 1 and cursor < self.seq:
+                # Fell behind the bounded buffer
+                self.stats['missed'] += pending[0][0] - cursor - 1
+            if not pending:
+                self._cursors[consumer] = self.seq
+                return []
+
+            # Newest trigger per marker, in push order of those newest triggers
+            latest = {}
+            for seq, key, trigger in pending:
+                latest.pop(key, None)
+                latest[key] = (seq, trigger)
+            batch = list(latest.values())[:self.max_batch]
+            # Only advance past what was delivered. Every older trigger up to
+            # there belongs to a delivered marker, so the others stay pending.
+            delivered = batch[-1][0]
+            self._cursors[consumer] = delivered
+            self.stats['coalesced'] += sum(1 for seq, _, _ in pending if seq <= delivered) - len(batch)
+            if len(latest) > len(batch):
+                self.stats['deferred'] += len(latest) - len(batch)
+            return batch
+
+    def forget(self, consumer):
+        with self._cond:
+            self._cursors.pop(consumer, None)
+
+    def get_stats(self):
+        with self._cond:
+            return dict(self.stats, pending=len(self._triggers), seq=self.seq, consumers=len(self._cursors))
@@ -0,0 +1,315 @@
+import os
+import csv
+import json
+import time
+import bisect
+import logging
+import threading
+import unicodedata
+
+import requests
+
+from Cache import LRUCache, DiskLRUCache, SingleFlight
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = 'Map_app geocoder (+https://github.com/Arthur-cascardo/Map_app)'
+NOMINATIM_URL = 'https://nominatim.openstreetmap.org/search'
+SAME_PLACE_DEGREES = 0.1  # results of different sources this close, with the same name, are one place
+
+
+class GeocodeUnavailable(Exception):
+    """The upstream geocoder could not be reached or failed."""
+
+
+def normalize_query(text):
+    """Case- and accent-insensitive form of a place name, with single spaces."""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char)).casefold()
+    text = ''.join(char if char.isalnum() else ' ' for char in text)
+    return ' '.join(text.split())
+
+
+class Gazetteer:
+    SHORT_PREFIX = 3  # prefixes up to this length use a precomputed top list
+    TOP_ENTRIES = 20  # entries kept per short prefix, most populous first
+    SCAN_LIMIT = 5000  # index keys scanned for a longer prefix
+
+    def __init__(self, entries):
+        """
+        Offline place index for prefix search.
+
+        Every normalized name, and every suffix of it that starts at a word
+        ("york" finds "New York"), is a key of a sorted array. The keys
+        starting with a prefix are one contiguous slice, found by bisection.
+        This is a flattened prefix trie at a fraction of the memory of
+        per-node dicts. Short prefixes match too many keys to rank on the
+        fly, so their most populous entries are precomputed.
+
+        Args:
+            entries (list): Dicts with name, lat, lon and optionally
+                            display_name, population and alt_names
+        """
+        self.entries = entries
+        keys = []
+        for entry_id, entry in enumerate(entries):
+            names = {normalize_query(entry['name'])}
+            names.update(normalize_query(name) for name in entry.get('alt_names', ()))
+            for name in names:
+                words = name.split(' ')
+                keys.extend((' '.join(words[i:]), entry_id) for i in range(len(words)) if words[i])
+        keys.sort()
+        self._keys = [key for key, _ in keys]
+        self._ids = [entry_id for _, entry_id in keys]
+
+        top = {}
+        for key, entry_id in keys:
+            for length in range(1, min(len(key), self.SHORT_PREFIX) + 1):
+                top.setdefault(key[:length], set()).add(entry_id)
+        self._top = {prefix: sorted(ids, key=self._population_rank)[:self.TOP_ENTRIES]
+                     for prefix, ids in top.items()}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _population_rank(self, entry_id):
+        return -(self.entries[entry_id].get('population') or 0)
+
+    def search(self, query, limit=5):
+        """
+        Places whose name (or a word of it) starts with the query. Text after
+        a comma must appear in the place's display name ("paris, texas").
+        Exact name matches come first, then the most populous places.
+
+        Returns:
+            list: Result dicts like the upstream geocoder's
+        """
+        name, qualifiers = self._split_query(query)
+        if not name:
+            return []
+
+        if len(name) <= self.SHORT_PREFIX and not qualifiers:
+            candidates = list(self._top.get(name, ()))
+            candidates += [entry_id for entry_id in self._exact(name) if entry_id not in candidates]
+        else:
+            start = bisect.bisect_left(self._keys, name)
+            stop = min(bisect.bisect_left(self._keys, name + '\uffff'), start + self.SCAN_LIMIT)
+            candidates = list(dict.fromkeys(self._ids[start:stop]))
+
+        exact = set(self._exact(name))
+        results = []
+        for entry_id in sorted(candidates, key=lambda i: (i not in exact, self._population_rank(i))):
+            entry = self.entries[entry_id]
+            display_name = entry.get('display_name') or entry['name']
+            if not self._qualifies(entry, qualifiers):
+                continue
+            results.append({'name': entry['name'], 'display_name': display_name,
+                            'lat': float(entry['lat']), 'lon': float(entry['lon'])})
+            if len(results) >= limit:
+                break
+        return results
+
+    def has_exact(self, query):
+        """
+        Whether a place's whole name (or alternate name) is the query, e.g.
+        "york" for York but not for New York. Qualifiers must match as in search().
+        """
+        name, qualifiers = self._split_query(query)
+        for entry_id in self._exact(name):
+            entry = self.entries[entry_id]
+            names = {normalize_query(entry['name'])}
+            names.update(normalize_query(alt_name) for alt_name in entry.get('alt_names', ()))
+            if name in names and self._qualifies(entry, qualifiers):
+                return True
+        return False
+
+    @staticmethod
+    def _split_query(query):
+        """Split "name, qualifier, ..." into the normalized name and qualifiers."""
+        name, *qualifiers = [normalize_query(part) for part in query.split(',')]
+        return name, [part for part in qualifiers if part]
+
+    @staticmethod
+    def _qualifies(entry, qualifiers):
+        normalized = normalize_query(entry.get('display_name') or entry['name'])
+        return all(part in normalized for part in qualifiers)
+
+    def _exact(self, name):
+        start = bisect.bisect_left(self._keys, name)
+        stop = bisect.bisect_right(self._keys, name)
+        return self._ids[start:stop]
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Load a gazetteer: a JSON list of entries (see gazetteer.example.json),
+        or a GeoNames dump such as cities500.txt (tab separated).
+        """
+        if path.endswith('.json'):
+            with open(path, 'r', encoding='utf-8') as f:
+                return cls(json.load(f))
+
+        entries = []
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            for row in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+                if len(row) < 15:
+                    continue
+                # geonameid, name, asciiname, alternatenames, lat, lon, class, code, country, ..., population
+                entries.append({
+                    'name': row[1],
+                    'alt_names': [row[2]] if row[2] != row[1] else [],
+                    'display_name': f"{row[1]}, {row[8]}",
+                    'lat': float(row[4]),
+                    'lon': float(row[5]),
+                    'population': int(row[14] or 0)
+                })
+        return cls(entries)
+
+
+class NominatimUpstream:
+    def __init__(self, url=NOMINATIM_URL, min_interval=1.0, timeout=10.0):
+        """
+        Nominatim search client. Requests are spaced at least min_interval
+        seconds apart, as the public instance's usage policy asks.
+
+        Args:
+            url (str): Search endpoint of Nominatim or a compatible stand-in
+            min_interval (float): Seconds between requests
+            timeout (float): Seconds per request
+        """
+        self.url = url
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self._next_request = 0.0
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        self._session.headers['User-Agent'] = USER_AGENT
+
+    def search(self, query, limit=5):
+        """Return result dicts or raise GeocodeUnavailable."""
+        with self._lock:
+            delay = self._next_request - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._next_request = time.monotonic() + self.min_interval
+            try:
+                response = self._session.get(self.url, params={'q': query, 'format': 'json', 'limit': limit},
+                                             timeout=self.timeout)
+                response.raise_for_status()
+                places = response.json()
+            except (requests.RequestException, ValueError) as e:
+                raise GeocodeUnavailable(f"{self.url}: {e}") from e
+
+        return [{'name': place.get('name') or place['display_name'].split(',')[0],
+                 'display_name': place['display_name'],
+                 'lat': float(place['lat']), 'lon': float(place['lon'])} for place in places]
+
+
+def same_place(a, b):
+    """Whether two results are the same place, as named by different sources."""
+    return (normalize_query(a['name']) == normalize_query(b['name'])
+            and abs(a['lat'] - b['lat']) < SAME_PLACE_DEGREES and abs(a['lon'] - b['lon']) < SAME_PLACE_DEGREES)
+
+
+def merge_results(upstream, local, limit):
+    """Upstream results first (they are ranked for the whole query), then local places they lack."""
+    merged = list(upstream[:limit])
+    for result in local:
+        if len(merged) >= limit:
+            break
+        if not any(same_place(result, other) for other in merged):
+            merged.append(result)
+    return merged
+
+
+def geocode_upstream_from_env():
+    """NominatimUpstream for the public instance, or for MAP_GEOCODE_UPSTREAM if it is set."""
+    return NominatimUpstream(os.environ.get('MAP_GEOCODE_UPSTREAM') or NOMINATIM_URL)
+
+
+class Geocoder:
+    def __init__(self, upstream, cache_dir, gazetteer=None, memory_entries=1024, max_bytes=16 * 1024 * 1024):
+        """
+        Place search: the local gazetteer first, then cached upstream
+        answers (memory LRU, then disk LRU), then the upstream geocoder.
+        The gazetteer answers alone only when a place is named exactly like
+        the query; prefix matches ("york" for New York) are merged with the
+        upstream's answer, so places missing from the gazetteer can still be
+        found. Identical queries in flight at the same time share one
+        upstream request. Answers without results are only cached in memory,
+        so they are retried after a restart.
+
+        Args:
+            upstream: Object with search(query, limit) -> list raising GeocodeUnavailable
+            cache_dir (str): Directory of the on-disk cache
+            gazetteer (Gazetteer): Offline index searched first, or None
+            memory_entries (int): Answers kept in memory
+            max_bytes (int): Size bound of the on-disk cache
+        """
+        self.upstream = upstream
+        self.gazetteer = gazetteer
+        self._memory = LRUCache(memory_entries)
+        self._disk = DiskLRUCache(cache_dir, max_bytes=max_bytes)
+        self._flights = SingleFlight()
+        self.stats = {'gazetteer': 0, 'merged': 0, 'memory_hits': 0, 'disk_hits': 0, 'upstream': 0,
+                      'upstream_errors': 0}
+
+    def search(self, query, limit=5):
+        """
+        Returns:
+            tuple: (results, source) where source is 'gazetteer', 'cache' or
+                   'upstream' (the source of the upstream part of a merged answer)
+
+        Raises:
+            GeocodeUnavailable: Nothing local matched and the upstream failed
+        """
+        local = []
+        if self.gazetteer is not None:
+            local = self.gazetteer.search(query, limit)
+            if local and self.gazetteer.has_exact(query):
+                self.stats['gazetteer'] += 1
+                return local, 'gazetteer'
+
+        try:
+            results, source = self._search_upstream(query, limit)
+        except GeocodeUnavailable:
+            if local:
+                # Prefix matches are better than an error
+                self.stats['gazetteer'] += 1
+                return local, 'gazetteer'
+            raise
+        if local:
+            self.stats['merged'] += 1
+            results = merge_results(results, local, limit)
+        return results, source
+
+    def _search_upstream(self, query, limit):
+        key = f"{limit}:{normalize_query(query)}"
+        results = self._memory.get(key)
+        if results is not None:
+            self.stats['memory_hits'] += 1
+            return results, 'cache'
+        data = self._disk.get(key)
+        if data is not None:
+            self.stats['disk_hits'] += 1
+            results = json.loads(data)
+            self._memory.put(key, results)
+            return results, 'cache'
+
+        return self._flights.do(key, self._fetch, key, query, limit), 'upstream'
+
+    def _fetch(self, key, query, limit):
+        try:
+            results = self.upstream.search(query, limit)
+        except GeocodeUnavailable:
+            self.stats['upstream_errors'] += 1
+            raise
+        self.stats['upstream'] += 1
+        self._memory.put(key, results)
+        if results:
+            self._disk.put(key, json.dumps(results).encode('utf-8'))
+        return results
+
+    def get_stats(self):
+        return dict(self.stats, coalesced=self._flights.coalesced,
+                    gazetteer_places=len(self.gazetteer) if self.gazetteer is not None else 0)
@@ -0,0 +1,172 @@
+import os
+import sys
+import hashlib
+import threading
+import logging
+import time
+from io import BytesIO
+
+from Cache import LRUCache, DiskLRUCache
+
+logger = logging.getLogger(__name__)
+
+# A PyInstaller build unpacks its bundled data files (see Map.spec) to sys._MEIPASS
+if getattr(sys, 'frozen', False):
+    APP_DIR = sys._MEIPASS
+else:
+    APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Base pin, bundled with the app
+BASE_PIN_PATH = os.path.join(APP_DIR, 'static', 'pinwithshadow2.png')
+
+# Leaflet's own marker, from the CDN the page already loads Leaflet from.
+# Used when the colored icons can't be rendered (base pin or PIL missing).
+DEFAULT_ICON_URL = "https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/images/marker-icon.png"
+DEFAULT_ICON_RETINA_URL = "https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/images/marker-icon-2x.png"
+
+# Seconds before loading a base pin that failed to load is tried again
+BASE_PIN_RETRY_SECONDS = 60
+
+# Only pixels of exactly this color are recolored, outline/inner circle are kept
+TARGET_RGB = (127, 58, 58)  # #7f3a3a
+
+# Marker icon size in CSS pixels and the pixel-density variants we serve
+ICON_SIZE = (30, 41)
+ICON_SCALES = (1, 2, 3)
+
+# Named colors accepted by the marker routes (same values as getColorHex in context_menu.js)
+NAMED_COLORS = {
+    'blue': '0066cc',
+    'red': 'cc0000',
+    'green': '00cc00',
+    'orange': 'ff8800',
+    'yellow': 'ffcc00',
+    'violet': '8800cc',
+    'grey': '808080',
+    'black': '333333'
+}
+
+
+def normalize_color(color):
+    """Convert a color name or #rgb/#rrggbb string to lowercase 'rrggbb'."""
+    color = (color or 'blue').strip().lower()
+    if color in NAMED_COLORS:
+        return NAMED_COLORS[color]
+    color = color.lstrip('#')
+    if len(color) == 3:
+        color = ''.join(c * 2 for c in color)
+    if len(color) != 6 or any(c not in '0123456789abcdef' for c in color):
+        raise ValueError(f"Invalid color: {color}")
+    return color
+
+
+def load_base_pin(path=BASE_PIN_PATH):
+    """Load the bundled base pin as an RGBA array."""
+    # NumPy and PIL load with the first icon, not with the server
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(path) as img:
+        return np.array(img.convert("RGBA"))
+
+
+def recolor_pin(base_rgba, mask, hex_color):
+    """Return a copy of the base pin with the masked pixels set to hex_color."""
+    new_rgb = [int(hex_color[i:i + 2], 16) for i in (0, 2, 4)]
+    pixels = base_rgba.copy()
+    pixels[mask, :3] = new_rgb
+    return pixels
+
+
+def encode_icon_png(pixels, scale):
+    """Scale a recolored pin to the icon size and encode it as PNG bytes."""
+    from PIL import Image
+    img = Image.fromarray(pixels, mode="RGBA")
+    # Scale after recoloring so the exact-match mask isn't blurred
+    img = img.resize((ICON_SIZE[0] * scale, ICON_SIZE[1] * scale), Image.LANCZOS)
+    buffer = BytesIO()
+    img.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+class IconCache:
+    def __init__(self, cache_dir, max_entries=512, memory_entries=128, base_pin_path=BASE_PIN_PATH):
+        """
+        Colored marker icons, generated with a NumPy mask and cached in memory and on disk.
+
+        Args:
+            cache_dir (str): Directory for the on-disk LRU cache
+            max_entries (int): Icons kept on disk
+            memory_entries (int): Icons kept in memory
+            base_pin_path (str): Bundled base pin image
+        """
+        self.base_pin_path = base_pin_path
+        self._memory = LRUCache(memory_entries)
+        self._disk = DiskLRUCache(cache_dir, max_entries=max_entries)
+        self._base = None
+        self._mask = None
+        self._base_error = None  # (exception, monotonic time) of the last failed load
+        self._base_lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'renders': 0, 'render_errors': 0}
+
+    def _load_base(self):
+        with self._base_lock:
+            if self._base is None:
+                # Don't hit the disk (or a missing PIL) again on every request
+                if self._base_error and time.monotonic() - self._base_error[1] < BASE_PIN_RETRY_SECONDS:
+                    raise self._base_error[0]
+                try:
+                    base = load_base_pin(self.base_pin_path)
+                except Exception as e:
+                    logger.error(f"Could not load base pin {self.base_pin_path}: {e}")
+                    self._base_error = (e, time.monotonic())
+                    raise
+                self._mask = (base[..., :3] == TARGET_RGB).all(axis=-1)
+                self._base = base
+                self._base_error = None
+        return self._base, self._mask
+
+    def get(self, hex_color, scale=1):
+        """
+        Return {'png': bytes, 'hash': str} for a normalised color and scale.
+        Looks in memory, then on disk, and only renders on a miss in both.
+        """
+        key = f"{hex_color}@{scale}x.png"
+        icon = self._memory.get(key)
+        if icon is not None:
+            self.stats['memory_hits'] += 1
+            return icon
+
+        png = self._disk.get(key)
+        if png is not None:
+            self.stats['disk_hits'] += 1
+        else:
+            self.stats['renders'] += 1
+            try:
+                base, mask = self._load_base()
+            except Exception:
+                self.stats['render_errors'] += 1
+                raise
+            png = encode_icon_png(recolor_pin(base, mask, hex_color), scale)
+            self._disk.put(key, png)
+
+        icon = {'png': png, 'hash': hashlib.sha1(png).hexdigest()[:12]}
+        self._memory.put(key, icon)
+        return icon
+
+    def get_stats(self):
+        return dict(self.stats, memory_entries=len(self._memory), disk_entries=len(self._disk))
+
+    def prewarm(self, colors, scales=(1, 2)):
+        """Generate icons for the given colors ahead of the first request."""
+        warmed = 0
+        for color in colors:
+            try:
+                hex_color = normalize_color(color)
+            except ValueError:
+                continue
+            for scale in scales:
+                self.get(hex_color, scale)
+                warmed += 1
+        logger.info(f"Pre-warmed {warmed} marker icons")
+        return warmed
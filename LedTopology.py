@@ -0,0 +1,87 @@
+import json
+
+# 'legacy' is the original 50-byte, 16-LED packet; 'frame' is the variable-length strip frame
+PROTOCOLS = ('legacy', 'frame')
+LEGACY_MAX_LEDS = 16
+
+
+class LedTopology:
+    def __init__(self, controllers):
+        """
+        Map marker numbers to LEDs across several controllers and strips.
+
+        Marker numbers are handed out in order: the first controller's first
+        strip gets 1..n, its next strip continues from n+1, then the next
+        controller, and so on.
+
+        Args:
+            controllers (list): One dict per serial port, e.g.
+                {'port': 'COM6', 'baudrate': 115200, 'protocol': 'frame', 'strips': [60, 60]}
+        """
+        self.controllers = []
+        self._locations = {}  # marker_number -> (port, strip, index)
+
+        marker_number = 1
+        for controller in controllers:
+            controller = {
+                'port': controller['port'],
+                'baudrate': controller.get('baudrate', 9600),
+                'protocol': controller.get('protocol', 'frame'),
+                'strips': [int(length) for length in controller.get('strips', [LEGACY_MAX_LEDS])]
+            }
+            if controller['protocol'] not in PROTOCOLS:
+                raise ValueError(f"Unknown LED protocol: {controller['protocol']}")
+            if controller['protocol'] == 'legacy' and (
+                    len(controller['strips']) != 1 or controller['strips'][0] > LEGACY_MAX_LEDS):
+                raise ValueError(f"Legacy controllers drive one strip of at most {LEGACY_MAX_LEDS} LEDs")
+            if any(port['port'] == controller['port'] for port in self.controllers):
+                raise ValueError(f"Port {controller['port']} is listed twice")
+
+            for strip, length in enumerate(controller['strips']):
+                for index in range(length):
+                    self._locations[marker_number] = (controller['port'], strip, index)
+                    marker_number += 1
+            self.controllers.append(controller)
+
+        self._by_port = {controller['port']: controller for controller in self.controllers}
+
+    @classmethod
+    def single(cls, port, baudrate):
+        """The original setup: one Arduino with 16 LEDs and the 50-byte packet."""
+        return cls([{'port': port, 'baudrate': baudrate, 'protocol': 'legacy', 'strips': [LEGACY_MAX_LEDS]}])
+
+    @classmethod
+    def from_file(cls, path):
+        """Load a topology from a JSON file with a 'controllers' list."""
+        with open(path, 'r') as f:
+            return cls(json.load(f)['controllers'])
+
+    def __len__(self):
+        return len(self._locations)
+
+    @property
+    def ports(self):
+        return [controller['port'] for controller in self.controllers]
+
+    def controller(self, port):
+        return self._by_port[port]
+
+    def locate(self, marker_number):
+        """Return (port, strip, index) of a marker number, or None if it has no LED."""
+        return self._locations.get(marker_number)
+
+    def group_by_port(self, marker_numbers):
+        """
+        Group marker numbers by where their LEDs are.
+
+        Returns:
+            dict: {port: {strip: [(index, marker_number), ...]}}, with every port present
+        """
+        groups = {port: {} for port in self.ports}
+        for marker_number in marker_numbers:
+            location = self._locations.get(marker_number)
+            if location is None:
+                continue
+            port, strip, index = location
+            groups[port].setdefault(strip, []).append((index, marker_number))
+        return groups
@@ -1,96 +1,245 @@
-from flask import Flask, render_template_string, request, jsonify, send_from_directory
+import time
+STARTUP_STARTED = time.perf_counter()
+
+from flask import Flask, render_template_string, request, jsonify, send_from_directory, Response, g, redirect
 import webbrowser
 import os
-from folium import plugins
-import requests
 import uuid
 import numbers
 import re
 import json
+import html
 import random
-import time
-from Arduino import Arduino
+from LedTopology import LedTopology
+from Storage import open_storage, MarkerNumberIndex, DuplicateMarkerNumber
+from SpatialIndex import GridIndex, StorageIndex
+from Clustering import ClusterIndex
+from Events import EventChannel, ColorTable, TriggerQueue
+from Viewports import ViewportSessions, ViewportOutOfSync
+from Serving import serve_production
+from Blobs import BlobStore, MemoryIndex, TEXT_CONTENT_TYPE
+from Icons import (IconCache, normalize_color, NAMED_COLORS, ICON_SIZE, ICON_SCALES,
+                   DEFAULT_ICON_URL, DEFAULT_ICON_RETINA_URL, APP_DIR)
+from Metrics import MetricsRegistry, CONTENT_TYPE as METRICS_CONTENT_TYPE
 import threading
 import logging
-from io import BytesIO
-import base64
-from PIL import Image
-import requests
-import folium
-import numpy as np
+import argparse
+import gzip
+import hashlib
+from contextlib import contextmanager
+from urllib.parse import quote
+
+# folium, numpy, PIL and requests are imported where they are first used, so
+# the server can bind before they load; see load_data() and warm_up()
+startup_phases = [('imports', time.perf_counter() - STARTUP_STARTED)]
+
+
+@contextmanager
+def startup_phase(name):
+    """Record how long a startup step takes, for --profile-startup."""
+    started = time.perf_counter()
+    yield
+    startup_phases.append((name, time.perf_counter() - started))
+
 
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
 
 # Create Flask application instance
-app = Flask(__name__, static_url_path='/static', static_folder='static')
+app = Flask(__name__, static_url_path='/static', static_folder=os.path.join(APP_DIR, 'static'))
+
+# Request, Arduino bridge and cache metrics, scraped from /metrics
+metrics = MetricsRegistry()
+request_count = metrics.counter('map_http_requests_total', "HTTP requests by route, method and status",
+                                ('route', 'method', 'status'))
+request_latency = metrics.histogram('map_http_request_duration_seconds', "HTTP request latency by route",
+                                    ('route', 'method'))
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        # Label by URL rule, not path, so /get_marker/<id> is one series
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_latency.observe(time.perf_counter() - started, route, request.method)
+        request_count.inc(route, request.method, str(response.status_code))
+    return response
+
+
+# The data is loaded in the background after the server binds (load_data());
+# until then requests wait for it, except those that don't need it
+DATA_WAIT_TIMEOUT = 30.0  # seconds before a waiting request gets a 503
+NO_DATA_ENDPOINTS = {'static', 'icon_route', 'metrics_route'}
+data_ready = threading.Event()
+
+
+@app.before_request
+def wait_for_data():
+    if request.endpoint in NO_DATA_ENDPOINTS or data_ready.is_set():
+        return None
+    if not data_ready.wait(DATA_WAIT_TIMEOUT):
+        response = jsonify({"status": "error", "message": "Server is still loading its data"})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    return None
+
 
 # Server-side storage for map elements
 STORAGE_FILE = "server_storage.json"
+# 'json' (journaled JSON file) or 'sqlite' (migrated from STORAGE_FILE on first start)
+STORAGE_BACKEND = os.environ.get('MAP_STORAGE_BACKEND', 'json')
+STORAGE_DB_FILE = "server_storage.db"
 
-# Global variable to store current visible markers
-current_visible_markers = []
+# Optional LED controller/strip layout, see led_topology.example.json
+LED_TOPOLOGY_FILE = "led_topology.json"
 
-# Global variable to store memory view trigger data for Arduino
-memory_view_trigger = None
+# Visible markers per browser tab; the LEDs show their aggregate
+VIEWPORT_TTL = 30.0  # seconds without an update before a tab is forgotten
+VIEWPORT_AGGREGATION = 'union'  # 'union', 'intersection' or 'primary'
+viewports = ViewportSessions(ttl=VIEWPORT_TTL, mode=VIEWPORT_AGGREGATION)
 
-# Load once at module level (fastest)
-with open('./context_menu.js', 'r') as f:
-    JS_TEMPLATE = f.read()
+# Memory view triggers for the Arduino bridges, one cursor per consumer
+memory_triggers = TriggerQueue()
+
+# In-process channel the routes publish visible-marker and memory-trigger events into
+arduino_events = EventChannel()
+
+# LED colors by marker number, updated by the mutation routes and read by the Arduino bridge
+marker_color_table = ColorTable()
+
+# Page script, read on first use
+JS_TEMPLATE = None
+
+
+def get_js_template():
+    global JS_TEMPLATE
+    if JS_TEMPLATE is None:
+        with open('./context_menu.js', 'r') as f:
+            JS_TEMPLATE = f.read()
+    return JS_TEMPLATE
+
+
+# Journaled store: mutations are appended to server_storage.journal and
+# folded back into STORAGE_FILE by a background compaction thread.
+# The SQLite backend reads rows on demand instead of loading everything.
+# Opened by load_data().
+storage = None
+
+# Spatial index over marker positions, kept in sync by the mutation routes
+# (the SQLite backend answers bounding box queries from its own index)
+marker_index = None
+
+# Marker clusters for every zoom level, kept in sync with marker_index
+CLUSTER_RADIUS = 60  # pixels covered by one cluster
+CLUSTER_MAX_ZOOM = 16  # from the next zoom level on every marker is shown
+CLUSTER_MIN_MARKERS = 300  # views with at most this many markers are not clustered
+marker_clusters = ClusterIndex(radius=CLUSTER_RADIUS, max_zoom=CLUSTER_MAX_ZOOM)
+
+
+def marker_number_from_text(popup_text):
+    """Extract the marker number from text like "New Marker (12)"."""
+    match = re.search(r'\((\d+)\)', popup_text or '')
+    return int(match.group(1)) if match else None
+
+
+def get_led_color(marker_data):
+    """Return the '#rrggbb' LED color of a marker."""
+    return led_color(marker_data.get('color'))
+
+
+def led_color(color):
+    """Return the '#rrggbb' LED color for a stored marker color."""
+    try:
+        return '#' + normalize_color(color)
+    except ValueError:
+        return color
+
+
+def update_marker_color(marker_id, marker_data):
+    """Publish a marker's LED number and color to the shared color table."""
+    marker_color_table.set(marker_id, marker_data.get('marker_number'), get_led_color(marker_data))
 
-if os.path.exists(STORAGE_FILE):
-    with open(STORAGE_FILE, "r") as f:
-        server_storage = json.load(f)
-else:
-    server_storage = {
-        'markers': {},
-        'paths': {},
-        'memories': {}
-    }
 
+def load_marker_numbers():
+    """
+    Build the marker number index from the marker_number field alone. Markers
+    stored before numbers were an explicit field get one parsed from their
+    popup text, once, and persisted; only those records are read whole.
+    """
+    for mid, marker_number in storage.iter_fields('markers', ('marker_number',)):
+        if marker_number is None:
+            continue
+        try:
+            marker_numbers.assign(mid, marker_number)
+        except DuplicateMarkerNumber:
+            print(f"Marker number {marker_number} of {mid} is already used, clearing it")
+            storage.put('markers', mid, dict(storage.get('markers', mid), marker_number=None))
+
+    for mid, m in storage.items_missing('markers', 'marker_number'):
+        marker_number = marker_number_from_text(m.get('popup_text'))
+        if marker_numbers.id_of(marker_number) is not None:
+            print(f"Marker number {marker_number} of {mid} is already used, clearing it")
+            marker_number = None
+        marker_numbers.assign(mid, marker_number)
+        storage.put('markers', mid, dict(m, marker_number=marker_number))
+
+
+# Marker id <-> marker number, kept in sync by the mutation routes
+marker_numbers = MarkerNumberIndex()
 
-def get_context_menu_js(map_div_id, map_var_name, markers_data):
-    js_content = JS_TEMPLATE.replace('{{MAP_DIV_ID}}', map_div_id)
+
+def requested_marker_number(data, popup_text):
+    """
+    Marker number from a request: an explicit 'marker_number' field wins,
+    otherwise it is taken from popup text like "New Marker (12)".
+    """
+    if 'marker_number' in data:
+        marker_number = data['marker_number']
+        if marker_number is not None and (isinstance(marker_number, bool) or
+                                          not isinstance(marker_number, int) or marker_number < 1):
+            raise ValueError("marker_number must be a positive integer")
+        return marker_number
+    return marker_number_from_text(popup_text)
+
+
+def validate_coordinates(lat, lon):
+    """Return an error message for invalid coordinates, or None if they are fine."""
+    if not isinstance(lat, (int, float)) or not isinstance(lon, (int, float)):
+        return "Invalid coordinates"
+    if not (-90 <= lat <= 90) or not (-180 <= lon <= 180):
+        return "Coordinates out of range"
+    return None
+
+
+def get_context_menu_js(map_div_id, map_var_name, initial_markers=None):
+    js_content = get_js_template().replace('{{MAP_DIV_ID}}', map_div_id)
     js_content = js_content.replace('{{MAP_VAR_NAME}}', map_var_name)
-    js_content = js_content.replace('{{MARKERS_DATA}}', json.dumps(markers_data))
+    # '</' is escaped so marker text can't close the script tag
+    js_content = js_content.replace('{{INITIAL_MARKERS}}', json.dumps(initial_markers).replace('</', '<\\/'))
     return f"<script>\n{js_content}\n</script>"
 
 
-def save_storage():
-    """Save the server_storage dictionary to JSON."""
-    with open(STORAGE_FILE, "w") as f:
-        json.dump(server_storage, f, indent=4)
+def save_storage(path=STORAGE_FILE):
+    """Export the whole store as a plain JSON file."""
+    if path == STORAGE_FILE:
+        storage.compact()
+    else:
+        storage.export_json(path)
 
 
 def get_marker_number_from_id(marker_id):
-    """
-    Convert marker_id to a number between 1-16.
-    Uses hash of the marker_id to ensure consistent mapping.
-    """
-    try:
-        # Access the global server_storage dictionary
-        global server_storage
-        marker_data = server_storage.get('markers', {}).get(marker_id)
-
-        if not marker_data:
-            log.warning(f"Marker ID '{marker_id}' not found in server_storage")
-            return None
-
-        popup_text = marker_data.get('popup_text', '')
-
-        # Regex to extract number inside parentheses, e.g., "New Marker (12)"
-        match = re.search(r'\((\d+)\)', popup_text)
-        if match:
-            marker_number = int(match.group(1))
-            log.info(f"Extracted marker number {marker_number} for ID '{marker_id}'")
-            return marker_number
-        else:
-            log.warning(f"No number found in popup_text for marker ID '{marker_id}'")
-            return None
+    """Return the LED number of a marker, or None if it has none."""
+    marker_number = marker_numbers.number_of(marker_id)
+    if marker_number is None:
+        log.warning(f"No marker number for marker ID '{marker_id}'")
+    return marker_number
 
-    except Exception as e:
-        log.error(f"Error extracting marker number for ID '{marker_id}': {e}")
-        return None
 
 def hex_color_to_rgb(hex_color):
     """Convert hex color to RGB tuple."""
@@ -99,7 +248,11 @@ def hex_color_to_rgb(hex_color):
     return tuple(int(hex_color[i:i + 2], 16) for i in (0, 2, 4))
 
 
-def create_memory_view_array(marker_id, marker_color):
+# LED color of a memory view when the marker has no (usable) color
+DEFAULT_LED_COLOR = '0000ff'
+
+
+def create_memory_view_array(marker_id, marker_color, marker_number=None):
     """
     Create a unique 50-byte array for memory view trigger.
     Format: [4-byte header][MARKER_NUMBER][R][G][B][43 padding bytes]
@@ -107,8 +260,15 @@ def create_memory_view_array(marker_id, marker_color):
     # 4-byte header that's very unlikely to occur in regular data
     MEMORY_HEADER = [0xFF, 0xFE, 0xFD, 0xFC]
 
-    marker_number = get_marker_number_from_id(marker_id)
-    r, g, b = hex_color_to_rgb(marker_color)
+    if marker_number is None:
+        marker_number = get_marker_number_from_id(marker_id)
+    # Named colors ('blue', ...) are stored as-is
+    try:
+        hex_color = normalize_color(marker_color)
+    except ValueError:
+        print(f"Unknown color {marker_color!r} of marker {marker_id}, using the default LED color")
+        hex_color = DEFAULT_LED_COLOR
+    r, g, b = hex_color_to_rgb(hex_color)
 
     # Create 50-byte array
     memory_array = [0] * 50
@@ -125,60 +285,152 @@ def create_memory_view_array(marker_id, marker_color):
     return memory_array
 
 
-# Cache for colored icons
-_icon_cache = {}
+# Memory bodies (text, photos, audio) live in content-addressed blob files;
+# storage only keeps a small {blob, size, content_type} record per marker
+MEMORY_BLOB_DIR = "memory_blobs"
+memory_blobs = BlobStore(MEMORY_BLOB_DIR)
+memory_index = MemoryIndex()
 
 
-def get_colored_marker_icon(color):
+def memory_record(blob_hash, size, content_type, filename=None):
+    return {'blob': blob_hash, 'size': size, 'content_type': content_type, 'filename': filename}
+
+
+def set_memory(marker_id, staged, content_type, filename=None):
+    """Point a marker at a staged blob. Call inside storage.transaction()."""
+    blob_hash, size = memory_blobs.commit(staged)
+    storage.put('memories', marker_id, memory_record(blob_hash, size, content_type, filename))
+    unreferenced = memory_index.set(marker_id, size, blob_hash, content_type)
+    if unreferenced:
+        memory_blobs.delete(unreferenced)
+
+
+def drop_memory(marker_id):
+    """Remove a marker's memory and its blob if nothing else uses it. Call inside storage.transaction()."""
+    storage.delete('memories', marker_id)
+    unreferenced = memory_index.remove(marker_id)
+    if unreferenced:
+        memory_blobs.delete(unreferenced)
+
+
+def load_memory_index():
     """
-    Create or retrieve a custom colored marker icon.
-    Recolors only the #7f3a3a area, preserves outline/inner circle.
-    Uses caching so each color is generated only once.
+    Build the memory index from the stored records. Memories stored inline
+    as text by older versions are moved into blobs, once.
     """
-    if color in _icon_cache:
-        return folium.CustomIcon(
-            icon_image=_icon_cache[color],
-            icon_size=(30, 41),
-            icon_anchor=(12, 41),
-            popup_anchor=(1, -34)
-        )
+    for mid, memory in storage.items('memories'):
+        if isinstance(memory, str):
+            blob_hash, size = memory_blobs.put(memory.encode('utf-8'))
+            memory = memory_record(blob_hash, size, TEXT_CONTENT_TYPE)
+            storage.put('memories', mid, memory)
+        elif not memory_blobs.exists(memory['blob']):
+            print(f"Memory blob of marker {mid} is missing")
+        memory_index.set(mid, memory['size'], memory['blob'], memory['content_type'])
+
+
+# GPS tracks: points in NumPy array blobs, served as simplified encoded polylines
+PATH_BLOB_DIR = "path_blobs"
+path_store = None
 
-    # Download base image
-    base_url = "https://raw.githubusercontent.com/Arthur-cascardo/Files/refs/heads/main/pinwithshadow2.png"
-    response = requests.get(base_url)
-    base_img = Image.open(BytesIO(response.content)).convert("RGBA")
 
-    target_rgb = (127, 58, 58)  # #7f3a3a
-    new_rgb = tuple(int(color.lstrip("#")[i:i + 2], 16) for i in (0, 2, 4))
+# Base map tiles, proxied through /tiles and kept in a bounded on-disk LRU.
+# Set MAP_TILE_UPSTREAM (e.g. http://127.0.0.1:8080/{layer}/{z}/{x}/{y}) to use
+# another tile server; seed an area for offline use with `python Tiles.py seed`.
+TILE_CACHE_DIR = "tile_cache"
+TILE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+tile_cache = None
 
-    # Fast recolor with putdata
-    data = base_img.getdata()
-    new_data = [(new_rgb[0], new_rgb[1], new_rgb[2], a) if (r, g, b) == target_rgb else (r, g, b, a)
-                for r, g, b, a in data]
-    base_img.putdata(new_data)
 
-    # Encode as base64
-    buffer = BytesIO()
-    base_img.save(buffer, format="PNG")
-    img_str = base64.b64encode(buffer.getvalue()).decode("utf-8")
-    data_url = f"data:image/png;base64,{img_str}"
+def proxied_tile_layer(layer, **kwargs):
+    """folium TileLayer that loads a TILE_LAYERS layer through the /tiles proxy."""
+    import folium
+    from Tiles import TILE_LAYERS
+    spec = TILE_LAYERS[layer]
+    return folium.TileLayer(tiles=f"/tiles/{layer}/{{z}}/{{x}}/{{y}}", attr=spec['attr'], name=spec['name'],
+                            max_zoom=spec['max_zoom'], **kwargs)
 
-    # Cache result
-    _icon_cache[color] = data_url
 
-    return folium.CustomIcon(
-        icon_image=data_url,
-        icon_size=(30, 41),
+# Place search for the search box: the optional offline gazetteer (a JSON list
+# like gazetteer.example.json, or a GeoNames dump such as cities500.txt), then
+# cached Nominatim answers. MAP_GEOCODE_UPSTREAM replaces the Nominatim URL.
+GAZETTEER_FILE = "gazetteer.json"
+GEOCODE_CACHE_DIR = "geocode_cache"
+geocoder = None
+
+
+# Colored marker icons, cached in memory and in a bounded on-disk LRU
+ICON_CACHE_DIR = "icon_cache"
+icon_cache = IconCache(ICON_CACHE_DIR)
+
+
+def get_colored_marker_icon(color):
+    """Create a folium icon for a custom colored marker."""
+    import folium
+    icon = folium.CustomIcon(
+        icon_image='data:,',
+        icon_size=ICON_SIZE,
         icon_anchor=(12, 41),
         popup_anchor=(1, -34)
     )
+    # folium tries to open a root-relative URL as a local file, so link it afterwards
+    icon.options['icon_url'] = get_marker_icon_url(color)
+    return icon
+
+
+def get_marker_icon_url(color, scale=1):
+    """
+    Return the /icons URL of a colored marker icon.
+    The content hash in the query string changes whenever the image does,
+    so the browser can cache the URL forever. If the icon can't be rendered
+    Leaflet's default marker is used, so the page and the API still work.
+    """
+    try:
+        hex_color = normalize_color(color)
+    except ValueError:
+        hex_color = NAMED_COLORS['blue']
+    try:
+        icon = get_marker_icon_png(hex_color, scale)
+    except Exception as e:
+        print(f"Error rendering marker icon {hex_color}: {e}")
+        return DEFAULT_ICON_URL if scale == 1 else DEFAULT_ICON_RETINA_URL
+    suffix = '' if scale == 1 else f'@{scale}x'
+    return f"/icons/{hex_color}{suffix}.png?v={icon['hash']}"
+
+
+def get_marker_icon_png(hex_color, scale=1):
+    """Return {'png': bytes, 'hash': str} for a colored marker icon."""
+    return icon_cache.get(hex_color, scale)
+
+
+def get_palette_colors():
+    """Return the quick-select palette defined in context_menu.js."""
+    match = re.search(r'var colorPalette = \[(.*?)\];', get_js_template(), re.S)
+    return re.findall(r"'(#[0-9a-fA-F]{6})'", match.group(1)) if match else []
+
+
+def prewarm_icons():
+    """Render the palette icons in the background so the first page needs no work."""
+    try:
+        icon_cache.prewarm(get_palette_colors() + ['blue'])
+    except Exception as e:
+        print(f"Error pre-warming marker icons: {e}")
 
 
 def com_with_arduino():
+    from Arduino import Arduino
+    # Several controllers/strips can be described in LED_TOPOLOGY_FILE,
+    # otherwise a single 16-LED Arduino on COM5 is used
+    topology = LedTopology.from_file(LED_TOPOLOGY_FILE) if os.path.exists(LED_TOPOLOGY_FILE) else None
     arduino_com = Arduino(url='http://127.0.0.1:5000/api/visible_markers',
                           memory_url='http://127.0.0.1:5000/api/memory_trigger',
                           port='COM5',
-                          baudrate=9600
+                          baudrate=9600,
+                          events=arduino_events,
+                          color_table=marker_color_table,
+                          markers_file=STORAGE_DB_FILE if STORAGE_BACKEND == 'sqlite' else STORAGE_FILE,
+                          topology=topology,
+                          trigger_queue=memory_triggers,
+                          metrics=metrics
                           )
     while True:
         arduino_com.run_communication_to_arduino()
@@ -193,11 +445,12 @@ class InteractiveWorldMap:
         self.markers = []
 
     def create_base_map(self, center_lat=20.0, center_lon=0.0, zoom_start=3):
+        import folium
         # Create base map with world bounds and no wrap
         self.map = folium.Map(
             location=[center_lat, center_lon],
             zoom_start=zoom_start,
-            tiles='OpenStreetMap',
+            tiles=None,
             # Limit the map to show only one world
             max_bounds=True,
             world_copy_jump=False,
@@ -220,17 +473,13 @@ class InteractiveWorldMap:
         return self.map
 
     def add_tile_layers(self):
-        # Alternative free tile layers with no_wrap option
-        folium.TileLayer(
-            tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
-            attr='Esri World Imagery',
-            name='Satellite View',
-            overlay=False,
-            control=True,
-            no_wrap=True
-        ).add_to(self.map)
+        # Both base layers load through the local caching proxy, with no_wrap
+        proxied_tile_layer('osm', overlay=False, control=True, no_wrap=True).add_to(self.map)
+        proxied_tile_layer('satellite', overlay=False, control=True, no_wrap=True).add_to(self.map)
 
     def add_map_controls(self):
+        import folium
+        from folium import plugins
         folium.LayerControl().add_to(self.map)
         plugins.Fullscreen().add_to(self.map)
         plugins.MeasureControl().add_to(self.map)
@@ -247,11 +496,12 @@ class InteractiveWorldMap:
             lng_formatter=fmtr,
         ).add_to(self.map)
 
-        minimap = plugins.MiniMap()
+        minimap = plugins.MiniMap(tile_layer=proxied_tile_layer('osm'))
         self.map.add_child(minimap)
 
     def add_marker(self, lat, lon, popup_text="Marker", tooltip_text=None, color='blue'):
         """Add a marker with custom colored icon."""
+        import folium
         marker = folium.Marker(
             location=[lat, lon],
             popup=folium.Popup(popup_text, max_width=300),
@@ -263,6 +513,7 @@ class InteractiveWorldMap:
         return marker
 
     def add_path(self, coordinates, popup_text="Path", color='blue', weight=3):
+        import folium
         polyline = folium.PolyLine(
             locations=coordinates,
             popup=popup_text,
@@ -274,49 +525,66 @@ class InteractiveWorldMap:
         return polyline
 
 
+# Rendered index page, valid for one storage generation
+_page_cache = {}
+_page_lock = threading.Lock()
+
+
+def get_cached_page():
+    """
+    Return the rendered index page for the current storage generation.
+    The page is rendered once per generation and kept both plain and gzipped.
+    """
+    page = _page_cache.get('page')
+    if page is not None and page['generation'] == storage.generation:
+        return page
+
+    with _page_lock:
+        # Another request may have rendered it while we were waiting
+        page = _page_cache.get('page')
+        generation = storage.generation
+        if page is not None and page['generation'] == generation:
+            return page
+
+        body = render_index_page().encode('utf-8')
+        page = {
+            'generation': generation,
+            'etag': hashlib.sha1(body).hexdigest(),
+            'body': body,
+            'gzip': gzip.compress(body, compresslevel=6)
+        }
+        _page_cache['page'] = page
+        return page
+
+
 @app.route('/')
 def index():
-    # Create map instance
-    world_map = InteractiveWorldMap()
-    world_map.create_base_map()
+    page = get_cached_page()
 
-    # Add existing markers from storage
-    for marker_id, marker_data in server_storage['markers'].items():
-        memory_text = server_storage['memories'].get(marker_id)
+    if request.if_none_match.contains(page['etag']):
+        response = Response(status=304)
+    elif 'gzip' in request.accept_encodings:
+        response = Response(page['gzip'], mimetype='text/html')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(page['body'], mimetype='text/html')
 
-        # Get the color from marker data, default to 'blue'
-        marker_color = marker_data.get('color', 'blue')
+    response.set_etag(page['etag'])
+    response.headers['Vary'] = 'Accept-Encoding'
+    # Let the browser keep the page but revalidate it on every reload
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
-        popup_content_html = f"""
-            <div>
-                <h4>{marker_data['popup_text']}</h4>
-                <p>Lat: {marker_data['lat']:.4f}, Lon: {marker_data['lon']:.4f}</p>
-                <p>Color: <span style="color: {marker_color};">● {marker_color.title()}</span></p>
-        """
-        if memory_text:
-            popup_content_html += f"""
-                <p>Memory: <span style="color: green;">✓</span></p>
-                <button onclick="viewMemory('{marker_id}')">View Memory</button><br>
-            """
-        else:
-            popup_content_html += f"""
-                <p>Memory: <span style="color: red;">✗</span></p>
-            """
 
-        popup_content_html += f"""
-                <button onclick="addMemoryPrompt('{marker_id}')">Add Memory</button>
-                <button onclick="editMarkerPrompt('{marker_id}')" style="margin-left: 5px;">Edit Marker</button>
-                <button onclick="deleteMarker('{marker_id}')" style="margin-left: 5px; background-color: #dc3545; color: white; border: none; padding: 5px 10px; border-radius: 3px; cursor: pointer;">Delete Marker</button>
-            </div>
-        """
+def render_index_page():
+    # Create map instance
+    world_map = InteractiveWorldMap()
+    zoom_start = 3
+    world_map.create_base_map(zoom_start=zoom_start)
 
-        world_map.add_marker(
-            lat=marker_data['lat'],
-            lon=marker_data['lon'],
-            popup_text=popup_content_html,
-            tooltip_text=marker_data.get('tooltip_text'),
-            color=marker_color
-        )
+    # Markers are not rendered as folium markers; the page starts from the
+    # clusters of the whole world and then loads the ones in view from /api/markers
+    initial_markers = markers_in_view([-180.0, -90.0, 180.0, 90.0], zoom_start)
 
     # Get the map HTML
     map_html = world_map.map.get_root().render()
@@ -331,18 +599,8 @@ def index():
         map_var_name = 'leafletMap'
         map_div_id = 'map'
 
-    # Create marker data dictionary for JavaScript (include color information)
-    markers_data = {}
-    for mid, mdata in server_storage['markers'].items():
-        markers_data[mid] = {
-            'lat': mdata['lat'],
-            'lon': mdata['lon'],
-            'name': mdata['popup_text'],
-            'color': mdata.get('color', 'blue')  # Include color in the data
-        }
-
     # Enhanced JavaScript with world bounds enforcement and search functionality
-    context_menu_js = get_context_menu_js(map_div_id, map_var_name, markers_data)
+    context_menu_js = get_context_menu_js(map_div_id, map_var_name, initial_markers)
 
     # Insert our JavaScript right before the closing body tag
     if '</body>' in map_html:
@@ -353,51 +611,346 @@ def index():
     return map_html
 
 
+def js_argument(value):
+    """Quote a value as a JavaScript literal for an inline event handler attribute."""
+    return html.escape(json.dumps(value), quote=True)
+
+
+def build_marker_popup_html(marker_id, marker_data, memory_content_type):
+    """
+    Build the popup HTML shown when a marker is clicked.
+
+    Args:
+        marker_id (str): Marker id
+        marker_data (dict): Stored marker
+        memory_content_type (str): Content type of the marker's memory, None without one
+    """
+    # Get the color from marker data, default to 'blue'
+    marker_color = marker_data.get('color', 'blue')
+    # Ids from older imports weren't validated, so never put them in a handler unquoted
+    marker_arg = js_argument(marker_id)
+
+    popup_content_html = f"""
+        <div>
+            <h4>{marker_data['popup_text']}</h4>
+            <p>Lat: {marker_data['lat']:.4f}, Lon: {marker_data['lon']:.4f}</p>
+            <p>Color: <span style="color: {marker_color};">● {marker_color.title()}</span></p>
+    """
+    if memory_content_type:
+        # Files are opened straight from the click, which popup blockers allow
+        is_file = 'false' if memory_content_type.startswith('text/') else 'true'
+        popup_content_html += f"""
+            <p>Memory: <span style="color: green;">✓</span></p>
+            <button onclick="viewMemory({marker_arg}, {is_file})">View Memory</button><br>
+        """
+    else:
+        popup_content_html += f"""
+            <p>Memory: <span style="color: red;">✗</span></p>
+        """
+
+    popup_content_html += f"""
+            <button onclick="addMemoryPrompt({marker_arg})">Add Memory</button>
+            <button onclick="addMemoryFile({marker_arg})" style="margin-left: 5px;">Attach File</button><br>
+            <button onclick="editMarkerPrompt({marker_arg})" style="margin-left: 5px;">Edit Marker</button>
+            <button onclick="deleteMarker({marker_arg})" style="margin-left: 5px; background-color: #dc3545; color: white; border: none; padding: 5px 10px; border-radius: 3px; cursor: pointer;">Delete Marker</button>
+        </div>
+    """
+    return popup_content_html
+
+
+def parse_bbox(bbox_param):
+    """Parse a 'west,south,east,north' query parameter into floats."""
+    parts = [float(v) for v in bbox_param.split(',')]
+    if len(parts) != 4:
+        raise ValueError("bbox must be west,south,east,north")
+    return parts
+
+
+def marker_payload(marker_id, marker_data):
+    """Marker fields the page needs to draw a marker and its popup."""
+    marker_color = marker_data.get('color', 'blue')
+    return {
+        'id': marker_id,
+        'lat': marker_data['lat'],
+        'lon': marker_data['lon'],
+        'name': marker_data['popup_text'],
+        'color': marker_color,
+        'marker_number': marker_data.get('marker_number'),
+        'tooltip_text': marker_data.get('tooltip_text'),
+        'icon_url': get_marker_icon_url(marker_color),
+        'icon_retina_url': get_marker_icon_url(marker_color, scale=2),
+        'popup_html': build_marker_popup_html(marker_id, marker_data, memory_index.content_type(marker_id))
+    }
+
+
+def markers_in_view(bbox, zoom=None):
+    """
+    Markers inside a bounding box. With a zoom level, a view holding more
+    than CLUSTER_MIN_MARKERS markers is sent as clusters instead; clusters of
+    a single marker are sent as that marker. Either way the drawn part of the
+    result is bounded by the size of the view, not by the number of markers.
+
+    visible_ids lists every marker inside the box, clustered or not: a marker
+    folded into a cluster is still on screen, so its LED stays lit.
+    """
+    clusters = []
+    if zoom is not None and zoom <= CLUSTER_MAX_ZOOM:
+        clusters = marker_clusters.query(*bbox, zoom)
+        if sum(cluster['count'] for cluster in clusters) <= CLUSTER_MIN_MARKERS:
+            clusters = []
+
+    if clusters:
+        marker_ids = [cluster['marker_id'] for cluster in clusters if cluster['count'] == 1]
+        clusters = [cluster for cluster in clusters if cluster['count'] > 1]
+        visible_ids = marker_index.query(*bbox)
+    else:
+        marker_ids = visible_ids = marker_index.query(*bbox)
+
+    markers = []
+    for marker_id in marker_ids:
+        marker_data = storage.get('markers', marker_id)
+        if marker_data:
+            markers.append(marker_payload(marker_id, marker_data))
+
+    return {
+        "bbox": bbox,
+        "zoom": zoom,
+        "count": len(markers),
+        "markers": markers,
+        "clusters": clusters,
+        "visible_ids": list(visible_ids)
+    }
+
+
+@app.route('/api/markers', methods=['GET'])
+def api_markers():
+    """
+    API endpoint that returns the markers (or, when crowded, marker clusters)
+    inside a bounding box.
+    Query: bbox=west,south,east,north&zoom=<map zoom>
+    """
+    try:
+        bbox_param = request.args.get('bbox')
+        try:
+            bbox = parse_bbox(bbox_param) if bbox_param else [-180.0, -90.0, 180.0, 90.0]
+            zoom = request.args.get('zoom', type=int)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": f"Invalid bbox: {e}"}), 400
+
+        return jsonify(dict(markers_in_view(bbox, zoom), status="success"))
+
+    except Exception as e:
+        print(f"Error querying markers: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route('/icons/<name>.png')
+def icon_route(name):
+    """
+    Serve a colored marker icon, e.g. /icons/ff0000.png or /icons/ff0000@2x.png.
+    Responses are immutable; the page references them with a content hash.
+    """
+    color, _, scale = name.partition('@')
+    try:
+        hex_color = normalize_color(color)
+        scale = int(scale[:-1]) if scale.endswith('x') else 1
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid icon color"}), 404
+    if scale not in ICON_SCALES:
+        return jsonify({"status": "error", "message": "Invalid icon scale"}), 404
+
+    try:
+        icon = get_marker_icon_png(hex_color, scale)
+    except Exception as e:
+        print(f"Error rendering marker icon {hex_color}: {e}")
+        return redirect(DEFAULT_ICON_URL if scale == 1 else DEFAULT_ICON_RETINA_URL)
+    if request.if_none_match.contains(icon['hash']):
+        response = Response(status=304)
+    else:
+        response = Response(icon['png'], mimetype='image/png')
+    response.set_etag(icon['hash'])
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+@app.route('/tiles/<layer>/<int:z>/<int:x>/<int:y>')
+def tile_route(layer, z, x, y):
+    """Serve a base map tile from the tile cache, fetching it upstream on a miss."""
+    from Tiles import TileUnavailable
+    try:
+        data, content_type = tile_cache.get(layer, z, x, y)
+    except (KeyError, ValueError):
+        return Response(status=404)
+    except TileUnavailable as e:
+        print(f"Tile {layer}/{z}/{x}/{y} unavailable: {e}")
+        # Failures are only remembered briefly, so don't let the browser keep the error
+        response = Response(status=504)
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    response = Response(data, mimetype=content_type)
+    response.headers['Cache-Control'] = 'public, max-age=604800'
+    return response
+
+
+@app.route('/api/geocode', methods=['GET'])
+def api_geocode():
+    """
+    Search places by name.
+    Query: q=<place>&limit=<results, default 5>
+    """
+    try:
+        query = request.args.get('q', '').strip()
+        limit = request.args.get('limit', 5, type=int)
+        if not query:
+            return jsonify({"status": "error", "message": "Missing q"}), 400
+        limit = max(1, min(limit, 20))
+
+        from Geocoding import GeocodeUnavailable
+        try:
+            results, source = geocoder.search(query, limit)
+        except GeocodeUnavailable as e:
+            print(f"Geocoding '{query}' failed: {e}")
+            return jsonify({"status": "error", "message": "Geocoder unavailable"}), 504
+
+        return jsonify({"status": "success", "query": query, "source": source, "results": results})
+
+    except Exception as e:
+        print(f"Error geocoding: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
 # New endpoint to receive visible markers data
 @app.route('/visible_markers', methods=['POST'])
 def visible_markers_route():
+    """
+    Receive a tab's visible markers.
+
+    The page sends deltas: {client_id, seq, added: [ids], removed: [ids]}, or
+    its whole viewport as {client_id, seq, visible_ids: [ids]} when (re)syncing.
+    An empty delta is a heartbeat. Answers 204 when nothing changed, and 409
+    when the delta doesn't follow the last seq (the page then resyncs).
+    Full {visible_markers: [records]} posts from older pages still work.
+    """
     try:
-        global current_visible_markers
         data = request.json
-        visible_markers = data.get('visible_markers', [])
-        current_visible_markers = visible_markers
+        # Tabs without an id (older pages) share one session per address
+        client_id = data.get('client_id') or request.remote_addr
+        primary = bool(data.get('primary'))
+        seq = data.get('seq')
+
+        if 'visible_markers' in data:
+            visible_markers = data['visible_markers']
+            marker_names = [marker['name'] for marker in visible_markers]
+            if viewports.update(client_id, [marker['id'] for marker in visible_markers], primary=primary):
+                publish_visible_markers()
+            return jsonify({
+                "status": "success",
+                "visible_count": len(visible_markers),
+                "marker_names": marker_names,
+                "sessions": len(viewports)
+            })
 
-        # Log visible markers (you can process this data as needed)
-        marker_names = [marker['name'] for marker in visible_markers]
-
-        return jsonify({
-            "status": "success",
-            "visible_count": len(current_visible_markers),
-            "marker_names": marker_names
-        })
+        try:
+            if 'visible_ids' in data:
+                changed = viewports.update(client_id, data['visible_ids'], primary=primary, seq=seq)
+            elif data.get('added') or data.get('removed'):
+                changed = viewports.apply(client_id, data.get('added', ()), data.get('removed', ()),
+                                          primary=primary, seq=seq)
+            else:
+                viewports.touch(client_id, seq)
+                return '', 204
+        except ViewportOutOfSync as e:
+            return jsonify({"status": "error", "message": "resync", "seq": e.last_seq}), 409
+
+        if not changed:
+            return '', 204
+        publish_visible_markers()
+        return jsonify({"status": "success", "seq": seq})
 
     except Exception as e:
         print(f"Error processing visible markers: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
-# API endpoint to get visible markers programmatically
-# Make sure you have the global variable declared at the top of your file
-current_visible_markers = []
+@app.route('/visible_markers/close', methods=['POST'])
+def close_viewport_route():
+    """Forget a tab's viewport right away (sent by the page on unload)."""
+    try:
+        data = request.get_json(force=True, silent=True) or {}
+        client_id = data.get('client_id') or request.remote_addr
+        if viewports.remove(client_id):
+            publish_visible_markers()
+        return jsonify({"status": "success", "sessions": len(viewports)})
+    except Exception as e:
+        print(f"Error closing viewport: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+def publish_visible_markers():
+    """Send the aggregated visible marker numbers to the Arduino bridge."""
+    numbers = []
+    for marker_id in viewports.visible():
+        marker_number = marker_numbers.number_of(marker_id)
+        if marker_number is not None:
+            numbers.append(marker_number)
+    arduino_events.publish('visible_markers', sorted(numbers))
+
+
+def expire_viewports():
+    """Drop viewports of tabs that stopped reporting, so their LEDs go dark."""
+    while True:
+        time.sleep(VIEWPORT_TTL / 3)
+        try:
+            if viewports.expire():
+                publish_visible_markers()
+        except Exception as e:
+            print(f"Error expiring viewports: {e}")
+
+
+def get_visible_marker_numbers(visible_markers):
+    """Map visible marker records to their LED numbers via the marker number index."""
+    numbers = []
+    for marker in visible_markers:
+        marker_number = marker_numbers.number_of(marker.get('id'))
+        if marker_number is not None:
+            numbers.append(marker_number)
+    return numbers
 
 
 @app.route('/api/visible_markers', methods=['GET'])  # Changed to GET since you're retrieving
 def api_visible_markers():
     """
-    API endpoint that returns currently stored visible markers.
+    API endpoint that returns the visible markers aggregated over all open tabs.
+    Query: mode=union|intersection|primary (defaults to VIEWPORT_AGGREGATION)
     """
     try:
-        global current_visible_markers
-
-        # Use the stored markers instead of reading from request
-        visible_markers = current_visible_markers
+        mode = request.args.get('mode', VIEWPORT_AGGREGATION)
+        try:
+            visible_ids = viewports.visible(mode)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+
+        visible_markers = []
+        for marker_id in visible_ids:
+            marker_data = storage.get('markers', marker_id)
+            if marker_data:
+                visible_markers.append({
+                    'id': marker_id,
+                    'name': marker_data['popup_text'],
+                    'lat': marker_data['lat'],
+                    'lon': marker_data['lon']
+                })
         marker_names = [marker['name'] for marker in visible_markers]
 
         return jsonify({
             "status": "success",
+            "mode": mode,
+            "sessions": len(viewports),
             "visible_markers": visible_markers,
             "count": len(visible_markers),
-            "marker_names": marker_names  # Added this for consistency
+            "marker_names": marker_names,  # Added this for consistency
+            "marker_numbers": get_visible_marker_numbers(visible_markers)
         })
 
     except Exception as e:
@@ -410,27 +963,31 @@ def api_visible_markers():
 def api_memory_trigger():
     """
     API endpoint that returns memory view trigger data for Arduino.
-    Returns the 50-byte array when a memory view has been triggered.
+    Returns the triggers (50-byte arrays) the consumer hasn't seen yet; each
+    consumer has its own cursor, or passes the last seq it saw as ?since=.
     """
     try:
-        global memory_view_trigger
-
-        if memory_view_trigger is not None:
-            # Get the trigger data and clear it (one-time use)
-            trigger_data = memory_view_trigger.copy()
-            memory_view_trigger = None  # Clear after reading
+        consumer = request.args.get('consumer', 'default')
+        since = request.args.get('since', type=int)
+        triggers = memory_triggers.read(consumer, since)
 
+        if triggers:
+            # Latest trigger in the single-trigger fields for older consumers
+            seq, trigger_data = triggers[-1]
             return jsonify({
                 "status": "success",
                 "has_trigger": True,
+                "seq": seq,  # a full batch leaves the rest for the next poll
                 "trigger_data": trigger_data,
-                "marker_number": trigger_data[1],
-                "color_rgb": [trigger_data[2], trigger_data[3], trigger_data[4]]
+                "marker_number": trigger_data[4],
+                "color_rgb": trigger_data[5:8],
+                "triggers": [{"seq": seq, "trigger_data": data} for seq, data in triggers]
             })
         else:
             return jsonify({
                 "status": "success",
                 "has_trigger": False,
+                "seq": memory_triggers.seq,
                 "trigger_data": None
             })
 
@@ -451,30 +1008,49 @@ def add_marker_route():
         print(f"Received marker request: lat={lat}, lon={lon}, text='{popup_text}', color='{color}'")
 
         # Validate coordinates
-        if not isinstance(lat, (int, float)) or not isinstance(lon, (int, float)):
-            return jsonify({"status": "error", "message": "Invalid coordinates"}), 400
+        error = validate_coordinates(lat, lon)
+        if error:
+            return jsonify({"status": "error", "message": error}), 400
 
-        if not (-90 <= lat <= 90) or not (-180 <= lon <= 180):
-            return jsonify({"status": "error", "message": "Coordinates out of range"}), 400
+        try:
+            marker_number = requested_marker_number(data, popup_text)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
 
-        # Generate unique ID and store
+        # Generate unique ID, then reserve its marker number and store the
+        # marker under one write lock; a failed write releases the number
         marker_id = str(uuid.uuid4())
-        server_storage['markers'][marker_id] = {
-            'lat': lat,
-            'lon': lon,
-            'popup_text': popup_text,
-            'tooltip_text': None,
-            'color': color  # Store the color
-        }
+        with storage.transaction():
+            try:
+                marker_numbers.assign(marker_id, marker_number)
+            except DuplicateMarkerNumber as e:
+                return jsonify({"status": "error", "message": str(e)}), 409
+
+            try:
+                storage.put('markers', marker_id, {
+                    'lat': lat,
+                    'lon': lon,
+                    'popup_text': popup_text,
+                    'tooltip_text': None,
+                    'color': color,  # Store the color
+                    'marker_number': marker_number
+                })
+            except Exception:
+                marker_numbers.remove(marker_id)
+                raise
+
+        marker_index.insert(marker_id, lat, lon)
+        marker_clusters.insert(marker_id, lat, lon)
+        update_marker_color(marker_id, storage.get('markers', marker_id))
 
         print(f"Added marker: {popup_text} at ({lat:.4f}, {lon:.4f}) with color {color} and ID {marker_id}")
-        print(f"Total markers in storage: {len(server_storage['markers'])}")
-        save_storage()
+        print(f"Total markers in storage: {storage.count('markers')}")
 
         return jsonify({
             "status": "success",
             "message": "Marker added successfully",
-            "marker_id": marker_id
+            "marker_id": marker_id,
+            "marker_number": marker_number
         })
 
     except Exception as e:
@@ -484,50 +1060,136 @@ def add_marker_route():
 
 @app.route('/add_memory', methods=['POST'])
 def add_memory_route():
+    """
+    Add or replace a marker's memory: JSON {marker_id, memory_text}, or a
+    multipart form with marker_id and a file (photo, audio, ...).
+    """
     try:
-        data = request.json
-        marker_id = data.get('marker_id')
-        memory_text = data.get('memory_text')
-
-        if not marker_id or not memory_text:
-            return jsonify({"status": "error", "message": "Missing marker_id or memory_text"}), 400
-
-        if marker_id in server_storage['markers']:
-            server_storage['memories'][marker_id] = memory_text
-            # Keep the original color when adding memory
-            print(f"Added memory for marker {marker_id}: {memory_text}")
-            save_storage()
-            return jsonify({"status": "success", "message": "Memory added successfully"})
+        upload = request.files.get('file')
+        if upload is not None:
+            marker_id = request.form.get('marker_id')
+            if not marker_id:
+                return jsonify({"status": "error", "message": "Missing marker_id"}), 400
+            # Streamed to a temp file, never held in memory as a whole
+            staged = memory_blobs.stage_stream(upload.stream)
+            content_type = upload.mimetype or 'application/octet-stream'
+            filename = upload.filename
+            description = f"file {filename} ({staged.size} bytes)"
         else:
-            return jsonify({"status": "error", "message": "Marker not found"}), 404
+            data = request.json
+            marker_id = data.get('marker_id')
+            memory_text = data.get('memory_text')
+
+            if not marker_id or not memory_text:
+                return jsonify({"status": "error", "message": "Missing marker_id or memory_text"}), 400
+            staged = memory_blobs.stage(memory_text.encode('utf-8'))
+            content_type = TEXT_CONTENT_TYPE
+            filename = None
+            description = memory_text
+
+        # Hold the write lock so the marker can't be deleted in between
+        with storage.transaction():
+            if storage.contains('markers', marker_id):
+                set_memory(marker_id, staged, content_type, filename)
+                # Keep the original color when adding memory
+                print(f"Added memory for marker {marker_id}: {description}")
+                return jsonify({"status": "success", "message": "Memory added successfully"})
+            else:
+                memory_blobs.discard(staged)
+                return jsonify({"status": "error", "message": "Marker not found"}), 404
 
     except Exception as e:
         print(f"Error adding memory: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
-@app.route('/get_memory/<marker_id>')
-def get_memory_route(marker_id):
+def trigger_memory_view(marker_id):
+    """
+    Light the marker's LED for a memory view. This is a side effect of
+    serving the memory, so errors are logged and never reach the response.
+    """
     try:
-        global memory_view_trigger
+        marker_data = storage.get('markers', marker_id)
+        if marker_data:
+            marker_color = marker_data.get('color', '#' + DEFAULT_LED_COLOR)
+
+            # Create and store the memory view trigger array
+            marker_number = get_marker_number_from_id(marker_id)
+            memory_trigger = create_memory_view_array(marker_id, marker_color, marker_number)
+            memory_triggers.push(marker_id, memory_trigger)
+            arduino_events.publish('memory_trigger', list(memory_trigger))
+
+            print(f"Memory view triggered for marker {marker_number} (ID: {marker_id}) with color {marker_color}")
+            print(f"Trigger array: {memory_trigger[:10]}...")  # Print first 10 bytes for debug
+    except Exception as e:
+        print(f"Error triggering memory view for marker {marker_id}: {e}")
 
-        memory = server_storage['memories'].get(marker_id)
-        if memory:
-            # Get marker data to extract color
-            marker_data = server_storage['markers'].get(marker_id)
-            if marker_data:
-                marker_color = marker_data.get('color', '#0000ff')  # Default to blue
 
-                # Create and store the memory view trigger array
-                memory_view_trigger = create_memory_view_array(marker_id, marker_color)
+def content_disposition(filename):
+    """
+    Build an inline Content-Disposition header for a stored filename: a plain
+    ASCII filename= fallback plus the exact name as RFC 5987 filename*=.
+    """
+    fallback = ''.join(c if c.isascii() and c.isprintable() and c not in '"\\;' else '_' for c in filename)
+    return f"inline; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
 
-                marker_number = get_marker_number_from_id(marker_id)
-                print(f"Memory view triggered for marker {marker_number} (ID: {marker_id}) with color {marker_color}")
-                print(f"Trigger array: {memory_view_trigger[:10]}...")  # Print first 10 bytes for debug
 
-            return jsonify({"status": "success", "memory": memory})
-        else:
+@app.route('/get_memory/<marker_id>')
+def get_memory_route(marker_id):
+    """
+    Stream a marker's memory with Range support (for audio/video seeking and
+    resumed downloads), read through a memory-mapped view of its blob.
+    ?format=json returns {"status", "memory"} for text memories instead.
+
+    The LED is lit once per view: by the request that returns the content,
+    i.e. the JSON of a text memory or the first byte range of a file. The
+    JSON of a file memory is only a description and has no side effects.
+    """
+    try:
+        memory = storage.get('memories', marker_id)
+        if not memory:
             return jsonify({"status": "error", "message": "No memory found"}), 404
+
+        blob_hash, size, content_type = memory['blob'], memory['size'], memory['content_type']
+
+        if request.args.get('format') == 'json':
+            text = None
+            if content_type.startswith('text/'):
+                text = memory_blobs.read(blob_hash).decode('utf-8')
+                trigger_memory_view(marker_id)
+            return jsonify({"status": "success", "memory": text, "content_type": content_type,
+                            "size": size, "url": f"/get_memory/{marker_id}"})
+
+        # Players fetch media in ranges; only light the LED for the first one
+        if request.range is None or request.range.ranges[0][0] == 0:
+            trigger_memory_view(marker_id)
+
+        if blob_hash in request.if_none_match:
+            response = Response(status=304)
+            response.set_etag(blob_hash)
+            return response
+
+        start, stop, status = 0, size, 200
+        if request.range is not None:
+            byte_range = request.range.range_for_length(size)
+            if byte_range is None:
+                response = Response(status=416)
+                response.headers['Content-Range'] = f"bytes */{size}"
+                return response
+            start, stop = byte_range
+            status = 206
+
+        response = Response(memory_blobs.iter_range(blob_hash, start, stop), status=status,
+                            content_type=content_type, direct_passthrough=True)
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.headers['Content-Length'] = str(stop - start)
+        if status == 206:
+            response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+        if memory.get('filename'):
+            response.headers['Content-Disposition'] = content_disposition(memory['filename'])
+        response.set_etag(blob_hash)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     except Exception as e:
         print(f"Error getting memory: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -536,7 +1198,7 @@ def get_memory_route(marker_id):
 @app.route('/get_marker/<marker_id>')
 def get_marker_route(marker_id):
     try:
-        marker = server_storage['markers'].get(marker_id)
+        marker = storage.get('markers', marker_id)
         if marker:
             return jsonify({"status": "success", "marker": marker})
         else:
@@ -557,19 +1219,33 @@ def edit_marker_route():
         if not marker_id or not popup_text:
             return jsonify({"status": "error", "message": "Missing marker_id or popup_text"}), 400
 
-        if marker_id in server_storage['markers']:
-            server_storage['markers'][marker_id]['popup_text'] = popup_text
-
-            # Update color if provided
-            if color:
-                server_storage['markers'][marker_id]['color'] = color
-                print(f"Updated marker {marker_id} color to: {color}")
-
-            print(f"Edited marker {marker_id}: new text '{popup_text}'")
-            save_storage()
-            return jsonify({"status": "success", "message": "Marker updated successfully"})
-        else:
-            return jsonify({"status": "error", "message": "Marker not found"}), 404
+        # Read-modify-write under the write lock so concurrent edits/deletes don't interleave
+        with storage.transaction():
+            marker_data = storage.get('markers', marker_id)
+            if marker_data:
+                try:
+                    marker_number = requested_marker_number(data, popup_text)
+                    marker_numbers.assign(marker_id, marker_number)
+                except DuplicateMarkerNumber as e:
+                    return jsonify({"status": "error", "message": str(e)}), 409
+                except ValueError as e:
+                    return jsonify({"status": "error", "message": str(e)}), 400
+
+                marker_data = dict(marker_data, popup_text=popup_text, marker_number=marker_number)
+
+                # Update color if provided
+                if color:
+                    marker_data['color'] = color
+                    print(f"Updated marker {marker_id} color to: {color}")
+
+                storage.put('markers', marker_id, marker_data)
+                update_marker_color(marker_id, marker_data)
+                # Its LED number may have changed
+                publish_visible_markers()
+                print(f"Edited marker {marker_id}: new text '{popup_text}'")
+                return jsonify({"status": "success", "message": "Marker updated successfully"})
+            else:
+                return jsonify({"status": "error", "message": "Marker not found"}), 404
 
     except Exception as e:
         print(f"Error editing marker: {e}")
@@ -585,38 +1261,526 @@ def delete_marker_route():
         if not marker_id:
             return jsonify({"status": "error", "message": "Missing marker_id"}), 400
 
-        if marker_id in server_storage['markers']:
-            marker_data = server_storage['markers'][marker_id]
-            del server_storage['markers'][marker_id]
-            # Also remove any associated memory
-            if marker_id in server_storage['memories']:
-                del server_storage['memories'][marker_id]
-            print(f"Deleted marker: {marker_id} ({marker_data.get('popup_text', 'Unknown')})")
-            save_storage()
-            return jsonify({"status": "success", "message": "Marker deleted successfully"})
-        else:
-            return jsonify({"status": "error", "message": "Marker not found"}), 404
+        with storage.transaction():
+            marker_data = storage.get('markers', marker_id)
+            if marker_data:
+                storage.delete('markers', marker_id)
+                marker_index.remove(marker_id)
+                marker_clusters.remove(marker_id, marker_data['lat'], marker_data['lon'])
+                marker_color_table.remove(marker_id)
+                marker_numbers.remove(marker_id)
+                # Also remove any associated memory
+                drop_memory(marker_id)
+                publish_visible_markers()
+                print(f"Deleted marker: {marker_id} ({marker_data.get('popup_text', 'Unknown')})")
+                return jsonify({"status": "success", "message": "Marker deleted successfully"})
+            else:
+                return jsonify({"status": "error", "message": "Marker not found"}), 404
 
     except Exception as e:
         print(f"Error deleting marker: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
-def run_flask_app():
+def path_payload(path_id, record, zoom=None, bbox=None):
+    """Path fields the page needs, with the polylines simplified for a zoom level and clipped to bbox."""
+    polylines, shown_points = path_store.polylines(record, zoom, bbox)
+    return {
+        'id': path_id,
+        'name': record['name'],
+        'color': record['color'],
+        'weight': record['weight'],
+        'points': record['points'],
+        'bbox': record['bbox'],
+        'zoom': zoom,
+        'shown_points': shown_points,
+        'polylines': polylines
+    }
+
+
+def path_request_data():
+    """
+    Fields and points of a path request: JSON {name, color, weight,
+    coordinates: [[lat, lon], ...]}, or raw little-endian float64 lat/lon
+    pairs (application/octet-stream) with the fields in the query string.
+    """
+    if request.mimetype == 'application/octet-stream':
+        data = request.args.to_dict()
+        body = request.get_data()
+        if len(body) % 16:
+            raise ValueError("Body must hold float64 lat/lon pairs")
+        import numpy as np
+        coords = np.frombuffer(body, dtype='<f8').reshape(-1, 2) if body else None
+        if 'weight' in data:
+            data['weight'] = int(data['weight'])
+    else:
+        data = request.json or {}
+        coords = data.get('coordinates')
+    fields = {key: data.get(key) for key in ('name', 'color', 'weight')}
+    if fields['weight'] is not None and (isinstance(fields['weight'], bool) or
+                                         not isinstance(fields['weight'], numbers.Number) or fields['weight'] <= 0):
+        raise ValueError("weight must be a positive number")
+    return fields, coords
+
+
+@app.route('/api/paths', methods=['GET'])
+def api_paths():
+    """
+    Paths overlapping a bounding box, simplified for the map zoom and
+    clipped to the box.
+    Query: bbox=west,south,east,north&zoom=<map zoom> (no zoom: every point)
+    """
+    try:
+        bbox_param = request.args.get('bbox')
+        try:
+            bbox = parse_bbox(bbox_param) if bbox_param else [-180.0, -90.0, 180.0, 90.0]
+            zoom = request.args.get('zoom', type=int)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": f"Invalid bbox: {e}"}), 400
+
+        found = [path_payload(path_id, record, zoom, bbox) for path_id, record in path_store.query(*bbox)]
+        return jsonify({"status": "success", "bbox": bbox, "zoom": zoom, "count": len(found), "paths": found})
+
+    except Exception as e:
+        print(f"Error querying paths: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route('/api/paths', methods=['POST'])
+def add_path_route():
+    try:
+        try:
+            fields, coords = path_request_data()
+            if coords is None:
+                raise ValueError("Missing coordinates")
+            path_id, record = path_store.create(
+                coords, name=fields['name'] or 'Path', color=fields['color'] or 'blue', weight=fields['weight'] or 3)
+        except (ValueError, TypeError) as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+
+        print(f"Added path {record['name']} with {record['points']} points and ID {path_id}")
+        return jsonify({"status": "success", "message": "Path added successfully", "path_id": path_id,
+                        "points": record['points']})
+
+    except Exception as e:
+        print(f"Error adding path: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route('/api/paths/<path_id>', methods=['GET'])
+def get_path_route(path_id):
+    try:
+        record = storage.get('paths', path_id)
+        if record is None:
+            return jsonify({"status": "error", "message": "Path not found"}), 404
+        return jsonify(dict(path_payload(path_id, record, request.args.get('zoom', type=int)), status="success"))
+    except Exception as e:
+        print(f"Error getting path: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route('/api/paths/<path_id>', methods=['POST', 'PUT'])
+def edit_path_route(path_id):
+    """Change a path's name, color or weight; new coordinates replace its points."""
+    try:
+        try:
+            fields, coords = path_request_data()
+            record = path_store.update(path_id, coords, **fields)
+        except (ValueError, TypeError) as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        if record is None:
+            return jsonify({"status": "error", "message": "Path not found"}), 404
+
+        print(f"Edited path {path_id}: {record['name']}, {record['points']} points")
+        return jsonify({"status": "success", "message": "Path updated successfully", "points": record['points']})
+
+    except Exception as e:
+        print(f"Error editing path: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route('/api/paths/<path_id>', methods=['DELETE'])
+def delete_path_route(path_id):
+    try:
+        if not path_store.delete(path_id):
+            return jsonify({"status": "error", "message": "Path not found"}), 404
+        print(f"Deleted path {path_id}")
+        return jsonify({"status": "success", "message": "Path deleted successfully"})
+    except Exception as e:
+        print(f"Error deleting path: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+# Bulk import/export: one JSON object per line, the same fields as /add_marker
+# plus an optional id and memory_text
+NDJSON_MIMETYPE = 'application/x-ndjson'
+IMPORT_MAX_ERRORS = 100  # errors reported back per import
+# Imported ids end up in URLs (/get_memory/<id>) and in the popup's handlers
+MARKER_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+EXPORT_CHUNK_SIZE = 64 * 1024  # bytes buffered per chunk of the export stream
+
+
+def iter_lines(stream, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield the lines of a request body, reading it in chunks (iterating the raw stream reads byte by byte)."""
+    pending = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
+
+
+def parse_import_row(row, seen_numbers):
+    """
+    Validate one import row like add_marker does.
+
+    Args:
+        row: Decoded JSON line
+        seen_numbers (dict): Marker number -> id of earlier rows of the same import
+
+    Returns:
+        tuple: (marker_id, marker_data, memory_text)
+
+    Raises:
+        ValueError: The row is invalid
+    """
+    if not isinstance(row, dict):
+        raise ValueError("Expected a JSON object")
+    lat = row.get('lat')
+    lon = row.get('lon')
+    error = validate_coordinates(lat, lon)
+    if error:
+        raise ValueError(error)
+
+    popup_text = row.get('popup_text', 'Marker')
+    marker_number = requested_marker_number(row, popup_text)
+    marker_id = row.get('id') or str(uuid.uuid4())
+    if not isinstance(marker_id, str) or not MARKER_ID_PATTERN.fullmatch(marker_id):
+        raise ValueError("id must be 1-64 letters, digits, '_' or '-'")
+
+    memory_text = row.get('memory_text')
+    if memory_text is not None and not isinstance(memory_text, str):
+        raise ValueError("memory_text must be a string")
+
+    # Only claim the number once the row is known to be valid
+    if marker_number is not None:
+        owner = seen_numbers.get(marker_number)
+        if owner is not None and owner != marker_id:
+            raise ValueError(f"Marker number {marker_number} is used twice in this import")
+        seen_numbers[marker_number] = marker_id
+
+    return marker_id, {
+        'lat': lat,
+        'lon': lon,
+        'popup_text': popup_text,
+        'tooltip_text': row.get('tooltip_text'),
+        'color': row.get('color', 'blue'),
+        'marker_number': marker_number
+    }, memory_text
+
+
+def check_import_numbers(rows):
+    """
+    Split parsed import rows into the ones whose marker numbers can be
+    assigned and the ones that would take a number from a marker that stays.
+    Must be called with the storage write lock held.
+
+    A number is free when nobody has it or its owner is replaced by this
+    import. Rejecting a row keeps that marker (and its number), which can in
+    turn make other rows invalid, so this repeats until nothing changes.
+    Every assignment of the accepted rows is then known to succeed before
+    anything is written.
+
+    Args:
+        rows (list): (marker_id, marker_data, memory_text) tuples
+
+    Returns:
+        tuple: (accepted rows, [{"id": ..., "message": ...}] for the rejected rows)
+    """
+    accepted = list(rows)
+    errors = []
+    while True:
+        batch_ids = {marker_id for marker_id, _, _ in accepted}
+        claimed = {}
+        kept = []
+        for row in accepted:
+            marker_id, marker_data, _ = row
+            marker_number = marker_data['marker_number']
+            if marker_number is not None:
+                owner = marker_numbers.id_of(marker_number)
+                if owner is not None and owner not in batch_ids:
+                    errors.append({"id": marker_id, "message": f"Marker number {marker_number} is already used"})
+                    continue
+                if claimed.setdefault(marker_number, marker_id) != marker_id:
+                    errors.append({"id": marker_id,
+                                   "message": f"Marker number {marker_number} is used twice in this import"})
+                    continue
+            kept.append(row)
+        if len(kept) == len(accepted):
+            return accepted, errors
+        accepted = kept
+
+
+@app.route('/api/markers/import', methods=['POST'])
+def import_markers_route():
+    """
+    Import markers from an NDJSON body, read line by line. Rows with an id
+    that already exists replace that marker.
+
+    All rows are validated first and then written in one batch. By default
+    any invalid row rejects the whole import; with ?skip_invalid=1 the valid
+    rows are imported and the invalid ones reported.
+    """
+    try:
+        skip_invalid = request.args.get('skip_invalid') in ('1', 'true')
+        rows = []
+        errors = []
+        seen_numbers = {}
+        for line_number, line in enumerate(iter_lines(request.stream), start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rows.append(parse_import_row(json.loads(line), seen_numbers))
+            except ValueError as e:  # includes JSONDecodeError
+                errors.append({"line": line_number, "message": str(e)})
+
+        if errors and not skip_invalid:
+            return jsonify({"status": "error", "message": f"{len(errors)} invalid rows, nothing imported",
+                            "errors": errors[:IMPORT_MAX_ERRORS]}), 400
+
+        # Stage memory bodies before taking the write lock
+        staged = {marker_id: memory_blobs.stage(memory_text.encode('utf-8'))
+                  for marker_id, _, memory_text in rows if memory_text}
+
+        with storage.transaction():
+            accepted, number_errors = check_import_numbers(rows)
+            errors.extend(number_errors)
+            accepted = [(marker_id, marker_data) for marker_id, marker_data, _ in accepted]
+
+            if errors and not skip_invalid:
+                for blob in staged.values():
+                    memory_blobs.discard(blob)
+                return jsonify({"status": "error", "message": f"{len(errors)} invalid rows, nothing imported",
+                                "errors": errors[:IMPORT_MAX_ERRORS]}), 409
+
+            # Release the numbers of replaced markers first so rows can swap numbers
+            for marker_id, _ in accepted:
+                marker_numbers.remove(marker_id)
+            for marker_id, marker_data in accepted:
+                marker_numbers.assign(marker_id, marker_data['marker_number'])
+            # The cluster index needs the old positions of the markers being replaced
+            final = dict(accepted)  # the last row of an id wins, as in put_many
+            replaced = [(marker_id, previous) for marker_id, previous in
+                        ((marker_id, storage.get('markers', marker_id)) for marker_id in final) if previous]
+            storage.put_many('markers', accepted)
+
+            memories = []
+            for marker_id, _ in accepted:
+                blob = staged.pop(marker_id, None)
+                if blob is not None:
+                    blob_hash, size = memory_blobs.commit(blob)
+                    memories.append((marker_id, memory_record(blob_hash, size, TEXT_CONTENT_TYPE)))
+            storage.put_many('memories', memories)
+            for marker_id, record in memories:
+                unreferenced = memory_index.set(marker_id, record['size'], record['blob'], record['content_type'])
+                if unreferenced:
+                    memory_blobs.delete(unreferenced)
+            for blob in staged.values():  # rows that were skipped
+                memory_blobs.discard(blob)
+
+        for marker_id, previous in replaced:
+            marker_clusters.remove(marker_id, previous['lat'], previous['lon'])
+        for marker_id, marker_data in final.items():
+            marker_index.insert(marker_id, marker_data['lat'], marker_data['lon'])
+            marker_clusters.insert(marker_id, marker_data['lat'], marker_data['lon'])
+            update_marker_color(marker_id, marker_data)
+        publish_visible_markers()
+
+        print(f"Imported {len(accepted)} markers ({len(memories)} memories), {len(errors)} rows skipped")
+        return jsonify({
+            "status": "success",
+            "imported": len(accepted),
+            "memories": len(memories),
+            "errors": errors[:IMPORT_MAX_ERRORS]
+        })
+
+    except Exception as e:
+        print(f"Error importing markers: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+def export_rows():
+    """
+    Yield the store as NDJSON in chunks of about EXPORT_CHUNK_SIZE bytes.
+    Text memories are inlined as memory_text (so the export can be imported
+    again); file memories are referenced by URL.
+    """
+    buffer = []
+    buffered = 0
+    for marker_id, marker in storage.iter_items('markers'):
+        row = dict(marker, id=marker_id)
+        if memory_index.has_memory(marker_id):
+            record = storage.get('memories', marker_id)
+            if record and record['content_type'] == TEXT_CONTENT_TYPE:
+                row['memory_text'] = memory_blobs.read(record['blob']).decode('utf-8')
+            elif record:
+                row['memory'] = {'content_type': record['content_type'], 'size': record['size'],
+                                 'filename': record.get('filename'), 'url': f"/get_memory/{marker_id}"}
+        line = json.dumps(row, separators=(',', ':')) + '\n'
+        buffer.append(line)
+        buffered += len(line)
+        if buffered >= EXPORT_CHUNK_SIZE:
+            yield ''.join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+@app.route('/api/markers/export', methods=['GET'])
+def export_markers_route():
+    """Stream all markers and their memories as NDJSON."""
+    return Response(export_rows(), mimetype=NDJSON_MIMETYPE,
+                    headers={'Content-Disposition': 'attachment; filename="markers.ndjson"'})
+
+
+def get_storage_stats():
+    return {'markers': storage.count('markers'), 'paths': storage.count('paths'), 'memories': len(memory_index)}
+
+
+# The components' own stats, read when /metrics is scraped (the data-backed
+# ones are added by load_data())
+metrics.add_stats('map_viewports', viewports.get_stats, "Browser viewports", gauges=('sessions', 'visible_union'))
+metrics.add_stats('map_memory_triggers', memory_triggers.get_stats, "Memory trigger queue",
+                  gauges=('pending', 'seq', 'consumers'))
+metrics.add_stats('map_arduino_events', arduino_events.get_stats, "Arduino event channel", gauges=('pending',))
+metrics.add_stats('map_icon_cache', icon_cache.get_stats, "Marker icon cache",
+                  gauges=('memory_entries', 'disk_entries'))
+
+
+@app.route('/metrics')
+def metrics_route():
+    """Request, Arduino bridge, queue and cache metrics in the Prometheus text format."""
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+
+def load_data():
+    """
+    Open the storage and build the in-memory indexes, the path store, the
+    tile cache and the geocoder, then let waiting requests through. The
+    server runs this in the background after binding; other importers of
+    this module call it before using the data.
+    """
+    global storage, marker_index, path_store, tile_cache, geocoder
+
+    with startup_phase('open storage'):
+        storage = open_storage(STORAGE_BACKEND, STORAGE_FILE, STORAGE_DB_FILE)
+
+    with startup_phase('marker indexes'):
+        if hasattr(storage, 'query_bbox'):
+            marker_index = StorageIndex(storage)
+        else:
+            marker_index = GridIndex(cell_size=1.0)
+            marker_index.rebuild(storage.iter_fields('markers', ('lat', 'lon')))
+        marker_clusters.rebuild(storage.iter_fields('markers', ('lat', 'lon')))
+        load_marker_numbers()
+        marker_color_table.rebuild((mid, marker_number, led_color(color)) for mid, marker_number, color
+                                   in storage.iter_fields('markers', ('marker_number', 'color')))
+
+    with startup_phase('memory index'):
+        load_memory_index()
+
+    with startup_phase('paths'):
+        from Paths import PathStore
+        path_store = PathStore(storage, BlobStore(PATH_BLOB_DIR))
+        path_store.migrate_legacy()
+
+    with startup_phase('tile cache and geocoder'):
+        from Tiles import TileCache, upstream_from_env
+        from Geocoding import Geocoder, Gazetteer, geocode_upstream_from_env
+        tile_cache = TileCache(TILE_CACHE_DIR, upstream_from_env(), max_bytes=TILE_CACHE_MAX_BYTES)
+        geocoder = Geocoder(geocode_upstream_from_env(), GEOCODE_CACHE_DIR,
+                            gazetteer=Gazetteer.from_file(GAZETTEER_FILE) if os.path.exists(GAZETTEER_FILE) else None)
+
+    metrics.add_stats('map_storage', get_storage_stats, "Stored items", gauges=('markers', 'paths', 'memories'))
+    metrics.add_stats('map_tile_cache', tile_cache.get_stats, "Tile proxy", gauges=('cached_tiles', 'cached_bytes'))
+    metrics.add_stats('map_geocoder', geocoder.get_stats, "Geocoder", gauges=('gazetteer_places',))
+    data_ready.set()
+
+
+def warm_up():
+    """Render the page (importing folium) and the palette icons before the first visitor asks."""
+    with startup_phase('first page render'):
+        try:
+            get_cached_page()
+        except Exception as e:
+            print(f"Error pre-rendering the page: {e}")
+    with startup_phase('icon prewarm'):
+        prewarm_icons()
+
+
+def print_startup_profile():
+    print("Startup profile:")
+    for name, seconds in startup_phases:
+        print(f"  {name:<26} {seconds * 1000:9.1f} ms")
+    print(f"  {'total since import':<26} {(time.perf_counter() - STARTUP_STARTED) * 1000:9.1f} ms")
+
+
+def run_flask_app(production=False, host='0.0.0.0', port=5000, threads=8):
+    if production:
+        serve_production(app, host=host, port=port, threads=threads)
+        return
     # Disable reloader if running Flask in a separate thread
     # as it can interfere with the main thread's execution.
-    app.run(debug=True, port=5000, host='0.0.0.0', use_reloader=False)
+    app.run(debug=True, port=port, host=host, use_reloader=False)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Interactive world map with Arduino LED output")
+    parser.add_argument('--production', action='store_true',
+                        help="serve with a worker thread pool, without the debugger")
+    parser.add_argument('--threads', type=int, default=8, help="worker threads in production mode")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--no-arduino', action='store_true', help="don't start the Arduino bridge")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="print how long each import and loading phase took once the app is warm")
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
-    # Start the Flask app in a separate thread
+    args = parse_args()
+    threading.Thread(target=expire_viewports, daemon=True).start()
+
+    # Start the Flask app in a separate thread. It binds right away; requests
+    # that need the data wait until load_data() is done
     print("Starting Flask server...")
-    flask_thread = threading.Thread(target=run_flask_app)
+    flask_thread = threading.Thread(target=run_flask_app,
+                                    args=(args.production, args.host, args.port, args.threads))
     flask_thread.start()
-    time.sleep(1)
-    # After starting the Flask app, initiate the background task thread
-    arduino_thread = threading.Thread(target=com_with_arduino)
-    arduino_thread.start()
+
+    try:
+        load_data()
+    except Exception as e:
+        print(f"Error loading the map data: {e}")
+        os._exit(1)
+    print(f"Loaded {storage.count('markers')} markers")
+    warm_up_thread = threading.Thread(target=warm_up, daemon=True)
+    warm_up_thread.start()
+
+    # Once the data is loaded, initiate the background task thread
+    if not args.no_arduino:
+        arduino_thread = threading.Thread(target=com_with_arduino)
+        arduino_thread.start()
+
+    if args.profile_startup:
+        warm_up_thread.join()
+        print_startup_profile()
 
     # You can add more code here to run in the main thread
-    print("Main thread continues after launching Flask and background task.")
\ No newline at end of file
+    print("Main thread continues after launching Flask and background task.")
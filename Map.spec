@@ -5,7 +5,7 @@ a = Analysis(
     ['Map.py'],
     pathex=['App'],
     binaries=[],
-    datas=[],
+    datas=[('static', 'static')],
     hiddenimports=[],
     hookspath=[],
     hooksconfig={},
@@ -0,0 +1,209 @@
+import math
+import bisect
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds: request latencies, from cache hits to slow page renders
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds in seconds: Arduino bridge stages, from building a packet to a slow serial write
+STAGE_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(int(value))
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        Monotonic counter, one value per combination of label values.
+
+        Args:
+            name (str): Metric name, ending in _total
+            documentation (str): HELP text
+            labelnames (tuple): Label names; inc() takes their values in this order
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        """
+        Histogram of observed values (usually seconds) with fixed buckets.
+
+        observe() only bisects the bucket list and bumps two numbers under a
+        lock; cumulative bucket counts are only summed up when scraped.
+
+        Args:
+            name (str): Metric name
+            documentation (str): HELP text
+            labelnames (tuple): Label names; observe() takes their values in this order
+            buckets (tuple): Increasing upper bounds; +Inf is implied
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def time(self, *labels):
+        """Context manager observing the seconds spent in its block."""
+        return _Timer(self, labels)
+
+    def count(self, *labels):
+        entry = self._values.get(labels)
+        return sum(entry[0]) if entry else 0
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = f'le="{_number(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        """
+        Metrics exposed on /metrics in the Prometheus text format.
+
+        Counters and histograms are updated on the hot paths. The stats
+        dicts the components already keep (transports, caches, queues) are
+        only read when the endpoint is scraped.
+        """
+        self._metrics = {}
+        self._stats = {}  # prefix -> (get_stats, documentation, gauges, label)
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            # Registering the same name again returns the existing metric
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_stats(self, prefix, get_stats, documentation, gauges=(), label=None):
+        """
+        Expose a component's stats dict. Numeric entries become counters named
+        prefix_key_total, or gauges named prefix_key for keys listed in gauges;
+        other entries (strings, None) are skipped.
+
+        Args:
+            prefix (str): Metric name prefix, e.g. 'map_tile_cache'
+            get_stats (callable): Returns the stats dict, or {label value: stats dict} with label
+            documentation (str): What the stats describe, used in the HELP texts
+            gauges (tuple): Keys that can go down
+            label (str): Label name for per-instance stats, e.g. 'port'
+        """
+        with self._lock:
+            self._stats[prefix] = (get_stats, documentation, frozenset(gauges), label)
+
+    def _collect_stats(self, prefix, get_stats, documentation, gauges, label):
+        stats = get_stats()
+        instances = stats.items() if label else [(None, stats)]
+        samples = {}  # key -> [(label value, value)]
+        for instance, values in instances:
+            for key, value in values.items():
+                if isinstance(value, bool):
+                    value = int(value)
+                elif not isinstance(value, (int, float)):
+                    continue
+                samples.setdefault(key, []).append((instance, value))
+
+        lines = []
+        for key, values in sorted(samples.items()):
+            kind = 'gauge' if key in gauges else 'counter'
+            name = f"{prefix}_{key}" if kind == 'gauge' else f"{prefix}_{key}_total"
+            lines.append(f"# HELP {name} {documentation}: {key.replace('_', ' ')}")
+            lines.append(f"# TYPE {name} {kind}")
+            for instance, value in values:
+                labels = _labels((label,), (instance,)) if label else ''
+                lines.append(f"{name}{labels} {_number(value)}")
+        return lines
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+            stats = list(self._stats.items())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        for prefix, (get_stats, documentation, gauges, label) in stats:
+            try:
+                lines.extend(self._collect_stats(prefix, get_stats, documentation, gauges, label))
+            except Exception as e:
+                lines.append(f"# {prefix} unavailable: {_escape(e)}")
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,316 @@
+import io
+import uuid
+import logging
+
+import numpy as np
+
+from Cache import LRUCache
+from Clustering import TILE_SIZE, MAX_LAT
+
+logger = logging.getLogger(__name__)
+
+TOLERANCE_PX = 1.0  # simplification tolerance in screen pixels at the requested zoom
+MAX_ZOOM = 18  # finest zoom the map allows; detail below it is never shown
+POLYLINE_PRECISION = 5  # decimal digits kept by the encoded polylines
+
+
+def project_array(lats, lons):
+    """Web Mercator positions (0..1 of the world width/height) of arrays of points."""
+    lats = np.clip(lats, -MAX_LAT, MAX_LAT)
+    sin_lat = np.sin(np.radians(lats))
+    x = (lons + 180.0) / 360.0
+    y = 0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)
+    return x, y
+
+
+def tolerance_for_zoom(zoom):
+    """TOLERANCE_PX at a zoom level, in projected (0..1) units."""
+    return TOLERANCE_PX / (TILE_SIZE * 2.0 ** zoom)
+
+
+def simplification_importance(lats, lons, min_tolerance=0.0):
+    """
+    Run Douglas-Peucker once for all tolerances.
+
+    Each point gets the tolerance up to which it survives: the distance that
+    made Douglas-Peucker split at it, capped by the value of the split that
+    contains it. Keeping the points with importance > t is then exactly the
+    Douglas-Peucker simplification with tolerance t, so any zoom level is a
+    mask over one array. Every split of one recursion depth is computed in
+    the same vectorized step. Ranges whose points are all within
+    min_tolerance are not split further.
+
+    Args:
+        lats, lons (np.ndarray): Coordinates in degrees
+        min_tolerance (float): Smallest tolerance that will be asked for, in projected units
+
+    Returns:
+        np.ndarray: Importance per point; the endpoints are infinite
+    """
+    x, y = project_array(np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64))
+    n = len(x)
+    importance = np.zeros(n)
+    if n == 0:
+        return importance
+    importance[0] = importance[-1] = np.inf
+
+    starts = np.array([0])
+    ends = np.array([n - 1])
+    parents = np.array([np.inf])
+    while len(starts):
+        lengths = ends - starts - 1
+        has_interior = lengths > 0
+        starts, ends = starts[has_interior], ends[has_interior]
+        parents, lengths = parents[has_interior], lengths[has_interior]
+        if not len(starts):
+            break
+
+        # Interior points of all ranges laid out back to back
+        offsets = np.cumsum(lengths) - lengths
+        range_of = np.repeat(np.arange(len(starts)), lengths)
+        points = starts[range_of] + 1 + (np.arange(lengths.sum()) - offsets[range_of])
+
+        # Distance of each point to its range's chord (a segment, so closed loops work)
+        ax, ay = x[starts][range_of], y[starts][range_of]
+        dx, dy = x[ends][range_of] - ax, y[ends][range_of] - ay
+        px, py = x[points] - ax, y[points] - ay
+        chord = dx * dx + dy * dy
+        t = np.clip((px * dx + py * dy) / np.where(chord > 0, chord, 1.0), 0.0, 1.0)
+        distance = np.hypot(px - t * dx, py - t * dy)
+
+        # Farthest point of every range (the first one on ties)
+        farthest = np.maximum.reduceat(distance, offsets)
+        candidates = np.flatnonzero(distance == farthest[range_of])
+        _, first = np.unique(range_of[candidates], return_index=True)
+        splits = points[candidates[first]]
+
+        split = farthest > min_tolerance
+        values = np.minimum(farthest, parents)[split]
+        splits = splits[split]
+        importance[splits] = values
+        starts = np.concatenate([starts[split], splits])
+        ends = np.concatenate([splits, ends[split]])
+        parents = np.concatenate([values, values])
+    return importance
+
+
+def encode_polyline(lats, lons, precision=POLYLINE_PRECISION):
+    """
+    Encode coordinates in the Google encoded polyline format, vectorized:
+    every coordinate delta is split into 5-bit chunks in one array operation.
+    """
+    scale = 10 ** precision
+    values = np.empty(2 * len(lats), dtype=np.int64)
+    values[0::2] = np.round(np.asarray(lats, dtype=np.float64) * scale)
+    values[1::2] = np.round(np.asarray(lons, dtype=np.float64) * scale)
+    # Deltas per axis, then zigzag so small negative numbers stay short
+    deltas = values.copy()
+    deltas[2:] -= values[:-2]
+    deltas = (deltas << 1) ^ (deltas >> 63)
+
+    chunks = (deltas[:, None] >> (5 * np.arange(7))) & 0x1f
+    counts = 1 + (deltas[:, None] >= 32 ** np.arange(1, 7)).sum(axis=1)
+    position = np.arange(7)
+    chunks = chunks | np.where(position < (counts[:, None] - 1), 0x20, 0)
+    chunks += 63
+    return chunks[position < counts[:, None]].astype(np.uint8).tobytes().decode('ascii')
+
+
+def decode_polyline(encoded, precision=POLYLINE_PRECISION):
+    """Decode an encoded polyline into a list of (lat, lon)."""
+    values = []
+    value = shift = 0
+    for char in encoded.encode('ascii'):
+        chunk = char - 63
+        value |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    coords = np.cumsum(np.array(values, dtype=np.int64).reshape(-1, 2), axis=0) / 10 ** precision
+    return [tuple(point) for point in coords.tolist()]
+
+
+def validate_coordinates_array(coords):
+    """
+    Check an (n, 2) array of lat/lon.
+
+    Raises:
+        ValueError: Wrong shape, fewer than 2 points or out of range
+    """
+    if coords.ndim != 2 or coords.shape[1] != 2:
+        raise ValueError("coordinates must be [lat, lon] pairs")
+    if len(coords) < 2:
+        raise ValueError("A path needs at least 2 points")
+    if not np.isfinite(coords).all():
+        raise ValueError("Invalid coordinates")
+    if (np.abs(coords[:, 0]) > 90).any() or (np.abs(coords[:, 1]) > 180).any():
+        raise ValueError("Coordinates out of range")
+
+
+class PathStore:
+    def __init__(self, storage, blobs, cache_entries=256):
+        """
+        GPS tracks as NumPy arrays. Each path's points are saved once as an
+        (n, 3) float64 .npy blob of lat, lon and Douglas-Peucker importance;
+        storage['paths'] only keeps a small record (name, style, point
+        count, bounding box, blob hash). Simplified, encoded polylines are
+        cached per blob and zoom level.
+
+        Args:
+            storage: JournalStorage or SQLiteStorage
+            blobs (BlobStore): Where the point arrays are stored
+            cache_entries (int): Encoded polylines kept in memory
+        """
+        self.storage = storage
+        self.blobs = blobs
+        self._polylines = LRUCache(cache_entries)
+        self._arrays = LRUCache(16)
+        self._simplified = LRUCache(16)
+
+    # ------------------------------------------------------------ points
+
+    def build(self, coords):
+        """Validate (n, 2) lat/lon points and stage their array blob; returns (staged, summary)."""
+        coords = np.asarray(coords, dtype=np.float64)
+        validate_coordinates_array(coords)
+        importance = simplification_importance(coords[:, 0], coords[:, 1], tolerance_for_zoom(MAX_ZOOM))
+        buffer = io.BytesIO()
+        np.save(buffer, np.column_stack([coords, importance]), allow_pickle=False)
+        bbox = [float(coords[:, 1].min()), float(coords[:, 0].min()),
+                float(coords[:, 1].max()), float(coords[:, 0].max())]
+        return self.blobs.stage(buffer.getvalue()), {'points': len(coords), 'bbox': bbox}
+
+    def points(self, blob_hash):
+        """The (n, 3) array of a path, memory-mapped from its blob."""
+        array = self._arrays.get(blob_hash)
+        if array is None:
+            array = np.load(self.blobs.path(blob_hash), mmap_mode='r', allow_pickle=False)
+            self._arrays.put(blob_hash, array)
+        return array
+
+    def simplified(self, blob_hash, zoom=None):
+        """The points of a path kept at a zoom level (all of them without one)."""
+        if zoom is None:
+            return self.points(blob_hash)
+        key = (blob_hash, zoom)
+        array = self._simplified.get(key)
+        if array is None:
+            array = self.points(blob_hash)
+            array = array[array[:, 2] > tolerance_for_zoom(zoom)]
+            self._simplified.put(key, array)
+        return array
+
+    def polylines(self, record, zoom=None, bbox=None):
+        """
+        Encoded polylines of a path, simplified for a zoom level. A path that
+        sticks out of bbox is clipped to the parts inside it (plus the
+        neighbouring points, so edge-crossing segments are drawn), which
+        can split it into several polylines.
+
+        Returns:
+            tuple: (list of encoded polylines, points in them)
+        """
+        west, south, east, north = bbox or record['bbox']
+        path_west, path_south, path_east, path_north = record['bbox']
+        if west <= path_west and south <= path_south and east >= path_east and north >= path_north:
+            key = (record['blob'], zoom)
+            cached = self._polylines.get(key)
+            if cached is None:
+                array = self.simplified(record['blob'], zoom)
+                cached = ([encode_polyline(array[:, 0], array[:, 1])], len(array))
+                self._polylines.put(key, cached)
+            return cached
+
+        array = self.simplified(record['blob'], zoom)
+        lats, lons = array[:, 0], array[:, 1]
+        inside = (lons >= west) & (lons <= east) & (lats >= south) & (lats <= north)
+        near = inside.copy()
+        near[1:] |= inside[:-1]
+        near[:-1] |= inside[1:]
+        indices = np.flatnonzero(near)
+        runs = np.split(indices, np.flatnonzero(np.diff(indices) > 1) + 1) if len(indices) else []
+        return [encode_polyline(lats[run], lons[run]) for run in runs if len(run) > 1], len(indices)
+
+    # -------------------------------------------------------------- CRUD
+
+    def create(self, coords, name='Path', color='blue', weight=3):
+        """Store a new path; returns (path_id, record)."""
+        staged, summary = self.build(coords)
+        path_id = str(uuid.uuid4())
+        with self.storage.transaction():
+            record = self._record(staged, summary, name, color, weight)
+            self.storage.put('paths', path_id, record)
+        return path_id, record
+
+    def update(self, path_id, coords=None, **fields):
+        """
+        Change a path's name/color/weight and optionally replace its points.
+
+        Returns:
+            dict: The new record, or None if the path does not exist
+        """
+        staged, summary = self.build(coords) if coords is not None else (None, None)
+        with self.storage.transaction():
+            record = self.storage.get('paths', path_id)
+            if record is None:
+                if staged:
+                    self.blobs.discard(staged)
+                return None
+            record = dict(record, **{key: value for key, value in fields.items() if value is not None})
+            if staged:
+                old_blob = record['blob']
+                record.update(self._record(staged, summary, record['name'], record['color'], record['weight']))
+                self.storage.put('paths', path_id, record)
+                if old_blob != record['blob']:
+                    self._release(old_blob, path_id)
+            else:
+                self.storage.put('paths', path_id, record)
+        return record
+
+    def delete(self, path_id):
+        """Delete a path and, if no other path uses it, its array blob. Returns False if it did not exist."""
+        with self.storage.transaction():
+            record = self.storage.get('paths', path_id)
+            if record is None:
+                return False
+            self.storage.delete('paths', path_id)
+            self._release(record['blob'], path_id)
+        return True
+
+    def query(self, west, south, east, north):
+        """(path_id, record) of the paths whose bounding box overlaps a box."""
+        return [(path_id, record) for path_id, record in self.storage.items('paths')
+                if record['bbox'][0] <= east and record['bbox'][2] >= west
+                and record['bbox'][1] <= north and record['bbox'][3] >= south]
+
+    def _record(self, staged, summary, name, color, weight):
+        """Commit a staged array blob and describe it. Call inside storage.transaction()."""
+        blob_hash, _ = self.blobs.commit(staged)
+        return dict(summary, name=name, color=color, weight=weight, blob=blob_hash)
+
+    def _release(self, blob_hash, path_id):
+        """Delete a blob no other path references. Call inside storage.transaction()."""
+        if any(record['blob'] == blob_hash for other_id, record in self.storage.items('paths') if other_id != path_id):
+            return
+        self._arrays.pop(blob_hash)
+        self._simplified.clear()
+        self.blobs.delete(blob_hash)
+
+    # --------------------------------------------------------- migration
+
+    def migrate_legacy(self):
+        """Move paths stored inline as coordinate lists by older versions into array blobs, once."""
+        for path_id, record in self.storage.items('paths'):
+            if 'blob' in record:
+                continue
+            try:
+                staged, summary = self.build(record.get('coordinates') or [])
+            except ValueError as e:
+                logger.warning(f"Dropping invalid legacy path {path_id}: {e}")
+                self.storage.delete('paths', path_id)
+                continue
+            with self.storage.transaction():
+                self.storage.put('paths', path_id, self._record(
+                    staged, summary, record.get('popup_text', 'Path'), record.get('color', 'blue'),
+                    record.get('weight', 3)))
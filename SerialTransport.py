@@ -0,0 +1,233 @@
+import time
+import random
+import logging
+import threading
+from collections import deque
+
+import serial
+
+
+class SerialTransport:
+    def __init__(self, port, baudrate, max_queue=16, reset_delay=2.0, min_backoff=0.5, max_backoff=30.0,
+                 on_connect=None, on_message=None, timer=None):
+        """
+        Non-blocking serial transport for one controller.
+
+        Callers only ever enqueue packets. A writer thread owns connecting,
+        reconnecting (with exponential backoff) and writing; a reader thread
+        parses the controller's replies line by line as they arrive.
+
+        Args:
+            port (str): Serial port (e.g., 'COM5', '/dev/ttyUSB0')
+            baudrate (int): Serial communication speed
+            max_queue (int): Packets queued before the oldest is dropped
+            reset_delay (float): Seconds to hold writes after opening (the Arduino resets on open)
+            min_backoff (float): First reconnect delay in seconds
+            max_backoff (float): Upper bound of the reconnect delay in seconds
+            on_connect (callable): Called after the port is (re)opened
+            on_message (callable): Called with every line the controller sends
+            timer (callable): Called with ('write', seconds) after every packet written and
+                              ('read', seconds) after every reply read
+        """
+        self.port = port
+        self.baudrate = baudrate
+        self.max_queue = max_queue
+        self.reset_delay = reset_delay
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.on_connect = on_connect
+        self.on_message = on_message
+        self.timer = timer
+
+        self.serial_connection = None
+        self.responses = deque(maxlen=50)
+        self.stats = {
+            'sent_packets': 0,
+            'dropped_packets': 0,
+            'coalesced_packets': 0,
+            'reconnects': 0,
+            'write_errors': 0,
+            'read_errors': 0
+        }
+        self.last_error = None
+
+        self._queue = deque()  # [coalesce_key, packet]
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._backoff = min_backoff
+        self._next_attempt = 0.0
+        self._ready_at = 0.0
+        self._ever_connected = False
+        self._threads = []
+        self.logger = logging.getLogger(__name__)
+
+    # ------------------------------------------------------------ lifecycle
+
+    def start(self):
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._write_loop, name=f"SerialWriter-{self.port}", daemon=True),
+            threading.Thread(target=self._read_loop, name=f"SerialReader-{self.port}", daemon=True)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+        self._close()
+
+    @property
+    def connected(self):
+        connection = self.serial_connection
+        return connection is not None and connection.is_open
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    # -------------------------------------------------------------- writing
+
+    def submit(self, packet, coalesce_key=None):
+        """
+        Queue a packet without blocking.
+
+        A packet with a coalesce_key replaces any queued packet with the same
+        key (only the newest LED state matters). If the queue is full the
+        oldest packet is dropped.
+        """
+        with self._cond:
+            if coalesce_key is not None:
+                for entry in self._queue:
+                    if entry[0] == coalesce_key:
+                        self._queue.remove(entry)
+                        self.stats['coalesced_packets'] += 1
+                        break
+            while len(self._queue) >= self.max_queue:
+                self._queue.popleft()
+                self.stats['dropped_packets'] += 1
+            self._queue.append([coalesce_key, packet])
+            self._cond.notify_all()
+        return True
+
+    def _write_loop(self):
+        while not self._stop.is_set():
+            with self._cond:
+                while not self._queue and not self._stop.is_set():
+                    self._cond.wait()
+            if self._stop.is_set():
+                break
+
+            now = time.monotonic()
+            if not self.connected:
+                if now < self._next_attempt:
+                    self._wait(self._next_attempt - now)
+                    continue
+                if not self._open():
+                    continue
+
+            if now < self._ready_at:
+                self._wait(self._ready_at - now)
+                continue
+
+            with self._cond:
+                if not self._queue:
+                    continue
+                entry = self._queue.popleft()
+
+            try:
+                started = time.perf_counter()
+                self.serial_connection.write(entry[1])
+                self.stats['sent_packets'] += 1
+                if self.timer:
+                    self.timer('write', time.perf_counter() - started)
+            except (serial.SerialException, OSError, AttributeError) as e:
+                self.stats['write_errors'] += 1
+                self.logger.error(f"Serial communication error on {self.port}: {e}")
+                self._disconnected(e)
+                with self._cond:
+                    # Keep the packet unless something newer replaced it meanwhile
+                    if entry[0] is None or all(queued[0] != entry[0] for queued in self._queue):
+                        self._queue.appendleft(entry)
+
+    def _wait(self, seconds):
+        with self._cond:
+            self._cond.wait(seconds)
+
+    # -------------------------------------------------------------- reading
+
+    def _read_loop(self):
+        while not self._stop.is_set():
+            connection = self.serial_connection
+            if connection is None or not connection.is_open or time.monotonic() < self._ready_at:
+                self._stop.wait(0.1)
+                continue
+            try:
+                started = time.perf_counter()
+                line = connection.readline()
+            except (serial.SerialException, OSError, TypeError, AttributeError) as e:
+                self.stats['read_errors'] += 1
+                self.logger.warning(f"Error reading Arduino response on {self.port}: {e}")
+                self._disconnected(e)
+                continue
+
+            response = line.decode('utf-8', errors='replace').strip() if line else ''
+            if response:
+                if self.timer:
+                    self.timer('read', time.perf_counter() - started)
+                self.responses.append(response)
+                self.logger.debug(f"Arduino {self.port}: {response}")
+                if self.on_message:
+                    self.on_message(response)
+
+    def read_response(self):
+        """Return the oldest unread reply from the controller, or None."""
+        try:
+            return self.responses.popleft()
+        except IndexError:
+            return None
+
+    # ----------------------------------------------------------- connection
+
+    def _open(self):
+        try:
+            self.serial_connection = serial.Serial(self.port, self.baudrate, timeout=0.1, write_timeout=1)
+        except (serial.SerialException, OSError) as e:
+            self.last_error = str(e)
+            delay = self._backoff * random.uniform(0.8, 1.2)
+            self._next_attempt = time.monotonic() + delay
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+            self.logger.error(f"Failed to open serial connection on {self.port}, retrying in {delay:.1f}s: {e}")
+            return False
+
+        self._backoff = self.min_backoff
+        # Hold writes while the Arduino resets instead of sleeping
+        self._ready_at = time.monotonic() + self.reset_delay
+        if self._ever_connected:
+            self.stats['reconnects'] += 1
+        self._ever_connected = True
+        self.logger.info(f"Serial connection opened on {self.port}")
+        if self.on_connect:
+            self.on_connect()
+        return True
+
+    def _disconnected(self, error):
+        self.last_error = str(error)
+        self._close()
+        self._next_attempt = time.monotonic() + self._backoff
+
+    def _close(self):
+        connection, self.serial_connection = self.serial_connection, None
+        try:
+            if connection is not None and connection.is_open:
+                connection.close()
+                self.logger.info(f"Serial connection on {self.port} closed")
+        except Exception as e:
+            self.logger.error(f"Error closing serial connection on {self.port}: {e}")
+
+    def get_stats(self):
+        return dict(self.stats, connected=self.connected, queued=self.queued, last_error=self.last_error)
@@ -0,0 +1,72 @@
+import queue
+import logging
+import threading
+
+from werkzeug.serving import BaseWSGIServer
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadPoolWSGIServer(BaseWSGIServer):
+    def __init__(self, host, port, app, threads=8):
+        """
+        Werkzeug WSGI server that handles requests on a fixed pool of worker
+        threads instead of one new thread per request.
+
+        Args:
+            host (str): Interface to bind
+            port (int): Port to bind
+            app: WSGI application
+            threads (int): Worker threads
+        """
+        super().__init__(host, port, app)
+        self.threads = threads
+        self._requests = queue.Queue()
+        self._workers = [threading.Thread(target=self._worker, name=f"http-worker-{i}", daemon=True)
+                         for i in range(threads)]
+        for worker in self._workers:
+            worker.start()
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _worker(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for _ in self._workers:
+            self._requests.put(None)
+
+
+def serve_production(app, host='0.0.0.0', port=5000, threads=8):
+    """
+    Serve the app without the debugger or reloader, with a pool of worker threads.
+    Uses waitress if it is installed, otherwise a thread-pool Werkzeug server.
+    """
+    try:
+        from waitress import serve
+    except ImportError:
+        serve = None
+
+    if serve is not None:
+        print(f"Serving on http://{host}:{port} with waitress ({threads} threads)")
+        serve(app, host=host, port=port, threads=threads)
+        return
+
+    print(f"Serving on http://{host}:{port} with a {threads}-thread pool (install waitress for a hardened server)")
+    server = ThreadPoolWSGIServer(host, port, app, threads=threads)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
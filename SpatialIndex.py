@@ -0,0 +1,131 @@
+import math
+import threading
+
+
+class GridIndex:
+    def __init__(self, cell_size=1.0):
+        """
+        Uniform grid spatial index over marker positions.
+
+        Markers are bucketed into cell_size x cell_size degree cells, so a
+        bounding-box query only touches the cells that overlap the box.
+
+        Args:
+            cell_size (float): Cell edge length in degrees
+        """
+        self.cell_size = cell_size
+        self._cells = {}      # (cell_x, cell_y) -> {marker_id: (lat, lon)}
+        self._positions = {}  # marker_id -> (lat, lon)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, marker_id):
+        return marker_id in self._positions
+
+    def _cell_of(self, lat, lon):
+        return (math.floor(lon / self.cell_size), math.floor(lat / self.cell_size))
+
+    def insert(self, marker_id, lat, lon):
+        """Add a marker, or move it if it is already indexed."""
+        with self._lock:
+            self._remove_locked(marker_id)
+            self._cells.setdefault(self._cell_of(lat, lon), {})[marker_id] = (lat, lon)
+            self._positions[marker_id] = (lat, lon)
+
+    def remove(self, marker_id):
+        """Remove a marker. Returns False if it was not indexed."""
+        with self._lock:
+            return self._remove_locked(marker_id)
+
+    def _remove_locked(self, marker_id):
+        position = self._positions.pop(marker_id, None)
+        if position is None:
+            return False
+        cell_key = self._cell_of(*position)
+        cell = self._cells[cell_key]
+        del cell[marker_id]
+        if not cell:
+            del self._cells[cell_key]
+        return True
+
+    def rebuild(self, items):
+        """Replace the index contents with (marker_id, lat, lon) tuples."""
+        with self._lock:
+            self._cells = {}
+            self._positions = {}
+            for marker_id, lat, lon in items:
+                self._cells.setdefault(self._cell_of(lat, lon), {})[marker_id] = (lat, lon)
+                self._positions[marker_id] = (lat, lon)
+
+    def position(self, marker_id):
+        return self._positions.get(marker_id)
+
+    def query(self, west, south, east, north):
+        """Return the ids of all markers inside the bounding box."""
+        west, east = max(west, -180.0), min(east, 180.0)
+        south, north = max(south, -90.0), min(north, 90.0)
+        if west > east or south > north:
+            return []
+
+        min_x, min_y = self._cell_of(south, west)
+        max_x, max_y = self._cell_of(north, east)
+        result = []
+
+        with self._lock:
+            span = (max_x - min_x + 1) * (max_y - min_y + 1)
+            if span <= len(self._cells):
+                # Small box: probe each overlapping cell
+                cells = (self._cells.get((x, y)) for x in range(min_x, max_x + 1)
+                         for y in range(min_y, max_y + 1))
+            else:
+                # Large box over a sparse grid: walk the occupied cells instead
+                cells = (cell for (x, y), cell in self._cells.items()
+                         if min_x <= x <= max_x and min_y <= y <= max_y)
+
+            for cell in cells:
+                if not cell:
+                    continue
+                for marker_id, (lat, lon) in cell.items():
+                    if south <= lat <= north and west <= lon <= east:
+                        result.append(marker_id)
+
+        return result
+
+
+class StorageIndex:
+    def __init__(self, storage):
+        """
+        Spatial index backed by a storage backend's own lat/lon index
+        (SQLiteStorage.query_bbox), so marker positions don't have to be
+        held in memory. Same interface as GridIndex.
+        """
+        self.storage = storage
+
+    def __len__(self):
+        return self.storage.count('markers')
+
+    def __contains__(self, marker_id):
+        return self.storage.contains('markers', marker_id)
+
+    def insert(self, marker_id, lat, lon):
+        pass  # the stored row already carries its position
+
+    def remove(self, marker_id):
+        pass
+
+    def rebuild(self, items):
+        pass
+
+    def position(self, marker_id):
+        marker = self.storage.get('markers', marker_id)
+        return (marker['lat'], marker['lon']) if marker else None
+
+    def query(self, west, south, east, north):
+        """Return the ids of all markers inside the bounding box."""
+        west, east = max(west, -180.0), min(east, 180.0)
+        south, north = max(south, -90.0), min(north, 90.0)
+        if west > east or south > north:
+            return []
+        return self.storage.query_bbox(west, south, east, north)
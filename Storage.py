@@ -0,0 +1,800 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import logging
+from contextlib import contextmanager
+
+from Cache import LRUCache
+
+SECTIONS = ('markers', 'paths', 'memories')
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+logger = logging.getLogger(__name__)
+
+
+def empty_store():
+    """Return a new, empty storage dictionary."""
+    return {section: {} for section in SECTIONS}
+
+
+def journal_path_for(snapshot_path):
+    """Return the journal file that belongs to a snapshot file."""
+    root, _ = os.path.splitext(snapshot_path)
+    return root + '.journal'
+
+
+def read_snapshot(snapshot_path):
+    """Read a JSON snapshot, returning an empty store if it does not exist."""
+    store = empty_store()
+    if os.path.exists(snapshot_path):
+        with open(snapshot_path, 'r', encoding='utf-8') as f:
+            store.update(json.load(f))
+    return store
+
+
+def apply_record(store, record):
+    """Apply a single journal record to a storage dictionary."""
+    op = record['op']
+    section = store.setdefault(record['section'], {})
+    if op == 'put':
+        section[record['key']] = record['value']
+    elif op == 'delete':
+        section.pop(record['key'], None)
+    else:
+        raise ValueError(f"Unknown journal op: {op}")
+
+
+def replay_journal(store, journal_path):
+    """
+    Replay a journal file on top of a storage dictionary.
+
+    Records are newline-terminated JSON objects. A trailing record that was
+    only partly written (crash mid-append) is ignored.
+
+    Returns:
+        tuple: (records applied, byte offset of the end of the last good record)
+    """
+    applied = 0
+    good_offset = 0
+    if not os.path.exists(journal_path):
+        return applied, good_offset
+
+    with open(journal_path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                logger.warning(f"Ignoring torn record at end of {journal_path}")
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.warning(f"Ignoring corrupt record at end of {journal_path}")
+                break
+            apply_record(store, record)
+            applied += 1
+            good_offset += len(line)
+
+    return applied, good_offset
+
+
+def load_store(snapshot_path):
+    """
+    Load the current state of a journaled store without opening it for writing.
+    Used by readers in other threads or processes.
+    """
+    if snapshot_path.endswith(SQLITE_EXTENSIONS):
+        return read_sqlite_store(snapshot_path)
+    store = read_snapshot(snapshot_path)
+    journal_path = journal_path_for(snapshot_path)
+    replay_journal(store, journal_path + '.compacting')
+    replay_journal(store, journal_path)
+    return store
+
+
+def write_json_atomic(path, data):
+    """Write data as JSON to a temp file and rename it over path."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class RWLock:
+    def __init__(self):
+        """
+        Reader/writer lock: many readers at once, one writer alone.
+
+        Waiting writers block new readers so a steady stream of reads can't
+        starve them. The write side is reentrant for the owning thread, and a
+        writer may also take the read side.
+        """
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = None
+        self._write_depth = 0
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                while self._writer is not None or self._writers_waiting:
+                    self._cond.wait()
+                self._readers += 1
+        try:
+            yield
+        finally:
+            if self._writer != me:
+                with self._cond:
+                    self._readers -= 1
+                    if not self._readers:
+                        self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                self._writers_waiting += 1
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+                self._writers_waiting -= 1
+                self._writer = me
+            self._write_depth += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._write_depth -= 1
+                if not self._write_depth:
+                    self._writer = None
+                    self._cond.notify_all()
+
+
+class JournalStorage:
+    def __init__(self, snapshot_path, compact_threshold=500, fsync=False):
+        """
+        Append-only journaled storage for markers, paths and memories.
+
+        Every mutation appends one small record to the journal instead of
+        rewriting the whole store. A background thread folds the journal into
+        the JSON snapshot once it grows past compact_threshold records.
+
+        Args:
+            snapshot_path (str): JSON snapshot file (also the import/export format)
+            compact_threshold (int): Journal records before a compaction is scheduled
+            fsync (bool): fsync the journal after every record
+        """
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path_for(snapshot_path)
+        self.compacting_path = self.journal_path + '.compacting'
+        self.compact_threshold = compact_threshold
+        self.fsync = fsync
+
+        self._lock = RWLock()
+        self._compact_lock = threading.Lock()
+        self._compact_event = threading.Event()
+        self._closed = False
+
+        # Bumped on every mutation so callers can cache derived views
+        self.generation = 0
+
+        self.data = self._recover()
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+
+        self._compactor = threading.Thread(target=self._compaction_loop, daemon=True)
+        self._compactor.start()
+
+    def _recover(self):
+        """Load the snapshot and replay any journals left by the last run."""
+        data = read_snapshot(self.snapshot_path)
+
+        # A compaction that crashed before renaming its snapshot leaves its
+        # journal behind; fold it back in before anything else.
+        pending, _ = replay_journal(data, self.compacting_path)
+        self._records, good_offset = replay_journal(data, self.journal_path)
+
+        if os.path.exists(self.journal_path) and os.path.getsize(self.journal_path) != good_offset:
+            # Drop the torn tail so new records don't get glued onto it
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(good_offset)
+
+        if pending:
+            write_json_atomic(self.snapshot_path, data)
+            os.remove(self.compacting_path)
+            logger.info(f"Recovered {pending} records from interrupted compaction")
+
+        if self._records:
+            logger.info(f"Replayed {self._records} journal records from {self.journal_path}")
+        return data
+
+    # ------------------------------------------------------------------ reads
+
+    def get(self, section, key, default=None):
+        with self._lock.read():
+            return self.data[section].get(key, default)
+
+    def contains(self, section, key):
+        with self._lock.read():
+            return key in self.data[section]
+
+    def items(self, section):
+        """Return a list of (key, value) pairs that is safe to iterate."""
+        with self._lock.read():
+            return list(self.data[section].items())
+
+    def count(self, section):
+        with self._lock.read():
+            return len(self.data[section])
+
+    def iter_items(self, section, batch_size=500):
+        """Yield (key, value) pairs, taking the read lock one batch at a time."""
+        keys = self.keys(section)
+        for i in range(0, len(keys), batch_size):
+            with self._lock.read():
+                batch = [(key, self.data[section][key]) for key in keys[i:i + batch_size]
+                         if key in self.data[section]]
+            yield from batch
+
+    def keys(self, section):
+        with self._lock.read():
+            return list(self.data[section])
+
+    def iter_fields(self, section, fields, batch_size=500):
+        """Yield (key, *values) tuples of some top-level fields (None when missing)."""
+        for key, value in self.iter_items(section, batch_size):
+            yield (key,) + tuple(value.get(field) for field in fields)
+
+    def items_missing(self, section, field):
+        """Return the (key, value) pairs whose value has no such field."""
+        with self._lock.read():
+            return [(key, value) for key, value in self.data[section].items() if field not in value]
+
+    def transaction(self):
+        """
+        Hold the write lock across a read-modify-write, e.g.
+
+            with storage.transaction():
+                marker = storage.get('markers', marker_id)
+                storage.put('markers', marker_id, dict(marker, color=color))
+        """
+        return self._lock.write()
+
+    # ----------------------------------------------------------------- writes
+
+    def put(self, section, key, value):
+        """Insert or replace one entry."""
+        with self._lock.write():
+            self.data[section][key] = value
+            self.generation += 1
+            self._append({'op': 'put', 'section': section, 'key': key, 'value': value})
+
+    def delete(self, section, key):
+        """Delete one entry. Returns False if it did not exist."""
+        with self._lock.write():
+            if key not in self.data[section]:
+                return False
+            del self.data[section][key]
+            self.generation += 1
+            self._append({'op': 'delete', 'section': section, 'key': key})
+            return True
+
+    def put_many(self, section, items):
+        """Insert or replace many entries with a single journal write."""
+        with self._lock.write():
+            records = []
+            for key, value in items:
+                self.data[section][key] = value
+                records.append({'op': 'put', 'section': section, 'key': key, 'value': value})
+            self.generation += 1
+            self._append_many(records)
+            return len(records)
+
+    def delete_many(self, section, keys):
+        """Delete many entries with a single journal write. Returns how many existed."""
+        with self._lock.write():
+            records = []
+            for key in keys:
+                if self.data[section].pop(key, None) is not None:
+                    records.append({'op': 'delete', 'section': section, 'key': key})
+            self.generation += 1
+            self._append_many(records)
+            return len(records)
+
+    def _append(self, record):
+        self._append_many([record])
+
+    def _append_many(self, records):
+        if not records:
+            return
+        self._journal.write(''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records))
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+
+        self._records += len(records)
+        if self._records >= self.compact_threshold:
+            self._compact_event.set()
+
+    # ------------------------------------------------------------- compaction
+
+    def _compaction_loop(self):
+        while not self._closed:
+            self._compact_event.wait()
+            self._compact_event.clear()
+            if self._closed:
+                break
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error(f"Storage compaction failed: {e}")
+
+    def compact(self):
+        """
+        Fold the journal into a fresh snapshot.
+
+        The write lock is only held to copy the section dicts and switch to
+        a new journal; the snapshot is serialised and written afterwards, so
+        requests don't wait for it. Stored values are never modified in place
+        (writes replace them), so a shallow copy is a consistent cutover.
+        """
+        with self._compact_lock:
+            with self._lock.write():
+                if self._records == 0:
+                    return
+                snapshot = {section: dict(entries) for section, entries in self.data.items()}
+                self._journal.close()
+                os.replace(self.journal_path, self.compacting_path)
+                self._journal = open(self.journal_path, 'a', encoding='utf-8')
+                compacted = self._records
+                self._records = 0
+
+            # Until the snapshot is renamed, .compacting holds everything since the last one
+            write_json_atomic(self.snapshot_path, snapshot)
+            os.remove(self.compacting_path)
+            logger.info(f"Compacted {compacted} journal records into {self.snapshot_path}")
+
+    # ---------------------------------------------------------- import/export
+
+    def export_json(self, path):
+        """Write the full store as a plain JSON file."""
+        with self._lock.read():
+            payload = json.loads(json.dumps(self.data))
+        write_json_atomic(path, payload)
+
+    def import_json(self, path):
+        """Replace the whole store with the contents of a JSON file."""
+        imported = read_snapshot(path)
+        with self._compact_lock:
+            with self._lock.write():
+                self.data.clear()
+                self.data.update(imported)
+                self.generation += 1
+                write_json_atomic(self.snapshot_path, self.data)
+                self._journal.close()
+                self._journal = open(self.journal_path, 'w', encoding='utf-8')
+                self._records = 0
+        logger.info(f"Imported store from {path}")
+
+    def close(self):
+        """Compact outstanding records and stop the background thread."""
+        self.compact()
+        self._closed = True
+        self._compact_event.set()
+        with self._lock.write():
+            self._journal.close()
+
+
+# Marker fields that have their own (indexed) column next to the JSON record
+MARKER_COLUMNS = ('lat', 'lon', 'marker_number')
+FIELD_NAME = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS markers (
+    id TEXT PRIMARY KEY,
+    lat REAL,
+    lon REAL,
+    marker_number INTEGER,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS markers_lat_lon ON markers (lat, lon);
+CREATE INDEX IF NOT EXISTS markers_lon ON markers (lon);
+CREATE INDEX IF NOT EXISTS markers_marker_number ON markers (marker_number);
+CREATE TABLE IF NOT EXISTS paths (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS memories (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+"""
+
+
+class SQLiteStorage:
+    def __init__(self, db_path, cache_entries=1024, fsync=False):
+        """
+        SQLite storage backend with the same interface as JournalStorage.
+
+        Markers are rows with indexed lat/lon and marker_number columns (the
+        full record is kept as JSON next to them); paths and memories have
+        their own tables. Records are read on demand and recently used
+        markers are kept in a small LRU cache. The app's derived indexes
+        (marker numbers, LED colors, cluster cells) are built at startup with
+        iter_fields(), which reads columns without decoding any record.
+
+        Args:
+            db_path (str): SQLite database file
+            cache_entries (int): Marker/path records kept in memory
+            fsync (bool): Sync the database on every commit (synchronous=FULL)
+        """
+        self.db_path = db_path
+        self.fsync = fsync
+        self._lock = RWLock()
+        self._local = threading.local()
+        self._cache = LRUCache(cache_entries)
+        self._tx_depth = 0
+
+        # Bumped on every mutation so callers can cache derived views
+        self.generation = 0
+
+        with self._lock.write():
+            self._connection().executescript(SQLITE_SCHEMA)
+
+    def _connection(self):
+        """
+        One connection per thread. WAL makes a commit an append to the log,
+        which stays crash-safe with synchronous=NORMAL; concurrency is decided
+        by the RWLock, which serializes readers against writes.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(f"PRAGMA synchronous={'FULL' if self.fsync else 'NORMAL'}")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _table(section):
+        if section not in SECTIONS:
+            raise KeyError(section)
+        return section
+
+    # ------------------------------------------------------------------ reads
+
+    def get(self, section, key, default=None):
+        cacheable = section != 'memories'  # memories are large and rarely reread
+        if cacheable:
+            value = self._cache.get((section, key))
+            if value is not None:
+                return value
+        with self._lock.read():
+            row = self._connection().execute(
+                f"SELECT data FROM {self._table(section)} WHERE id = ?", (key,)).fetchone()
+            if row is None:
+                return default
+            value = json.loads(row[0])
+            if cacheable:
+                self._cache.put((section, key), value)
+            return value
+
+    def contains(self, section, key):
+        if section != 'memories' and self._cache.get((section, key)) is not None:
+            return True
+        with self._lock.read():
+            return self._connection().execute(
+                f"SELECT 1 FROM {self._table(section)} WHERE id = ?", (key,)).fetchone() is not None
+
+    def items(self, section):
+        """Return a list of (key, value) pairs that is safe to iterate."""
+        with self._lock.read():
+            rows = self._connection().execute(f"SELECT id, data FROM {self._table(section)}").fetchall()
+        return [(key, json.loads(data)) for key, data in rows]
+
+    def count(self, section):
+        with self._lock.read():
+            return self._connection().execute(f"SELECT COUNT(*) FROM {self._table(section)}").fetchone()[0]
+
+    def iter_items(self, section, batch_size=500):
+        """Yield (key, value) pairs, reading one batch of rows at a time."""
+        table = self._table(section)
+        last_key = ''
+        while True:
+            with self._lock.read():
+                rows = self._connection().execute(
+                    f"SELECT id, data FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_key, batch_size)).fetchall()
+            if not rows:
+                return
+            for key, data in rows:
+                yield key, json.loads(data)
+            last_key = rows[-1][0]
+
+    def keys(self, section):
+        with self._lock.read():
+            return [row[0] for row in self._connection().execute(f"SELECT id FROM {self._table(section)}")]
+
+    def iter_fields(self, section, fields, batch_size=500):
+        """
+        Yield (key, *values) tuples of some top-level fields (None when
+        missing), one batch of rows at a time. Marker lat/lon/marker_number
+        come from their columns, other fields are extracted by SQLite, so no
+        record is decoded in Python.
+        """
+        table = self._table(section)
+        columns = []
+        for field in fields:
+            if not FIELD_NAME.fullmatch(field):
+                raise ValueError(f"Invalid field name: {field}")
+            if table == 'markers' and field in MARKER_COLUMNS:
+                columns.append(field)
+            else:
+                columns.append(f"json_extract(data, '$.{field}')")
+        last_key = ''
+        while True:
+            with self._lock.read():
+                rows = self._connection().execute(
+                    f"SELECT id, {', '.join(columns)} FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_key, batch_size)).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_key = rows[-1][0]
+
+    def items_missing(self, section, field):
+        """Return the (key, value) pairs whose value has no such field."""
+        if not FIELD_NAME.fullmatch(field):
+            raise ValueError(f"Invalid field name: {field}")
+        with self._lock.read():
+            rows = self._connection().execute(
+                f"SELECT id, data FROM {self._table(section)} WHERE json_type(data, '$.{field}') IS NULL").fetchall()
+        return [(key, json.loads(data)) for key, data in rows]
+
+    def query_bbox(self, west, south, east, north):
+        """Return the ids of markers inside a bounding box, using the lat/lon index."""
+        with self._lock.read():
+            rows = self._connection().execute(
+                "SELECT id FROM markers WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?",
+                (south, north, west, east)).fetchall()
+        return [row[0] for row in rows]
+
+    @contextmanager
+    def transaction(self):
+        """
+        Hold the write lock across a read-modify-write; the statements inside
+        are committed together (or rolled back on an exception).
+        """
+        with self._lock.write():
+            connection = self._connection()
+            if self._tx_depth == 0:
+                connection.execute('BEGIN IMMEDIATE')
+            self._tx_depth += 1
+            try:
+                yield
+            except BaseException:
+                self._tx_depth -= 1
+                if self._tx_depth == 0:
+                    connection.execute('ROLLBACK')
+                    self._cache.clear()
+                raise
+            else:
+                self._tx_depth -= 1
+                if self._tx_depth == 0:
+                    connection.execute('COMMIT')
+
+    # ----------------------------------------------------------------- writes
+
+    def put(self, section, key, value):
+        """Insert or replace one entry."""
+        data = json.dumps(value, separators=(',', ':'))
+        with self.transaction():
+            if section == 'markers':
+                self._connection().execute(
+                    "INSERT OR REPLACE INTO markers (id, lat, lon, marker_number, data) VALUES (?, ?, ?, ?, ?)",
+                    (key, value.get('lat'), value.get('lon'), value.get('marker_number'), data))
+            else:
+                self._connection().execute(
+                    f"INSERT OR REPLACE INTO {self._table(section)} (id, data) VALUES (?, ?)", (key, data))
+            self._cache.pop((section, key))
+            self.generation += 1
+
+    def delete(self, section, key):
+        """Delete one entry. Returns False if it did not exist."""
+        with self.transaction():
+            cursor = self._connection().execute(f"DELETE FROM {self._table(section)} WHERE id = ?", (key,))
+            self._cache.pop((section, key))
+            if not cursor.rowcount:
+                return False
+            self.generation += 1
+            return True
+
+    def put_many(self, section, items):
+        """Insert or replace many entries in one transaction."""
+        items = list(items)
+        with self.transaction():
+            connection = self._connection()
+            if section == 'markers':
+                connection.executemany(
+                    "INSERT OR REPLACE INTO markers (id, lat, lon, marker_number, data) VALUES (?, ?, ?, ?, ?)",
+                    ((key, value.get('lat'), value.get('lon'), value.get('marker_number'),
+                      json.dumps(value, separators=(',', ':'))) for key, value in items))
+            else:
+                connection.executemany(
+                    f"INSERT OR REPLACE INTO {self._table(section)} (id, data) VALUES (?, ?)",
+                    ((key, json.dumps(value, separators=(',', ':'))) for key, value in items))
+            for key, _ in items:
+                self._cache.pop((section, key))
+            self.generation += 1
+            return len(items)
+
+    def delete_many(self, section, keys):
+        """Delete many entries in one transaction. Returns how many existed."""
+        deleted = 0
+        with self.transaction():
+            connection = self._connection()
+            for key in keys:
+                deleted += connection.execute(f"DELETE FROM {self._table(section)} WHERE id = ?", (key,)).rowcount
+                self._cache.pop((section, key))
+            self.generation += 1
+            return deleted
+
+    def compact(self):
+        """Fold the write-ahead log back into the database file."""
+        with self._lock.write():
+            self._connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    # ---------------------------------------------------------- import/export
+
+    def export_json(self, path):
+        """Write the full store as a plain JSON file."""
+        write_json_atomic(path, {section: dict(self.items(section)) for section in SECTIONS})
+
+    def import_json(self, path):
+        """Replace the whole store with the contents of a JSON file."""
+        self.import_store(read_snapshot(path))
+        logger.info(f"Imported store from {path}")
+
+    def import_store(self, store):
+        """Replace the whole store with a storage dictionary, in one transaction."""
+        with self.transaction():
+            connection = self._connection()
+            for section in SECTIONS:
+                connection.execute(f"DELETE FROM {section}")
+            connection.executemany(
+                "INSERT INTO markers (id, lat, lon, marker_number, data) VALUES (?, ?, ?, ?, ?)",
+                ((key, value.get('lat'), value.get('lon'), value.get('marker_number'),
+                  json.dumps(value, separators=(',', ':')))
+                 for key, value in store.get('markers', {}).items()))
+            for section in ('paths', 'memories'):
+                connection.executemany(
+                    f"INSERT INTO {section} (id, data) VALUES (?, ?)",
+                    ((key, json.dumps(value, separators=(',', ':'))) for key, value in store.get(section, {}).items()))
+            self._cache.clear()
+            self.generation += 1
+
+    def close(self):
+        self.compact()
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+def read_sqlite_store(db_path):
+    """Read a whole SQLite store into a storage dictionary (for out-of-process readers)."""
+    store = empty_store()
+    connection = sqlite3.connect(db_path)
+    try:
+        for section in SECTIONS:
+            for key, data in connection.execute(f"SELECT id, data FROM {section}"):
+                store[section][key] = json.loads(data)
+    finally:
+        connection.close()
+    return store
+
+
+def migrate_json_to_sqlite(snapshot_path, db_path):
+    """
+    One-shot migration of a JSON snapshot (and its journal) into a new
+    SQLite database. The JSON files are left in place as a backup.
+
+    Returns:
+        dict: Number of entries migrated per section
+    """
+    if os.path.exists(db_path):
+        raise FileExistsError(f"{db_path} already exists")
+    store = load_store(snapshot_path)
+    tmp_path = db_path + '.migrating'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    backend = SQLiteStorage(tmp_path)
+    backend.import_store(store)
+    backend.close()
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(tmp_path + suffix):
+            os.remove(tmp_path + suffix)
+    os.replace(tmp_path, db_path)
+
+    counts = {section: len(store.get(section, {})) for section in SECTIONS}
+    logger.info(f"Migrated {snapshot_path} to {db_path}: {counts}")
+    return counts
+
+
+def open_storage(backend='json', snapshot_path='server_storage.json', db_path='server_storage.db'):
+    """
+    Open the configured storage backend.
+
+    'json' is the journaled JSON store; 'sqlite' is the SQLite store, migrated
+    from the JSON snapshot the first time it is opened.
+    """
+    if backend == 'json':
+        return JournalStorage(snapshot_path)
+    if backend == 'sqlite':
+        if not os.path.exists(db_path) and os.path.exists(snapshot_path):
+            migrate_json_to_sqlite(snapshot_path, db_path)
+        return SQLiteStorage(db_path)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+class DuplicateMarkerNumber(ValueError):
+    """Raised when a marker number is already used by another marker."""
+
+
+class MarkerNumberIndex:
+    def __init__(self):
+        """
+        Bidirectional marker id <-> marker number index.
+
+        Marker numbers select the LED of a marker, so each number may only
+        belong to one marker.
+        """
+        self._by_id = {}
+        self._by_number = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def number_of(self, marker_id):
+        return self._by_id.get(marker_id)
+
+    def id_of(self, marker_number):
+        return self._by_number.get(marker_number)
+
+    def assign(self, marker_id, marker_number):
+        """
+        Give a marker a number (None clears it).
+        Raises DuplicateMarkerNumber if another marker already has it.
+        """
+        with self._lock:
+            owner = self._by_number.get(marker_number)
+            if marker_number is not None and owner is not None and owner != marker_id:
+                raise DuplicateMarkerNumber(f"Marker number {marker_number} is already used")
+            self._remove_locked(marker_id)
+            if marker_number is not None:
+                self._by_id[marker_id] = marker_number
+                self._by_number[marker_number] = marker_id
+
+    def remove(self, marker_id):
+        with self._lock:
+            self._remove_locked(marker_id)
+
+    def _remove_locked(self, marker_id):
+        marker_number = self._by_id.pop(marker_id, None)
+        if marker_number is not None:
+            del self._by_number[marker_number]
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) != 4 or sys.argv[1] != 'migrate':
+        print("Usage: python Storage.py migrate <server_storage.json> <server_storage.db>")
+        sys.exit(1)
+    print(migrate_json_to_sqlite(sys.argv[2], sys.argv[3]))
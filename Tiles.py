@@ -0,0 +1,281 @@
+import os
+import math
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from Cache import LRUCache, DiskLRUCache, SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Base layers served through /tiles/<layer>/<z>/<x>/<y>
+TILE_LAYERS = {
+    'osm': {
+        'url': 'https://tile.openstreetmap.org/{z}/{x}/{y}.png',
+        'attr': '&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors',
+        'name': 'OpenStreetMap',
+        'content_type': 'image/png',
+        'max_zoom': 19
+    },
+    'satellite': {
+        'url': 'https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
+        'attr': 'Esri World Imagery',
+        'name': 'Satellite View',
+        'content_type': 'image/jpeg',
+        'max_zoom': 18
+    }
+}
+
+USER_AGENT = 'Map_app tile proxy (+https://github.com/Arthur-cascardo/Map_app)'
+SEED_MAX_TILES = 20000  # refuse larger seeds unless forced; tile servers forbid bulk scraping
+TYPICAL_TILE_BYTES = 20 * 1024  # to warn when a seed will not fit in the cache
+
+# A tile miss may only hold a server thread this long: a few requests go
+# upstream at a time, the rest wait briefly for a slot and then give up
+UPSTREAM_TIMEOUT = 5.0        # seconds per upstream request
+MAX_UPSTREAM_FETCHES = 4      # concurrent upstream requests (the server has 8 threads)
+UPSTREAM_SLOT_WAIT = 0.5      # seconds a miss waits for a free upstream slot
+FAILURE_TTL = 30.0            # seconds a failed tile is answered from the failure cache
+FAILURE_ENTRIES = 4096        # failed tiles remembered
+
+
+class TileUnavailable(Exception):
+    """The tile is neither cached nor available upstream."""
+
+
+class HTTPUpstream:
+    def __init__(self, layers=TILE_LAYERS, url_template=None, timeout=UPSTREAM_TIMEOUT):
+        """
+        Fetches tiles over HTTP from the layers' own servers.
+
+        Args:
+            layers (dict): Layer name -> {'url', 'content_type', ...}, see TILE_LAYERS
+            url_template (str): One URL for every layer instead, with {layer}, {z}, {x}
+                                and {y}, e.g. a local stand-in tile server
+            timeout (float): Seconds per request
+        """
+        self.layers = layers
+        self.url_template = url_template
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.headers['User-Agent'] = USER_AGENT
+        return session
+
+    def fetch(self, layer, z, x, y):
+        """Return the tile bytes or raise TileUnavailable."""
+        template = self.url_template or self.layers[layer]['url']
+        url = template.format(layer=layer, z=z, x=x, y=y)
+        try:
+            response = self._session().get(url, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise TileUnavailable(f"{url}: {e}") from e
+        if response.status_code != 200 or not response.content:
+            raise TileUnavailable(f"{url}: HTTP {response.status_code}")
+        return response.content
+
+
+def upstream_from_env(layers=TILE_LAYERS):
+    """HTTPUpstream for the real tile servers, or for MAP_TILE_UPSTREAM if it is set."""
+    return HTTPUpstream(layers, url_template=os.environ.get('MAP_TILE_UPSTREAM') or None)
+
+
+class TileCache:
+    def __init__(self, cache_dir, upstream, layers=TILE_LAYERS, max_bytes=512 * 1024 * 1024,
+                 max_upstream=MAX_UPSTREAM_FETCHES, slot_wait=UPSTREAM_SLOT_WAIT, failure_ttl=FAILURE_TTL):
+        """
+        Caching tile proxy: tiles are served from a size-bounded on-disk LRU
+        and fetched from the upstream only on a miss. Concurrent misses on
+        the same tile share a single upstream request. Cached tiles never
+        expire, so a seeded area keeps working while the uplink is down.
+
+        Misses are bounded so a slow or dead upstream can't tie up the
+        server: at most max_upstream requests go upstream at once, a miss
+        gives up after slot_wait seconds without a free slot, and a tile
+        whose fetch failed is refused for failure_ttl seconds without asking
+        the upstream again.
+
+        Args:
+            cache_dir (str): Directory of the tile files
+            upstream: Object with fetch(layer, z, x, y) -> bytes raising TileUnavailable
+            layers (dict): Served layers, see TILE_LAYERS
+            max_bytes (int): Size bound of the on-disk cache
+            max_upstream (int): Concurrent upstream requests
+            slot_wait (float): Seconds a miss waits for an upstream slot
+            failure_ttl (float): Seconds a failed fetch is remembered
+        """
+        self.layers = layers
+        self.upstream = upstream
+        self.cache = DiskLRUCache(cache_dir, max_bytes=max_bytes)
+        self.slot_wait = slot_wait
+        self.failure_ttl = failure_ttl
+        self._flights = SingleFlight()
+        self._slots = threading.BoundedSemaphore(max_upstream)
+        self._failures = LRUCache(FAILURE_ENTRIES)  # key -> (monotonic time, message)
+        self.stats = {'hits': 0, 'misses': 0, 'upstream_errors': 0, 'failure_hits': 0, 'upstream_busy': 0}
+
+    @staticmethod
+    def key(layer, z, x, y):
+        return f"{layer}_{z}_{x}_{y}"
+
+    def validate(self, layer, z, x, y):
+        """Raise KeyError for an unknown layer, ValueError for a tile outside the layer."""
+        spec = self.layers[layer]
+        if not 0 <= z <= spec['max_zoom']:
+            raise ValueError(f"Zoom {z} out of range for {layer}")
+        if not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            raise ValueError(f"Tile {z}/{x}/{y} does not exist")
+
+    def get(self, layer, z, x, y, slot_wait=-1):
+        """
+        Return (tile bytes, content type).
+
+        Args:
+            slot_wait (float): Seconds to wait for an upstream slot on a miss;
+                               -1 for the cache's default, None to wait as long as it takes
+
+        Raises:
+            KeyError: Unknown layer
+            ValueError: Tile outside the layer
+            TileUnavailable: Not cached and the upstream failed, recently failed or is busy
+        """
+        self.validate(layer, z, x, y)
+        content_type = self.layers[layer]['content_type']
+        key = self.key(layer, z, x, y)
+        data = self.cache.get(key)
+        if data is not None:
+            self.stats['hits'] += 1
+            return data, content_type
+
+        failure = self._failures.get(key)
+        if failure is not None:
+            failed_at, message = failure
+            if time.monotonic() - failed_at < self.failure_ttl:
+                self.stats['failure_hits'] += 1
+                raise TileUnavailable(f"{message} (cached failure)")
+            self._failures.pop(key)
+
+        if slot_wait == -1:
+            slot_wait = self.slot_wait
+        return self._flights.do(key, self._fetch, layer, z, x, y, slot_wait), content_type
+
+    def _fetch(self, layer, z, x, y, slot_wait):
+        key = self.key(layer, z, x, y)
+        # The previous flight for this tile may have stored it just now
+        data = self.cache.get(key)
+        if data is not None:
+            self.stats['hits'] += 1
+            return data
+        if not self._slots.acquire(timeout=slot_wait):
+            # Busy isn't a property of the tile, so it isn't remembered as a failure
+            self.stats['upstream_busy'] += 1
+            raise TileUnavailable(f"{layer}/{z}/{x}/{y}: upstream busy")
+        try:
+            self.stats['misses'] += 1
+            try:
+                data = self.upstream.fetch(layer, z, x, y)
+            except TileUnavailable as e:
+                self.stats['upstream_errors'] += 1
+                self._failures.put(key, (time.monotonic(), str(e)))
+                raise
+        finally:
+            self._slots.release()
+        self.cache.put(key, data)
+        return data
+
+    def get_stats(self):
+        return dict(self.stats, coalesced=self._flights.coalesced, cached_tiles=len(self.cache),
+                    cached_bytes=self.cache.total_bytes)
+
+    # --------------------------------------------------------------- seeding
+
+    def seed(self, layer, bbox, min_zoom, max_zoom, workers=4, max_tiles=SEED_MAX_TILES):
+        """
+        Download every tile of a bounding box and zoom range that is not cached yet.
+
+        Args:
+            layer (str): Layer name
+            bbox (list): west, south, east, north in degrees
+            min_zoom, max_zoom (int): Zoom range, inclusive
+            workers (int): Concurrent downloads
+            max_tiles (int): Refuse to seed more tiles than this (None for no limit)
+
+        Returns:
+            dict: Counts of tiles that were cached, fetched and failed
+        """
+        if layer not in self.layers:
+            raise KeyError(layer)
+        tiles = list(tiles_in_bbox(bbox, min_zoom, min(max_zoom, self.layers[layer]['max_zoom'])))
+        if max_tiles is not None and len(tiles) > max_tiles:
+            raise ValueError(f"{len(tiles)} tiles is more than the limit of {max_tiles}")
+
+        if self.cache.max_bytes is not None and len(tiles) * TYPICAL_TILE_BYTES > self.cache.max_bytes:
+            print(f"Warning: {len(tiles)} tiles may not fit in {self.cache.max_bytes} bytes; "
+                  f"the first ones would be evicted again")
+        missing = [tile for tile in tiles if self.key(layer, *tile) not in self.cache]
+        result = {'tiles': len(tiles), 'cached': len(tiles) - len(missing), 'fetched': 0, 'failed': 0}
+
+        def fetch(tile):
+            try:
+                # Seeding may queue for upstream slots, unlike page requests
+                self.get(layer, *tile, slot_wait=None)
+                return True
+            except TileUnavailable as e:
+                logger.warning(f"Seeding {layer}/{'/'.join(map(str, tile))} failed: {e}")
+                return False
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for done, ok in enumerate(pool.map(fetch, missing), start=1):
+                result['fetched' if ok else 'failed'] += 1
+                if done % 100 == 0:
+                    print(f"  {done}/{len(missing)} tiles ({time.monotonic() - started:.0f}s)")
+        return result
+
+
+def tile_xy(lat, lon, z):
+    """Slippy map tile containing a point."""
+    lat = max(-85.05112878, min(85.05112878, lat))
+    n = 2 ** z
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_in_bbox(bbox, min_zoom, max_zoom):
+    """Yield (z, x, y) of every tile overlapping a bounding box."""
+    west, south, east, north = bbox
+    for z in range(min_zoom, max_zoom + 1):
+        x0, y0 = tile_xy(north, west, z)
+        x1, y1 = tile_xy(south, east, z)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                yield z, x, y
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pre-seed the tile cache for offline use")
+    parser.add_argument('command', choices=['seed'])
+    parser.add_argument('--layer', choices=sorted(TILE_LAYERS), default='osm')
+    parser.add_argument('--bbox', required=True, help="west,south,east,north")
+    parser.add_argument('--zoom', default='3-12', help="zoom range, e.g. 3-12")
+    parser.add_argument('--cache-dir', default='tile_cache')
+    parser.add_argument('--max-bytes', type=int, default=512 * 1024 * 1024)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--force', action='store_true', help=f"allow more than {SEED_MAX_TILES} tiles")
+    args = parser.parse_args()
+
+    min_zoom, _, max_zoom = args.zoom.partition('-')
+    tile_cache = TileCache(args.cache_dir, upstream_from_env(), max_bytes=args.max_bytes)
+    summary = tile_cache.seed(args.layer, [float(v) for v in args.bbox.split(',')], int(min_zoom),
+                              int(max_zoom or min_zoom), workers=args.workers,
+                              max_tiles=None if args.force else SEED_MAX_TILES)
+    print(f"Seeded {args.layer}: {summary}")
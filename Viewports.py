@@ -0,0 +1,236 @@
+import time
+import threading
+from collections import OrderedDict
+
+AGGREGATIONS = ('union', 'intersection', 'primary')
+
+
+class ViewportOutOfSync(Exception):
+    """A delta doesn't follow the session's last sequence number; the client must resend its full viewport."""
+
+    def __init__(self, client_id, last_seq):
+        super().__init__(f"Viewport of {client_id} is out of sync (last seq {last_seq})")
+        self.last_seq = last_seq
+
+
+class ViewportSessions:
+    def __init__(self, ttl=30.0, mode='union'):
+        """
+        Visible markers per browser session, aggregated for the LED bridge.
+
+        Each session keeps the set of marker ids in its viewport. A per-marker
+        count of the sessions showing it (and the markers bucketed by that
+        count) is kept up to date on every change, so union, intersection and
+        "primary client" all cost O(changed ids) to maintain.
+
+        Sessions that stop reporting are evicted after ttl seconds.
+
+        Args:
+            ttl (float): Seconds without an update before a session is dropped
+            mode (str): Default aggregation, one of AGGREGATIONS
+        """
+        if mode not in AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation: {mode}")
+        self.ttl = ttl
+        self.mode = mode
+        self.version = 0  # bumped whenever the aggregate in self.mode changes
+
+        self._sessions = OrderedDict()  # client_id -> set of marker ids, least recently seen first
+        self._last_seen = {}
+        self._seqs = {}  # client_id -> last applied sequence number
+        self._joined = {}  # live sessions in join order, the oldest is the primary
+        self._primary_claim = None
+        self._counts = {}  # marker_id -> sessions showing it
+        self._by_count = {}  # count -> set of marker ids
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    # ------------------------------------------------------------- updates
+
+    def update(self, client_id, marker_ids, primary=False, seq=None):
+        """
+        Replace a session's visible markers (a full resync when seq is given).
+
+        Returns:
+            bool: True if the aggregate in the default mode changed
+        """
+        marker_ids = set(marker_ids)
+        with self._lock:
+            old = self._sessions.get(client_id, set())
+            changed = self._apply_locked(client_id, marker_ids - old, old - marker_ids, primary)
+            self._seqs[client_id] = seq
+            return changed
+
+    def apply(self, client_id, added=(), removed=(), primary=False, seq=None):
+        """
+        Add and remove marker ids from a session's viewport.
+
+        With a seq the delta must follow the last one applied: a repeat of an
+        already applied seq is ignored, a gap (or an unknown session) raises
+        ViewportOutOfSync.
+
+        Returns:
+            bool: True if the aggregate in the default mode changed
+        """
+        with self._lock:
+            if seq is not None:
+                last_seq = self._seqs.get(client_id)
+                if last_seq is None or seq > last_seq + 1:
+                    raise ViewportOutOfSync(client_id, last_seq)
+                if seq <= last_seq:
+                    self._touch_locked(client_id)
+                    return False
+                self._seqs[client_id] = seq
+            return self._apply_locked(client_id, set(added), set(removed), primary)
+
+    def touch(self, client_id, seq=None):
+        """
+        Keep a session alive without changing it (heartbeat).
+
+        Raises:
+            ViewportOutOfSync: The session is unknown (e.g. it expired) or behind seq
+        """
+        with self._lock:
+            last_seq = self._seqs.get(client_id)
+            if client_id not in self._sessions or (seq is not None and last_seq != seq):
+                raise ViewportOutOfSync(client_id, last_seq)
+            self._touch_locked(client_id)
+
+    def remove(self, client_id):
+        """Drop a session (e.g. the tab was closed). Returns True if the aggregate changed."""
+        with self._lock:
+            return self._drop_locked(client_id)
+
+    def expire(self, now=None):
+        """Drop sessions not seen for ttl seconds. Returns True if the aggregate changed."""
+        now = time.monotonic() if now is None else now
+        changed = False
+        with self._lock:
+            while self._sessions:
+                client_id = next(iter(self._sessions))
+                if now - self._last_seen[client_id] < self.ttl:
+                    break
+                changed |= self._drop_locked(client_id)
+        return changed
+
+    def _apply_locked(self, client_id, added, removed, primary):
+        changed = False
+        if client_id not in self._sessions:
+            self._sessions[client_id] = set()
+            self._joined[client_id] = True
+            # Another session means another count to reach for the intersection
+            changed |= self.mode == 'intersection'
+            changed |= self.mode == 'primary' and self._primary_locked() == client_id
+        self._touch_locked(client_id)
+
+        if primary and self._primary_claim != client_id:
+            self._primary_claim = client_id
+            changed |= self.mode == 'primary'
+
+        viewport = self._sessions[client_id]
+        removed &= viewport
+        added -= viewport
+        viewport -= removed
+        viewport |= added
+        is_primary = self._primary_locked() == client_id
+
+        for marker_id in removed:
+            count = self._move_locked(marker_id, -1)
+            changed |= self._changes_aggregate(count + 1, count, is_primary)
+        for marker_id in added:
+            count = self._move_locked(marker_id, 1)
+            changed |= self._changes_aggregate(count - 1, count, is_primary)
+
+        if changed:
+            self.version += 1
+        return changed
+
+    def _drop_locked(self, client_id):
+        if client_id not in self._sessions:
+            return False
+        was_primary = self._primary_locked() == client_id
+        viewport = self._sessions.pop(client_id)
+        del self._last_seen[client_id]
+        del self._joined[client_id]
+        self._seqs.pop(client_id, None)
+        if self._primary_claim == client_id:
+            self._primary_claim = None
+
+        changed = self.mode == 'intersection' or (self.mode == 'primary' and was_primary)
+        for marker_id in viewport:
+            count = self._move_locked(marker_id, -1)
+            changed |= self.mode == 'union' and count == 0
+
+        if changed:
+            self.version += 1
+        return changed
+
+    def _touch_locked(self, client_id):
+        self._last_seen[client_id] = time.monotonic()
+        self._sessions.move_to_end(client_id)
+
+    def _move_locked(self, marker_id, delta):
+        """Change a marker's session count and re-bucket it; returns the new count."""
+        old = self._counts.get(marker_id, 0)
+        new = old + delta
+        if old:
+            bucket = self._by_count[old]
+            bucket.discard(marker_id)
+            if not bucket:
+                del self._by_count[old]
+        if new:
+            self._counts[marker_id] = new
+            self._by_count.setdefault(new, set()).add(marker_id)
+        else:
+            self._counts.pop(marker_id, None)
+        return new
+
+    def _changes_aggregate(self, old_count, new_count, is_primary):
+        if self.mode == 'union':
+            return (old_count == 0) != (new_count == 0)
+        if self.mode == 'intersection':
+            sessions = len(self._sessions)
+            return old_count == sessions or new_count == sessions
+        return is_primary
+
+    # ------------------------------------------------------------- queries
+
+    @property
+    def primary_client(self):
+        """The session that claimed primary, otherwise the oldest live one."""
+        with self._lock:
+            return self._primary_locked()
+
+    def _primary_locked(self):
+        if self._primary_claim in self._sessions:
+            return self._primary_claim
+        return next(iter(self._joined), None)
+
+    def visible(self, mode=None):
+        """Return the aggregated set of visible marker ids."""
+        mode = mode or self.mode
+        if mode not in AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation: {mode}")
+        with self._lock:
+            if mode == 'union':
+                return set(self._counts)
+            if mode == 'intersection':
+                return set(self._by_count.get(len(self._sessions), ())) if self._sessions else set()
+            primary = self._primary_locked()
+            return set(self._sessions[primary]) if primary is not None else set()
+
+    def session(self, client_id):
+        with self._lock:
+            return set(self._sessions.get(client_id, ()))
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'mode': self.mode,
+                'version': self.version,
+                'primary_client': self._primary_locked(),
+                'visible_union': len(self._counts)
+            }
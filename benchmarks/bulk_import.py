@@ -0,0 +1,133 @@
+"""
+Bulk NDJSON import/export throughput benchmark.
+
+Starts Map.py in production mode on a copy of the app (or targets a running
+server with --url), imports --rows generated markers through
+/api/markers/import, streams them back from /api/markers/export and, for
+comparison, adds --single markers one at a time through /add_marker.
+
+    python benchmarks/bulk_import.py --rows 50000 --backend sqlite
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import spawn_server  # noqa: E402
+
+
+def generate_rows(count, first_number, memory_every):
+    for i in range(count):
+        row = {
+            'lat': (i * 0.0137) % 170 - 85.0,
+            'lon': (i * 0.0291) % 350 - 175.0,
+            'popup_text': f"Imported {i}",
+            'color': ('red', 'green', 'blue', 'orange')[i % 4],
+            'marker_number': first_number + i
+        }
+        if memory_every and i % memory_every == 0:
+            row['memory_text'] = f"memory of imported marker {i}"
+        yield (json.dumps(row) + '\n').encode('utf-8')
+
+
+def import_rows(url, rows, first_number, memory_every):
+    """
+    POST `rows` generated markers to /api/markers/import.
+
+    Returns:
+        tuple: (rows imported, seconds taken)
+    """
+    started = time.perf_counter()
+    # A generator body is sent with chunked encoding, never built in memory
+    response = requests.post(f"{url}/api/markers/import", data=generate_rows(rows, first_number, memory_every),
+                             headers={'Content-Type': 'application/x-ndjson'}, timeout=600)
+    elapsed = time.perf_counter() - started
+    response.raise_for_status()
+    return response.json()['imported'], elapsed
+
+
+def run(url, rows, single, memory_every):
+    result = {'rows': rows}
+
+    imported, elapsed = import_rows(url, rows, 100000, memory_every)
+    result.update(import_seconds=round(elapsed, 3), import_rows_per_second=round(rows / elapsed, 1),
+                  imported=imported)
+
+    started = time.perf_counter()
+    exported = 0
+    exported_bytes = 0
+    with requests.get(f"{url}/api/markers/export", stream=True, timeout=600) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                exported += 1
+                exported_bytes += len(line) + 1
+    elapsed = time.perf_counter() - started
+    result.update(export_seconds=round(elapsed, 3), export_rows_per_second=round(exported / elapsed, 1),
+                  exported=exported, export_bytes=exported_bytes)
+
+    if single:
+        session = requests.Session()
+        started = time.perf_counter()
+        for i in range(single):
+            session.post(f"{url}/add_marker", json={'lat': 10.0, 'lon': i * 0.001, 'popup_text': f"Single {i}",
+                                                    'marker_number': None}, timeout=30).raise_for_status()
+        elapsed = time.perf_counter() - started
+        result.update(single_rows_per_second=round(single / elapsed, 1))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', help="target a running server instead of spawning one")
+    parser.add_argument('--rows', type=int, default=20000, help="markers per import")
+    parser.add_argument('--single', type=int, default=500, help="markers added one by one for comparison")
+    parser.add_argument('--memory-every', type=int, default=10, help="give every Nth row a text memory (0: none)")
+    parser.add_argument('--backend', choices=('json', 'sqlite'), default='json',
+                        help="storage backend of the spawned server")
+    parser.add_argument('--json', action='store_true', help="print the result as JSON")
+    args = parser.parse_args()
+
+    workdir = process = None
+    url = args.url
+    if url is None:
+        workdir = tempfile.mkdtemp(prefix='map_bulk_')
+        process, url = spawn_server(workdir, 4, args.backend)
+
+    try:
+        result = run(url.rstrip('/'), args.rows, args.single, args.memory_every)
+    finally:
+        if process:
+            process.terminate()
+            process.wait(timeout=10)
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    problems = []
+    if result['imported'] != args.rows:
+        problems.append(f"imported {result['imported']} of {args.rows} rows")
+    # A spawned server starts empty and is exported before the single adds
+    if workdir and result['exported'] != args.rows:
+        problems.append(f"exported {result['exported']} rows, expected {args.rows}")
+    result['problems'] = problems
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for key, value in result.items():
+            if key != 'problems':
+                print(f"{key:>24}: {value}")
+        for problem in problems:
+            print(f"    {problem}")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+"""
+Concurrent-writer load test for the map server.
+
+Starts Map.py in production mode on a copy of the app in a temp directory
+(or targets a running server with --url), then hammers it with writer
+threads that add, edit, annotate and delete markers while reader threads
+query /api/markers. Afterwards it checks that every acknowledged write is
+visible through the API and, for a spawned server, in the persisted store.
+
+    python benchmarks/load_test.py --writers 16 --ops 50 --threads 8
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import requests
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+from Storage import load_store  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def copy_app(workdir):
+    """Copy the app's modules, page script and static files into workdir."""
+    for name in os.listdir(APP_DIR):
+        if name.endswith('.py') or name in ('context_menu.js', 'static'):
+            src = os.path.join(APP_DIR, name)
+            if os.path.isdir(src):
+                shutil.copytree(src, os.path.join(workdir, name))
+            else:
+                shutil.copy(src, workdir)
+
+
+def spawn_server(workdir, threads, backend):
+    """Copy the app into workdir and start it in production mode."""
+    copy_app(workdir)
+
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, 'Map.py', '--production', '--no-arduino', '--host', '127.0.0.1',
+         '--port', str(port), '--threads', str(threads)],
+        cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        env=dict(os.environ, MAP_STORAGE_BACKEND=backend))
+
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get(f"{url}/api/markers", params={'bbox': '0,0,0,0'}, timeout=1)
+            return process, url
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("Server did not start")
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class LoadTest:
+    def __init__(self, url, writers, ops, readers):
+        self.url = url
+        self.writers = writers
+        self.ops = ops
+        self.readers = readers
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = []
+        self.expected = {}  # marker_id -> {'popup_text', 'color', 'marker_number', 'memory'}
+        self.deleted = set()
+        self._stop_readers = threading.Event()
+
+    def call(self, method, path, **kwargs):
+        started = time.perf_counter()
+        response = requests.request(method, self.url + path, timeout=30, **kwargs)
+        with self.lock:
+            self.latencies.append(time.perf_counter() - started)
+        return response
+
+    def writer(self, writer_index):
+        for op in range(self.ops):
+            # Numbers are unique per writer/op, so every add must succeed
+            marker_number = 1000 + writer_index * self.ops + op
+            response = self.call('POST', '/add_marker', json={
+                'lat': (writer_index * 7 + op) % 170 - 85.0,
+                'lon': (writer_index * 13 + op * 3) % 350 - 175.0,
+                'popup_text': f"W{writer_index} op {op}",
+                'color': 'red',
+                'marker_number': marker_number
+            })
+            if response.status_code != 200:
+                self.errors.append(f"add {writer_index}/{op}: {response.status_code} {response.text[:200]}")
+                continue
+            marker_id = response.json()['marker_id']
+            expected = {'popup_text': f"W{writer_index} op {op}", 'color': 'red',
+                        'marker_number': marker_number, 'memory': None}
+
+            response = self.call('POST', '/edit_marker', json={
+                'marker_id': marker_id, 'popup_text': f"W{writer_index} op {op} edited",
+                'color': 'green', 'marker_number': marker_number})
+            if response.status_code == 200:
+                expected.update(popup_text=f"W{writer_index} op {op} edited", color='green')
+            else:
+                self.errors.append(f"edit {marker_id}: {response.status_code} {response.text[:200]}")
+
+            response = self.call('POST', '/add_memory', json={'marker_id': marker_id,
+                                                               'memory_text': f"memory {marker_id}"})
+            if response.status_code == 200:
+                expected['memory'] = f"memory {marker_id}"
+            else:
+                self.errors.append(f"memory {marker_id}: {response.status_code}")
+
+            if op % 3 == 2:
+                response = self.call('POST', '/delete_marker', json={'marker_id': marker_id})
+                if response.status_code == 200:
+                    with self.lock:
+                        self.deleted.add(marker_id)
+                    continue
+                self.errors.append(f"delete {marker_id}: {response.status_code}")
+
+            with self.lock:
+                self.expected[marker_id] = expected
+
+    def reader(self):
+        while not self._stop_readers.is_set():
+            response = self.call('GET', '/api/markers', params={'bbox': '-180,-90,180,90'})
+            if response.status_code != 200:
+                self.errors.append(f"read: {response.status_code}")
+
+    def run(self):
+        readers = [threading.Thread(target=self.reader) for _ in range(self.readers)]
+        writers = [threading.Thread(target=self.writer, args=(i,)) for i in range(self.writers)]
+        started = time.perf_counter()
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        self._stop_readers.set()
+        for thread in readers:
+            thread.join()
+        return time.perf_counter() - started
+
+    def verify_api(self):
+        """Every acknowledged write is visible, nothing deleted came back."""
+        problems = []
+        markers = {m['id']: m for m in self.call('GET', '/api/markers',
+                                                 params={'bbox': '-180,-90,180,90'}).json()['markers']}
+        for marker_id, expected in self.expected.items():
+            marker = markers.get(marker_id)
+            if marker is None:
+                problems.append(f"missing {marker_id}")
+            elif (marker['name'], marker['color'], marker['marker_number']) != (
+                    expected['popup_text'], expected['color'], expected['marker_number']):
+                problems.append(f"wrong data for {marker_id}: {marker['name']}, {marker['color']}")
+        problems += [f"deleted marker {marker_id} is back" for marker_id in self.deleted if marker_id in markers]
+        numbers = [m['marker_number'] for m in markers.values() if m['marker_number'] is not None]
+        if len(numbers) != len(set(numbers)):
+            problems.append("duplicate marker numbers")
+        return problems
+
+    def verify_store(self, snapshot_path):
+        """The persisted store (snapshot + journal) matches what the API acknowledged."""
+        problems = []
+        store = load_store(snapshot_path)
+        for marker_id, expected in self.expected.items():
+            marker = store['markers'].get(marker_id)
+            if marker is None:
+                problems.append(f"not persisted: {marker_id}")
+                continue
+            if (marker['popup_text'], marker['color']) != (expected['popup_text'], expected['color']):
+                problems.append(f"stale persisted data for {marker_id}")
+            memory = store['memories'].get(marker_id)
+            if expected['memory'] is not None and (memory or {}).get('size') != len(expected['memory'].encode()):
+                problems.append(f"memory not persisted for {marker_id}")
+        for marker_id in self.deleted:
+            if marker_id in store['markers'] or marker_id in store['memories']:
+                problems.append(f"deleted marker {marker_id} persisted")
+        return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', help="target a running server instead of spawning one")
+    parser.add_argument('--writers', type=int, default=16)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--ops', type=int, default=30, help="markers added per writer")
+    parser.add_argument('--threads', type=int, default=8, help="server worker threads (spawned server)")
+    parser.add_argument('--backend', choices=('json', 'sqlite'), default='json',
+                        help="storage backend of the spawned server")
+    parser.add_argument('--json', action='store_true', help="print the result as JSON")
+    args = parser.parse_args()
+
+    workdir = process = None
+    url = args.url
+    if url is None:
+        workdir = tempfile.mkdtemp(prefix='map_load_')
+        process, url = spawn_server(workdir, args.threads, args.backend)
+
+    try:
+        test = LoadTest(url.rstrip('/'), args.writers, args.ops, args.readers)
+        elapsed = test.run()
+        problems = test.errors + test.verify_api()
+        if workdir:
+            store_file = 'server_storage.db' if args.backend == 'sqlite' else 'server_storage.json'
+            problems += test.verify_store(os.path.join(workdir, store_file))
+    finally:
+        if process:
+            process.terminate()
+            process.wait(timeout=10)
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        'requests': len(test.latencies),
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(test.latencies) / elapsed, 1),
+        'p50_ms': round(percentile(test.latencies, 0.5) * 1000, 2),
+        'p95_ms': round(percentile(test.latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(test.latencies, 0.99) * 1000, 2),
+        'markers_kept': len(test.expected),
+        'markers_deleted': len(test.deleted),
+        'problems': problems
+    }
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for key, value in result.items():
+            if key != 'problems':
+                print(f"{key:>20}: {value}")
+        print(f"{'problems':>20}: {len(problems)}")
+        for problem in problems[:20]:
+            print(f"    {problem}")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
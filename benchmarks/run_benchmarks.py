@@ -0,0 +1,424 @@
+"""
+Reproducible benchmark suite for the server's hot paths.
+
+For every store size a synthetic server_storage.json (markers with colors
+and numbers, every --memory-every-th one with a text memory blob) is
+generated from a fixed seed in a copy of the app. A fresh Python process
+then imports Map there and times:
+
+  import_map           module import
+  load_data            Map.load_data(): storage load and index builds
+  index_render         GET / after dropping the page cache (index() end to end)
+  index_cached         GET / served from the page cache
+  save_storage         Map.save_storage() to a separate export file
+  storage_load         Storage.load_store() of the store
+  icon_cold/icon_warm  get_colored_marker_icon() with an empty / a warm icon cache
+  visible_full_sync    POST /visible_markers with a whole viewport of ids
+  visible_delta        POST /visible_markers with a small added/removed delta
+  api_visible_markers  GET /api/visible_markers
+  regular_packet       Arduino.create_regular_packet()
+  memory_packet        Arduino.create_memory_packet()
+
+and, running `Map.py --production` there, the startup time until the
+server answers HTTP (startup_bind) and until it serves markers
+(startup_ready). Finally, as bulk_import_json and bulk_import_sqlite,
+the size's worth of generated rows is imported through /api/markers/import
+into an empty server of each storage backend, reported in records/s.
+
+Results are written as JSON (--output); pass an earlier result file as
+--compare to report regressions between commits.
+
+    python benchmarks/run_benchmarks.py --sizes 100,10000,100000 --output before.json
+    python benchmarks/run_benchmarks.py --sizes 100,10000,100000 --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime, timezone
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import APP_DIR, copy_app, free_port, spawn_server  # noqa: E402
+from bulk_import import import_rows  # noqa: E402
+
+DEFAULT_SIZES = '100,1000,10000'
+COLORS = ('blue', 'red', 'green', '#ff5733', '#33a1ff', '#8e44ad', '#2ecc71', '#f1c40f')
+VIEWPORT_SIZE = 500  # marker ids sent by the visible marker benchmarks
+DELTA_SIZE = 10  # ids added/removed per delta
+PACKET_CALLS = 10000  # packet builds per timed run
+STARTUP_TIMEOUT = 600.0  # seconds a server may take to load the largest stores
+
+
+def marker_id_for(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def generate_store(workdir, count, memory_every, seed=0):
+    """
+    Write a synthetic store of `count` markers into workdir: server_storage.json
+    plus the memory blobs. The JSON is streamed, so even 1M markers are never
+    held in memory at once.
+
+    Returns:
+        int: Number of memories written
+    """
+    rng = random.Random(seed)
+    blob_root = os.path.join(workdir, 'memory_blobs')
+    memories = {}
+
+    with open(os.path.join(workdir, 'server_storage.json'), 'w', encoding='utf-8') as f:
+        f.write('{"markers": {')
+        for i in range(count):
+            marker_id = marker_id_for(rng)
+            marker = {
+                'lat': round(rng.uniform(-85.0, 85.0), 6),
+                'lon': round(rng.uniform(-180.0, 180.0), 6),
+                'popup_text': f"Marker {i + 1} ({i + 1})",
+                'tooltip_text': None,
+                'color': COLORS[i % len(COLORS)],
+                'marker_number': i + 1
+            }
+            f.write(('' if i == 0 else ', ') + json.dumps(marker_id) + ': ' + json.dumps(marker))
+
+            if memory_every and i % memory_every == 0:
+                data = f"Memory of marker {i + 1}: {rng.getrandbits(64):016x}\n".encode('utf-8') * 8
+                blob_hash = hashlib.sha256(data).hexdigest()
+                # Written straight into the content-addressed layout of Blobs.BlobStore
+                blob_dir = os.path.join(blob_root, blob_hash[:2])
+                os.makedirs(blob_dir, exist_ok=True)
+                with open(os.path.join(blob_dir, blob_hash), 'wb') as blob:
+                    blob.write(data)
+                memories[marker_id] = {'blob': blob_hash, 'size': len(data),
+                                       'content_type': 'text/plain; charset=utf-8', 'filename': None}
+        f.write('}, "paths": {}, "memories": ')
+        json.dump(memories, f)
+        f.write('}')
+    return len(memories)
+
+
+# ------------------------------------------------------------------ child
+
+
+def measure(fn, repeat, number=1):
+    """Time `repeat` runs of `number` calls of fn; returns milliseconds per call."""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - started) * 1000.0 / number)
+    result = {'median_ms': round(statistics.median(times), 4), 'min_ms': round(min(times), 4),
+              'runs': repeat}
+    if number > 1:
+        result['calls_per_run'] = number
+        result['ops_per_second'] = round(1000.0 / statistics.median(times), 1)
+    return result
+
+
+def run_child(workdir, repeat, heavy_repeat, result_path):
+    """Import Map in workdir and run every benchmark against it."""
+    os.chdir(workdir)
+    sys.path.insert(0, workdir)
+    results = {}
+
+    started = time.perf_counter()
+    import Map
+    elapsed = (time.perf_counter() - started) * 1000.0
+    results['import_map'] = {'median_ms': round(elapsed, 4), 'min_ms': round(elapsed, 4), 'runs': 1}
+    results['load_data'] = measure(Map.load_data, 1)
+
+    from Arduino import Arduino
+    from Icons import IconCache
+    from Storage import load_store
+
+    client = Map.app.test_client()
+
+    def render_index():
+        Map._page_cache.clear()
+        assert client.get('/', headers={'Accept-Encoding': 'gzip'}).status_code == 200
+
+    results['index_render'] = measure(render_index, heavy_repeat)
+    results['index_cached'] = measure(
+        lambda: client.get('/', headers={'Accept-Encoding': 'gzip'}).status_code, repeat)
+
+    store_path = Map.STORAGE_DB_FILE if Map.STORAGE_BACKEND == 'sqlite' else Map.STORAGE_FILE
+    export_path = os.path.join(workdir, 'benchmark_export.json')
+    results['save_storage'] = measure(lambda: Map.save_storage(export_path), heavy_repeat)
+    results['storage_load'] = measure(lambda: load_store(store_path), heavy_repeat)
+
+    original_cache = Map.icon_cache
+    icon_dirs = iter(range(repeat))
+
+    def cold_icon():
+        Map.icon_cache = IconCache(os.path.join(workdir, f"benchmark_icons_{next(icon_dirs)}"))
+        Map.get_colored_marker_icon('#123456')
+
+    results['icon_cold'] = measure(cold_icon, repeat)
+    Map.icon_cache = original_cache
+    Map.get_colored_marker_icon('#123456')
+    results['icon_warm'] = measure(lambda: Map.get_colored_marker_icon('#123456'), repeat, number=1000)
+
+    marker_ids = []
+    for marker_id in Map.storage.keys('markers'):
+        marker_ids.append(marker_id)
+        if len(marker_ids) == VIEWPORT_SIZE + DELTA_SIZE:
+            break
+    viewport = marker_ids[:VIEWPORT_SIZE]
+    spare = marker_ids[VIEWPORT_SIZE:] or marker_ids[:DELTA_SIZE]
+    state = {'seq': 0, 'shown': False}
+
+    def full_sync():
+        state['seq'] += 1
+        state['shown'] = False
+        response = client.post('/visible_markers', json={'client_id': 'benchmark', 'seq': state['seq'],
+                                                         'visible_ids': viewport})
+        assert response.status_code in (200, 204), response.status_code
+
+    def delta():
+        state['seq'] += 1
+        change = 'removed' if state['shown'] else 'added'
+        state['shown'] = not state['shown']
+        response = client.post('/visible_markers', json={'client_id': 'benchmark', 'seq': state['seq'],
+                                                         change: spare})
+        assert response.status_code in (200, 204), response.status_code
+
+    results['visible_full_sync'] = measure(full_sync, repeat)
+    results['visible_delta'] = measure(delta, repeat, number=20)
+    results['api_visible_markers'] = measure(
+        lambda: client.get('/api/visible_markers').status_code, repeat)
+
+    logging.getLogger('Arduino').setLevel(logging.WARNING)
+    arduino = Arduino(None, None, 'BENCHMARK', 115200, color_table=Map.marker_color_table)
+    arduino.refresh_marker_colors()
+    lit = list(range(1, 17))
+    trigger = Map.create_memory_view_array(viewport[0], '#123456', 1) if viewport else [0] * 50
+    results['regular_packet'] = measure(lambda: arduino.create_regular_packet(lit), repeat, number=PACKET_CALLS)
+    results['memory_packet'] = measure(lambda: arduino.create_memory_packet(trigger), repeat, number=PACKET_CALLS)
+
+    with open(result_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f)
+
+
+# ----------------------------------------------------------------- parent
+
+
+def measure_startup(workdir, backend, repeat):
+    """Start the server `repeat` times; milliseconds until it answers HTTP and until it serves markers."""
+    bind_times = []
+    ready_times = []
+    for _ in range(repeat):
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        started = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, 'Map.py', '--production', '--no-arduino', '--host', '127.0.0.1', '--port', str(port)],
+            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            env=dict(os.environ, MAP_STORAGE_BACKEND=backend))
+        try:
+            bound = None
+            while time.perf_counter() - started < STARTUP_TIMEOUT:
+                if process.poll() is not None:
+                    raise RuntimeError("Server exited during startup")
+                try:
+                    if bound is None:
+                        requests.get(f"{url}/metrics", timeout=1)
+                        bound = time.perf_counter()
+                    response = requests.get(f"{url}/api/markers", params={'bbox': '0,0,0,0'},
+                                            timeout=STARTUP_TIMEOUT)
+                    if response.status_code == 200:
+                        break
+                except requests.exceptions.ConnectionError:
+                    time.sleep(0.01)
+            else:
+                raise RuntimeError("Server did not start")
+            ready = time.perf_counter()
+        finally:
+            process.terminate()
+            process.wait(timeout=10)
+        bind_times.append((bound - started) * 1000.0)
+        ready_times.append((ready - started) * 1000.0)
+
+    return {name: {'median_ms': round(statistics.median(times), 4), 'min_ms': round(min(times), 4),
+                   'runs': repeat}
+            for name, times in (('startup_bind', bind_times), ('startup_ready', ready_times))}
+
+
+def measure_bulk_import(count, backend, memory_every, repeat):
+    """Import `count` rows into a fresh server `repeat` times; milliseconds per import and records/s."""
+    times = []
+    for _ in range(repeat):
+        workdir = tempfile.mkdtemp(prefix=f'map_bench_import_{backend}_')
+        process = None
+        try:
+            process, url = spawn_server(workdir, 4, backend)
+            imported, seconds = import_rows(url, count, 1, memory_every)
+            if imported != count:
+                raise RuntimeError(f"Imported {imported} of {count} rows into {backend}")
+        finally:
+            if process:
+                process.terminate()
+                process.wait(timeout=10)
+            shutil.rmtree(workdir, ignore_errors=True)
+        times.append(seconds * 1000.0)
+
+    median = statistics.median(times)
+    return {'median_ms': round(median, 4), 'min_ms': round(min(times), 4), 'runs': repeat,
+            'rows': count, 'records_per_second': round(count * 1000.0 / median, 1)}
+
+
+def run_size(count, args):
+    workdir = tempfile.mkdtemp(prefix=f'map_bench_{count}_')
+    try:
+        copy_app(workdir)
+        started = time.perf_counter()
+        memories = generate_store(workdir, count, args.memory_every, seed=args.seed)
+        if args.backend == 'sqlite':
+            # Migrate up front so import_map times opening the database, not the migration
+            sys.path.insert(0, APP_DIR)
+            from Storage import migrate_json_to_sqlite
+            migrate_json_to_sqlite(os.path.join(workdir, 'server_storage.json'),
+                                   os.path.join(workdir, 'server_storage.db'))
+        generate_seconds = time.perf_counter() - started
+
+        result_path = os.path.join(workdir, 'benchmark_result.json')
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', workdir, '--repeat', str(args.repeat),
+             '--heavy-repeat', str(args.heavy_repeat), '--child-output', result_path],
+            cwd=workdir, stdout=subprocess.DEVNULL, check=True,
+            env=dict(os.environ, MAP_STORAGE_BACKEND=args.backend))
+        with open(result_path, 'r', encoding='utf-8') as f:
+            metrics = json.load(f)
+        metrics.update(measure_startup(workdir, args.backend, args.heavy_repeat))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for backend in ('json', 'sqlite'):
+        metrics[f'bulk_import_{backend}'] = measure_bulk_import(count, backend, args.memory_every,
+                                                                args.heavy_repeat)
+
+    return {'markers': count, 'memories': memories, 'generate_seconds': round(generate_seconds, 3),
+            'metrics': metrics}
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=APP_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=APP_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return commit, bool(dirty)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def compare(results, baseline, threshold, min_delta_ms):
+    """
+    Compare median times with a baseline result file. A metric regressed
+    when it is more than `threshold` slower and at least min_delta_ms, so
+    timer noise on sub-microsecond calls is not reported.
+
+    Returns:
+        list: (size, metric, baseline_ms, current_ms, ratio) of the regressions
+    """
+    regressions = []
+    print(f"\nCompared with {baseline['meta'].get('commit') or 'baseline'} "
+          f"(regression: more than {threshold:.0%} slower)")
+    print(f"{'markers':>9} {'metric':<20} {'baseline ms':>12} {'current ms':>12} {'ratio':>7}")
+    for size, current in results.items():
+        previous = baseline['results'].get(size)
+        if previous is None:
+            continue
+        for metric, values in current['metrics'].items():
+            old = previous['metrics'].get(metric)
+            if old is None or not old['median_ms']:
+                continue
+            ratio = values['median_ms'] / old['median_ms']
+            flag = ''
+            if ratio > 1 + threshold and values['median_ms'] - old['median_ms'] >= min_delta_ms:
+                flag = '  REGRESSION'
+                regressions.append((size, metric, old['median_ms'], values['median_ms'], ratio))
+            print(f"{size:>9} {metric:<20} {old['median_ms']:>12.3f} {values['median_ms']:>12.3f} "
+                  f"{ratio:>7.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help="comma separated store sizes, up to 1000000")
+    parser.add_argument('--memory-every', type=int, default=10, help="give every Nth marker a memory (0: none)")
+    parser.add_argument('--backend', choices=('json', 'sqlite'), default='json')
+    parser.add_argument('--repeat', type=int, default=7, help="timed runs of the fast benchmarks")
+    parser.add_argument('--heavy-repeat', type=int, default=3,
+                        help="timed runs of page renders, saves and loads")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the generated stores")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="earlier result file to compare with")
+    parser.add_argument('--threshold', type=float, default=0.2, help="slowdown counted as a regression")
+    parser.add_argument('--min-delta-ms', type=float, default=0.05,
+                        help="smallest slowdown in ms counted as a regression")
+    parser.add_argument('--fail-on-regression', action='store_true', help="exit with 1 on a regression")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--child-output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.repeat, args.heavy_repeat, args.child_output)
+        return
+
+    commit, dirty = git_revision()
+    report = {
+        'meta': {
+            'commit': commit,
+            'dirty': dirty,
+            'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'backend': args.backend,
+            'memory_every': args.memory_every,
+            'repeat': args.repeat,
+            'heavy_repeat': args.heavy_repeat,
+            'seed': args.seed
+        },
+        'results': {}
+    }
+
+    for size in (int(size) for size in args.sizes.split(',')):
+        print(f"Benchmarking {size} markers ({args.backend})...")
+        result = run_size(size, args)
+        report['results'][str(size)] = result
+        for metric, values in result['metrics'].items():
+            extra = ''
+            if 'ops_per_second' in values:
+                extra = f"  {values['ops_per_second']:.0f} ops/s"
+            elif 'records_per_second' in values:
+                extra = f"  {values['records_per_second']:.0f} records/s"
+            print(f"  {metric:<20} {values['median_ms']:>12.3f} ms{extra}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
+
+    regressions = []
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            regressions = compare(report['results'], json.load(f), args.threshold, args.min_delta_ms)
+        print(f"{len(regressions)} regression(s)")
+    sys.exit(1 if regressions and args.fail_on_regression else 0)
+
+
+if __name__ == '__main__':
+    main()
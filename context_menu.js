@@ -9,8 +9,39 @@ var setupAttempts = 0;
 var maxSetupAttempts = 50;
 var visibleMarkersInterval = null;
 
-// Store marker data for visibility checking
-var allMarkersData = {{MARKERS_DATA}};
+// Marker data for the markers currently in view, keyed by id (loaded from /api/markers)
+var allMarkersData = {};
+// Ids of every marker inside the view, including those drawn as part of a cluster (drives the LEDs)
+var visibleMarkerIds = {};
+var loadedMarkers = {};
+var loadedClusters = {};  // keyed by cluster id and count, so a changed count redraws it
+var markerLayer = null;
+// Clusters/markers of the whole world at the initial zoom, rendered with the page
+var initialMarkers = {{INITIAL_MARKERS}};
+var markersRequestSeq = 0;
+// GPS tracks in view, simplified by the server for the current zoom
+var pathLayer = null;
+var loadedPaths = {};  // path id -> {key, layer}
+var pathsRequestSeq = 0;
+var loadMarkersTimeout = null;
+
+// Identifies this tab's viewport to the server; kept across reloads of the same tab
+var viewportClientId = sessionStorage.getItem('viewportClientId');
+if (!viewportClientId) {
+    viewportClientId = Date.now().toString(36) + Math.random().toString(36).slice(2);
+    sessionStorage.setItem('viewportClientId', viewportClientId);
+}
+
+// Visible markers are sent as deltas against what the server last acknowledged
+var VISIBLE_DEBOUNCE_MS = 300;
+var VISIBLE_HEARTBEAT_MS = 10000;  // well inside the server's viewport TTL
+var visibleSeq = 0;
+var visibleAcked = {};  // ids the server has for this tab
+var visibleNeedsResync = true;
+var visibleInFlight = false;
+var visiblePending = false;
+var visibleLastSent = 0;
+var visibleUpdateTimeout = null;
 
 // Color options for markers
 var markerColors = {
@@ -520,6 +551,9 @@ function showEditDialog(markerId, currentText, currentColor) {
     // Handle both hex colors and predefined color names
     var displayColor = currentColor.startsWith('#') ? currentColor : getColorHex(currentColor);
 
+    // Quote the id as a JS string for the inline handler below
+    var markerIdArg = JSON.stringify(markerId).replace(/&/g, '&amp;').replace(/"/g, '&quot;');
+
     var dialog = document.createElement('div');
     dialog.id = 'editDialog';
     dialog.innerHTML = `
@@ -562,7 +596,7 @@ function showEditDialog(markerId, currentText, currentColor) {
                 </div>
 
                 <div style="text-align: center; display: flex; gap: 10px; justify-content: center;">
-                    <button onclick="saveEdit('${markerId}')" style="padding: 12px 20px; background: #28a745; color: white; border: none; border-radius: 8px; cursor: pointer; font-weight: bold;">Save</button>
+                    <button onclick="saveEdit(${markerIdArg})" style="padding: 12px 20px; background: #28a745; color: white; border: none; border-radius: 8px; cursor: pointer; font-weight: bold;">Save</button>
                     <button onclick="closeEditDialog()" style="padding: 12px 20px; border: 1px solid #ddd; border-radius: 8px; background: #f8f9fa; cursor: pointer;">Cancel</button>
                 </div>
             </div>
@@ -742,13 +776,15 @@ window.searchLocation = function() {
 
     results.innerHTML = 'Searching...';
 
-    fetch(`https://nominatim.openstreetmap.org/search?format=json&q=${encodeURIComponent(query)}&limit=3`)
+    // The server answers from its gazetteer and cache before asking Nominatim
+    fetch(`/api/geocode?q=${encodeURIComponent(query)}&limit=3`)
     .then(response => response.json())
     .then(data => {
-        if (data && data.length > 0) {
-            var result = data[0];
-            var lat = parseFloat(result.lat);
-            var lon = parseFloat(result.lon);
+        if (data.status !== 'success') throw new Error(data.message);
+        if (data.results.length > 0) {
+            var result = data.results[0];
+            var lat = result.lat;
+            var lon = result.lon;
 
             globalMap.setView([lat, lon], 12);
 
@@ -831,19 +867,65 @@ window.addMemoryPrompt = function(markerId) {
     }
 };
 
+// Attach a photo, audio clip or other file as the marker's memory
+window.addMemoryFile = function(markerId) {
+    var input = document.createElement('input');
+    input.type = 'file';
+    input.accept = 'image/*,audio/*,video/*,text/plain';
+    input.onchange = function() {
+        if (!input.files.length) return;
+        saveMapState();
+
+        var form = new FormData();
+        form.append('marker_id', markerId);
+        form.append('file', input.files[0]);
+        fetch('/add_memory', { method: 'POST', body: form })
+        .then(response => response.json())
+        .then(data => {
+            if (data.status === 'success') {
+                alert('Memory added!');
+                location.reload();
+            } else {
+                sessionStorage.removeItem('mapState');
+                alert('Error: ' + (data.message || 'Unknown error'));
+            }
+        })
+        .catch(error => {
+            console.error('Error adding memory file:', error);
+            sessionStorage.removeItem('mapState');
+            alert('Failed to add memory');
+        });
+    };
+    input.click();
+};
+
 // ======================== UPDATED MEMORY VIEW FUNCTION ========================
-window.viewMemory = function(markerId) {
+window.viewMemory = function(markerId, isFile) {
     console.log('Viewing memory for marker:', markerId);
+    var memoryUrl = '/get_memory/' + encodeURIComponent(markerId);
+
+    if (isFile) {
+        // Photos, audio, ... are streamed by the browser itself. Open them
+        // from the click itself (popup blockers allow that); the server
+        // triggers the Arduino when the content is fetched.
+        window.open(memoryUrl, '_blank');
+        return;
+    }
 
-    fetch('/get_memory/' + markerId)
+    fetch(memoryUrl + '?format=json')
     .then(response => response.json())
     .then(data => {
         if (data.status === 'success') {
             var memory = data.memory;
 
             // Display the memory to the user
-            if (memory.startsWith('http')) {
-                window.open(memory, '_blank');
+            if (memory === null) {
+                window.open(data.url, '_blank');
+            } else if (memory.startsWith('http')) {
+                // Opened after a fetch, so a popup blocker may refuse it
+                if (!window.open(memory, '_blank')) {
+                    alert('Memory: ' + memory);
+                }
             } else {
                 alert('Memory: ' + memory);
             }
@@ -882,43 +964,268 @@ function startVisibleMarkersTracking() {
     if (!globalMap) return;
 
     try {
-        updateVisibleMarkers();
+        if (!markerLayer) markerLayer = L.layerGroup().addTo(globalMap);
+        if (!pathLayer) pathLayer = L.layerGroup().addTo(globalMap);
+        loadPathsInView();
+        // The page already carries the world view at its initial zoom; only fetch for other views
+        if (initialMarkers && initialMarkers.zoom === globalMap.getZoom()) {
+            showMarkers(initialMarkers);
+        } else {
+            loadMarkersInView();
+        }
+        initialMarkers = null;
         if (visibleMarkersInterval) clearInterval(visibleMarkersInterval);
-        visibleMarkersInterval = setInterval(updateVisibleMarkers, 1000);
-        globalMap.on('moveend', updateVisibleMarkers);
-        globalMap.on('zoomend', updateVisibleMarkers);
+        visibleMarkersInterval = setInterval(updateVisibleMarkers, VISIBLE_HEARTBEAT_MS);
+        globalMap.on('moveend', scheduleLoadMarkers);
+        globalMap.on('zoomend', scheduleLoadMarkers);
+        // Let the server drop this tab's viewport now instead of waiting for it to expire
+        window.addEventListener('pagehide', function() {
+            navigator.sendBeacon('/visible_markers/close', JSON.stringify({ client_id: viewportClientId }));
+        });
     } catch (error) {
         console.error('Error starting visible markers tracking:', error);
     }
 }
 
+function scheduleLoadMarkers() {
+    if (loadMarkersTimeout) clearTimeout(loadMarkersTimeout);
+    loadMarkersTimeout = setTimeout(function() {
+        loadMarkersInView();
+        loadPathsInView();
+    }, 150);
+}
+
+// Ask the server which markers are inside the current view and sync the marker layer
+function loadMarkersInView() {
+    if (!globalMap) return;
+
+    var bounds = globalMap.getBounds();
+    var bbox = [bounds.getWest(), bounds.getSouth(), bounds.getEast(), bounds.getNorth()]
+        .map(v => v.toFixed(6)).join(',');
+    var requestSeq = ++markersRequestSeq;
+
+    fetch('/api/markers?bbox=' + bbox + '&zoom=' + globalMap.getZoom())
+    .then(response => response.json())
+    .then(data => {
+        // Ignore responses that were overtaken by a newer view
+        if (requestSeq !== markersRequestSeq || data.status !== 'success') return;
+        showMarkers(data);
+    })
+    .catch(error => {
+        console.log('Loading markers failed:', error);
+    });
+}
+
+// Sync the marker layer with a /api/markers response: add what is new, drop what left the view
+function showMarkers(data) {
+    var inView = {};
+    data.markers.forEach(marker => {
+        inView[marker.id] = marker;
+        if (!loadedMarkers[marker.id]) {
+            loadedMarkers[marker.id] = createMapMarker(marker).addTo(markerLayer);
+        }
+    });
+
+    for (var id in loadedMarkers) {
+        if (!inView[id]) {
+            markerLayer.removeLayer(loadedMarkers[id]);
+            delete loadedMarkers[id];
+        }
+    }
+
+    var clustersInView = {};
+    (data.clusters || []).forEach(cluster => {
+        var key = cluster.id + ':' + cluster.count;
+        clustersInView[key] = true;
+        if (!loadedClusters[key]) {
+            loadedClusters[key] = createClusterMarker(cluster).addTo(markerLayer);
+        }
+    });
+
+    for (var key in loadedClusters) {
+        if (!clustersInView[key]) {
+            markerLayer.removeLayer(loadedClusters[key]);
+            delete loadedClusters[key];
+        }
+    }
+
+    allMarkersData = inView;
+    // Markers folded into clusters are still in view, so the LEDs use every id in the box
+    var visibleIds = {};
+    (data.visible_ids || Object.keys(inView)).forEach(id => { visibleIds[id] = true; });
+    visibleMarkerIds = visibleIds;
+    scheduleVisibleMarkersUpdate();
+}
+
+// Ask the server for the paths in view; a path is redrawn when its simplified or clipped shape changes
+function loadPathsInView() {
+    if (!globalMap || !pathLayer) return;
+
+    var bounds = globalMap.getBounds();
+    var bbox = [bounds.getWest(), bounds.getSouth(), bounds.getEast(), bounds.getNorth()]
+        .map(v => v.toFixed(6)).join(',');
+    var requestSeq = ++pathsRequestSeq;
+
+    fetch('/api/paths?bbox=' + bbox + '&zoom=' + globalMap.getZoom())
+    .then(response => response.json())
+    .then(data => {
+        if (requestSeq !== pathsRequestSeq || data.status !== 'success') return;
+
+        var inView = {};
+        data.paths.forEach(path => {
+            var key = [path.zoom, path.shown_points, path.color, path.weight, path.name,
+                       path.polylines.join(' ').length].join(':');
+            inView[path.id] = true;
+            var loaded = loadedPaths[path.id];
+            if (loaded && loaded.key === key) return;
+            if (loaded) pathLayer.removeLayer(loaded.layer);
+
+            var popup = document.createElement('div');
+            popup.textContent = path.name + ' (' + path.points + ' points)';
+            var layer = L.polyline(path.polylines.map(decodePolyline), {
+                color: path.color.charAt(0) === '#' ? path.color : getColorHex(path.color),
+                weight: path.weight,
+                opacity: 0.8
+            }).bindPopup(popup);
+            loadedPaths[path.id] = { key: key, layer: layer.addTo(pathLayer) };
+        });
+
+        for (var id in loadedPaths) {
+            if (!inView[id]) {
+                pathLayer.removeLayer(loadedPaths[id].layer);
+                delete loadedPaths[id];
+            }
+        }
+    })
+    .catch(error => {
+        console.log('Loading paths failed:', error);
+    });
+}
+
+// Decode a Google encoded polyline (precision 5) into [lat, lon] pairs
+function decodePolyline(encoded) {
+    var points = [];
+    var index = 0, lat = 0, lon = 0;
+    while (index < encoded.length) {
+        var deltas = [];
+        for (var axis = 0; axis < 2; axis++) {
+            var result = 0, shift = 0, chunk;
+            do {
+                chunk = encoded.charCodeAt(index++) - 63;
+                result |= (chunk & 0x1f) << shift;
+                shift += 5;
+            } while (chunk >= 0x20);
+            deltas.push(result & 1 ? ~(result >> 1) : result >> 1);
+        }
+        lat += deltas[0];
+        lon += deltas[1];
+        points.push([lat / 1e5, lon / 1e5]);
+    }
+    return points;
+}
+
+// A round badge with the number of markers; clicking it zooms in until the cluster splits
+function createClusterMarker(cluster) {
+    var size = cluster.count < 100 ? 30 : cluster.count < 1000 ? 36 : 44;
+    var label = cluster.count < 1000 ? cluster.count : (cluster.count / 1000).toFixed(1) + 'k';
+    var clusterMarker = L.marker([cluster.lat, cluster.lon], {
+        icon: L.divIcon({
+            html: '<div style="width:' + size + 'px;height:' + size + 'px;line-height:' + size + 'px;' +
+                  'border-radius:50%;background:rgba(49,130,189,0.85);color:white;text-align:center;' +
+                  'font:bold 12px sans-serif;box-shadow:0 0 0 4px rgba(49,130,189,0.3);">' + label + '</div>',
+            className: '',
+            iconSize: [size, size]
+        })
+    });
+    clusterMarker.bindTooltip(cluster.count + ' markers');
+    clusterMarker.on('click', function() {
+        globalMap.setView([cluster.lat, cluster.lon], Math.min(cluster.expansion_zoom, globalMap.getMaxZoom()));
+    });
+    return clusterMarker;
+}
+
+function createMapMarker(marker) {
+    var leafletMarker = L.marker([marker.lat, marker.lon], {
+        icon: L.icon({
+            iconUrl: marker.icon_url,
+            iconRetinaUrl: marker.icon_retina_url,
+            iconSize: [30, 41],
+            iconAnchor: [12, 41],
+            popupAnchor: [1, -34]
+        })
+    });
+    leafletMarker.bindPopup(marker.popup_html, { maxWidth: 300 });
+    if (marker.tooltip_text) leafletMarker.bindTooltip(marker.tooltip_text);
+    return leafletMarker;
+}
+
+function scheduleVisibleMarkersUpdate() {
+    if (visibleUpdateTimeout) clearTimeout(visibleUpdateTimeout);
+    visibleUpdateTimeout = setTimeout(updateVisibleMarkers, VISIBLE_DEBOUNCE_MS);
+}
+
+// Send the server what changed in this tab's view since its last acknowledged update.
+// Nothing is sent while nothing changes, except a small heartbeat to keep the session alive.
 function updateVisibleMarkers() {
-    if (!globalMap || !allMarkersData) return;
+    if (!globalMap || !visibleMarkerIds) return;
+    if (visibleInFlight) {
+        visiblePending = true;
+        return;
+    }
 
     try {
-        var bounds = globalMap.getBounds();
-        var visible = [];
-
-        for (var id in allMarkersData) {
-            var marker = allMarkersData[id];
-            if (bounds.contains(L.latLng(marker.lat, marker.lon))) {
-                visible.push({
-                    id: id,
-                    name: marker.name,
-                    lat: marker.lat,
-                    lon: marker.lon
-                });
-            }
+        var current = {};
+        var added = [];
+        var removed = [];
+        for (var id in visibleMarkerIds) {
+            current[id] = true;
+            if (!visibleAcked[id]) added.push(id);
+        }
+        for (var id in visibleAcked) {
+            if (!current[id]) removed.push(id);
         }
 
+        var body = { client_id: viewportClientId };
+        if (visibleNeedsResync) {
+            body.seq = ++visibleSeq;
+            body.visible_ids = Object.keys(current);
+        } else if (added.length || removed.length) {
+            body.seq = ++visibleSeq;
+            body.added = added;
+            body.removed = removed;
+        } else if (Date.now() - visibleLastSent >= VISIBLE_HEARTBEAT_MS - 500) {
+            body.seq = visibleSeq;
+        } else {
+            return;
+        }
+
+        visibleInFlight = true;
+        visibleLastSent = Date.now();
         fetch('/visible_markers', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ visible_markers: visible })
+            body: JSON.stringify(body)
+        }).then(response => {
+            if (response.ok) {
+                visibleAcked = current;
+                visibleNeedsResync = false;
+            } else {
+                // 409: the server lost or skipped our session, send the whole view next time
+                visibleNeedsResync = true;
+                visiblePending = true;
+            }
         }).catch(error => {
+            visibleNeedsResync = true;
             console.log('Visible markers update failed:', error);
+        }).finally(() => {
+            visibleInFlight = false;
+            if (visiblePending) {
+                visiblePending = false;
+                scheduleVisibleMarkersUpdate();
+            }
         });
     } catch (error) {
+        visibleInFlight = false;
         console.error('Visible markers error:', error);
     }
 }
@@ -926,22 +1233,7 @@ function updateVisibleMarkers() {
 window.getVisibleMarkers = function() {
     if (!globalMap || !allMarkersData) return [];
 
-    try {
-        var bounds = globalMap.getBounds();
-        var visible = [];
-
-        for (var id in allMarkersData) {
-            var marker = allMarkersData[id];
-            if (bounds.contains(L.latLng(marker.lat, marker.lon))) {
-                visible.push(marker);
-            }
-        }
-
-        return visible;
-    } catch (error) {
-        console.error('Error getting visible markers:', error);
-        return [];
-    }
+    return Object.values(allMarkersData);
 };
 
 // ======================== INITIALIZATION ========================
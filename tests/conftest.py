@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+# The app's modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """
+    Map.py with its data loaded from an empty store in a temporary directory.
+    Its files are relative to the working directory, so the tests run there.
+    Shared by the whole session: tests use their own ids and map areas.
+    """
+    previous = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('app'))
+    try:
+        import Map
+        Map.load_data()
+        yield Map
+    finally:
+        os.chdir(previous)
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
@@ -0,0 +1,24 @@
+def add_marker(client, marker_number):
+    return client.post('/add_marker', json={'lat': -20, 'lon': -20, 'popup_text': 'Numbered',
+                                            'marker_number': marker_number})
+
+
+def test_duplicate_number_is_rejected(client):
+    assert add_marker(client, 8001).status_code == 200
+    response = add_marker(client, 8001)
+    assert response.status_code == 409
+    assert response.json['message'] == "Marker number 8001 is already used"
+
+
+def test_failed_write_releases_the_number(app_module, client, monkeypatch):
+    def broken_put(*args, **kwargs):
+        raise OSError("disk full")
+    monkeypatch.setattr(app_module.storage, 'put', broken_put)
+
+    assert add_marker(client, 8101).status_code == 500
+    assert app_module.marker_numbers.id_of(8101) is None
+
+    monkeypatch.undo()
+    response = add_marker(client, 8101)
+    assert response.status_code == 200
+    assert app_module.marker_numbers.id_of(8101) == response.json['marker_id']
@@ -0,0 +1,37 @@
+import json
+
+from Arduino import Arduino
+
+
+def write_store(path, markers):
+    with open(path, 'w') as f:
+        json.dump({'markers': markers, 'paths': {}, 'memories': {}}, f)
+
+
+def bridge(path):
+    return Arduino('http://localhost/visible', 'http://localhost/memory', 'COM0', 9600, markers_file=str(path))
+
+
+def test_named_and_short_colors_are_normalized_like_the_map(tmp_path):
+    path = tmp_path / 'server_storage.json'
+    write_store(path, {'a': {'color': 'red', 'marker_number': 1},
+                       'b': {'color': '#0f0', 'marker_number': 2},
+                       'c': {'marker_number': 3},
+                       'd': {'color': 'purple', 'marker_number': 4}})
+    arduino = bridge(path)
+    arduino.load_marker_colors(str(path))
+
+    assert arduino.marker_colors == {1: (0xcc, 0, 0), 2: (0, 0xff, 0), 3: (0, 0x66, 0xcc), 4: (255, 255, 255)}
+
+
+def test_reload_forgets_deleted_markers(tmp_path):
+    path = tmp_path / 'server_storage.json'
+    write_store(path, {'a': {'color': 'red', 'marker_number': 1}, 'b': {'color': 'green', 'marker_number': 2}})
+    arduino = bridge(path)
+    arduino.set_marker_color_override(9, (1, 2, 3))
+    arduino.reload_marker_colors(str(path))
+
+    write_store(path, {'b': {'color': 'green', 'marker_number': 2}})
+    arduino.reload_marker_colors(str(path))
+
+    assert arduino.marker_colors == {2: (0, 0xcc, 0), 9: (1, 2, 3)}
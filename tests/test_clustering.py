@@ -0,0 +1,98 @@
+import random
+
+from Clustering import ClusterIndex, project
+
+WORLD = (-180, -85, 180, 85)
+ZOOMS = (0, 2, 5, 8, 12, 16)
+
+
+def random_markers(count, seed=0):
+    rng = random.Random(seed)
+    # Dense spots plus scattered markers, so there are clusters at every zoom
+    centers = [(rng.uniform(-60, 60), rng.uniform(-170, 170)) for _ in range(5)]
+    markers = {}
+    for i in range(count):
+        if i % 3:
+            lat, lon = rng.choice(centers)
+            lat, lon = lat + rng.gauss(0, 0.01), lon + rng.gauss(0, 0.01)
+        else:
+            lat, lon = rng.uniform(-80, 80), rng.uniform(-179, 179)
+        markers[f"m{i}"] = (lat, lon)
+    return markers
+
+
+def members_by_cell(index, markers, zoom):
+    cells = {}
+    for marker_id, (lat, lon) in markers.items():
+        cells.setdefault(index._cell_of(*project(lat, lon), zoom), set()).add(marker_id)
+    return cells
+
+
+def test_counts_sum_to_the_live_markers_at_every_zoom():
+    index = ClusterIndex()
+    markers = random_markers(600)
+    for marker_id, (lat, lon) in markers.items():
+        index.insert(marker_id, lat, lon)
+
+    rng = random.Random(1)
+    for marker_id in rng.sample(sorted(markers), 200):
+        assert index.remove(marker_id, *markers.pop(marker_id))
+    for i in range(50):
+        markers[f"late{i}"] = (rng.uniform(-80, 80), rng.uniform(-179, 179))
+        index.insert(f"late{i}", *markers[f"late{i}"])
+
+    assert len(index) == len(markers)
+    for zoom in ZOOMS:
+        clusters = index.query(*WORLD, zoom)
+        assert sum(cluster['count'] for cluster in clusters) == len(markers), zoom
+        assert len(clusters) == len(members_by_cell(index, markers, zoom)), zoom
+
+
+def test_repeated_insert_and_wrong_remove_change_nothing():
+    index = ClusterIndex()
+    index.insert('a', 10, 10)
+    index.insert('a', 10, 10)
+    assert len(index) == 1
+
+    assert not index.remove('a', 20, 20)
+    assert not index.remove('b', 10, 10)
+    assert len(index) == 1
+    assert index.remove('a', 10, 10)
+    assert len(index) == 0
+    assert index.query(*WORLD, 0) == []
+
+
+def test_expansion_zoom_is_where_a_cluster_splits():
+    index = ClusterIndex()
+    markers = random_markers(300, seed=2)
+    for marker_id, (lat, lon) in markers.items():
+        index.insert(marker_id, lat, lon)
+
+    for zoom in (0, 4, 9):
+        cells = members_by_cell(index, markers, zoom)
+        for cluster in index.query(*WORLD, zoom):
+            if cluster['count'] == 1:
+                continue
+            members = cells[tuple(int(part) for part in cluster['id'].split('/')[1:])]
+            assert len(members) == cluster['count']
+            expected = next((z for z in range(zoom + 1, index.max_zoom + 1)
+                             if len({index._cell_of(*project(*markers[m]), z) for m in members}) > 1),
+                            index.max_zoom + 1)
+            assert cluster['expansion_zoom'] == expected
+
+
+def test_single_marker_clusters_name_their_marker():
+    index = ClusterIndex()
+    index.insert('lonely', -30, 140)
+    index.insert('pair-1', 30, 10)
+    index.insert('pair-2', 30.0001, 10.0001)
+
+    clusters = {cluster['count']: cluster for cluster in index.query(*WORLD, 3)}
+    assert clusters[1]['marker_id'] == 'lonely'
+    assert (clusters[1]['lat'], clusters[1]['lon']) == (-30, 140)
+    assert 'marker_id' not in clusters[2]
+    assert clusters[2]['expansion_zoom'] > 3
+
+    index.remove('pair-2', 30.0001, 10.0001)
+    singles = sorted(cluster['marker_id'] for cluster in index.query(*WORLD, 3))
+    assert singles == ['lonely', 'pair-1']
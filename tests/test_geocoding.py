@@ -0,0 +1,107 @@
+import pytest
+
+from Geocoding import Gazetteer, Geocoder, GeocodeUnavailable
+
+PLACES = [
+    {'name': 'New York', 'display_name': 'New York, US', 'lat': 40.71, 'lon': -74.01, 'population': 8800000},
+    {'name': 'Paris', 'display_name': 'Paris, FR', 'lat': 48.86, 'lon': 2.35, 'population': 2100000},
+    {'name': 'Paris', 'display_name': 'Paris, Texas, US', 'lat': 33.66, 'lon': -95.56, 'population': 25000},
+    {'name': 'São Paulo', 'alt_names': ['Sao Paulo'], 'display_name': 'São Paulo, BR',
+     'lat': -23.55, 'lon': -46.63, 'population': 12300000},
+]
+
+YORK_UK = {'name': 'York', 'display_name': 'York, England, United Kingdom', 'lat': 53.96, 'lon': -1.08}
+NEW_YORK = {'name': 'New York', 'display_name': 'New York, United States', 'lat': 40.71, 'lon': -74.0}
+
+
+class StubUpstream:
+    """Stand-in geocoder: answers from a fixed table and records the queries."""
+
+    def __init__(self, answers=None, fail=False):
+        self.answers = answers or {}
+        self.fail = fail
+        self.queries = []
+
+    def search(self, query, limit=5):
+        self.queries.append(query)
+        if self.fail:
+            raise GeocodeUnavailable("stand-in is down")
+        return self.answers.get(query, [])[:limit]
+
+
+def make_geocoder(tmp_path, upstream):
+    return Geocoder(upstream, str(tmp_path / 'geocode'), gazetteer=Gazetteer(PLACES))
+
+
+def names(results):
+    return [result['display_name'] for result in results]
+
+
+def test_exact_name_is_answered_locally(tmp_path):
+    upstream = StubUpstream()
+    geocoder = make_geocoder(tmp_path, upstream)
+
+    results, source = geocoder.search('paris')
+
+    assert source == 'gazetteer'
+    assert names(results) == ['Paris, FR', 'Paris, Texas, US']
+    assert upstream.queries == []
+
+
+def test_exact_match_ignores_case_accents_and_alternate_names(tmp_path):
+    upstream = StubUpstream()
+    geocoder = make_geocoder(tmp_path, upstream)
+
+    assert geocoder.search('SAO PAULO')[1] == 'gazetteer'
+    assert geocoder.search('paris, texas') == ([{'name': 'Paris', 'display_name': 'Paris, Texas, US',
+                                                 'lat': 33.66, 'lon': -95.56}], 'gazetteer')
+    assert upstream.queries == []
+
+
+def test_prefix_match_is_merged_with_upstream(tmp_path):
+    upstream = StubUpstream({'york': [YORK_UK, NEW_YORK]})
+    geocoder = make_geocoder(tmp_path, upstream)
+
+    results, source = geocoder.search('york')
+
+    assert source == 'upstream'
+    assert upstream.queries == ['york']
+    # The gazetteer's New York is the upstream's New York, so it is listed once
+    assert names(results) == ['York, England, United Kingdom', 'New York, United States']
+    assert geocoder.get_stats()['merged'] == 1
+
+
+def test_local_prefix_results_fill_up_the_upstream_answer(tmp_path):
+    geocoder = make_geocoder(tmp_path, StubUpstream({'york': [YORK_UK]}))
+
+    results, _ = geocoder.search('york')
+
+    assert names(results) == ['York, England, United Kingdom', 'New York, US']
+
+
+def test_upstream_answers_are_cached(tmp_path):
+    upstream = StubUpstream({'york': [YORK_UK]})
+    geocoder = make_geocoder(tmp_path, upstream)
+    geocoder.search('york')
+
+    results, source = geocoder.search('York')
+
+    assert source == 'cache'
+    assert upstream.queries == ['york']
+    assert names(results) == ['York, England, United Kingdom', 'New York, US']
+
+
+def test_prefix_matches_are_returned_when_upstream_fails(tmp_path):
+    geocoder = make_geocoder(tmp_path, StubUpstream(fail=True))
+
+    results, source = geocoder.search('york')
+
+    assert source == 'gazetteer'
+    assert names(results) == ['New York, US']
+
+
+def test_upstream_failure_without_local_matches_raises(tmp_path):
+    geocoder = make_geocoder(tmp_path, StubUpstream(fail=True))
+
+    with pytest.raises(GeocodeUnavailable):
+        geocoder.search('atlantis')
@@ -0,0 +1,70 @@
+import json
+
+
+def import_rows(client, rows, skip_invalid=False):
+    url = '/api/markers/import' + ('?skip_invalid=1' if skip_invalid else '')
+    return client.post(url, data='\n'.join(json.dumps(row) for row in rows))
+
+
+def row(marker_id, marker_number):
+    return {'id': marker_id, 'lat': 60, 'lon': 60, 'popup_text': marker_id, 'marker_number': marker_number}
+
+
+def check(app_module, rows):
+    parsed = [(marker_id, {'marker_number': marker_number}, None) for marker_id, marker_number in rows]
+    with app_module.storage.transaction():
+        accepted, errors = app_module.check_import_numbers(parsed)
+    return [marker_id for marker_id, _, _ in accepted], {error['id']: error['message'] for error in errors}
+
+
+def test_numbers_used_twice_in_a_batch_keep_the_first_row(app_module):
+    accepted, errors = check(app_module, [('dup-a', 7001), ('dup-b', 7001), ('dup-c', 7002), ('dup-d', None)])
+
+    assert accepted == ['dup-a', 'dup-c', 'dup-d']
+    assert errors == {'dup-b': "Marker number 7001 is used twice in this import"}
+
+
+def test_number_of_a_marker_outside_the_batch_is_rejected(app_module, client):
+    assert import_rows(client, [row('owner-a', 7101)]).status_code == 200
+
+    accepted, errors = check(app_module, [('taker', 7101), ('free', 7102)])
+
+    assert accepted == ['free']
+    assert errors == {'taker': "Marker number 7101 is already used"}
+
+
+def test_replaced_markers_can_swap_numbers(app_module, client):
+    assert import_rows(client, [row('swap-a', 7201), row('swap-b', 7202)]).status_code == 200
+
+    response = import_rows(client, [row('swap-a', 7202), row('swap-b', 7201)])
+
+    assert response.status_code == 200, response.json
+    assert app_module.marker_numbers.number_of('swap-a') == 7202
+    assert app_module.marker_numbers.number_of('swap-b') == 7201
+
+
+def test_rejected_row_keeps_its_number_and_invalidates_others(app_module, client):
+    # keep-x and keep-y exist; keep-y's new row is rejected, so keep-y stays at
+    # 7302 and the row moving keep-z onto 7302 only fails in the second pass
+    assert import_rows(client, [row('keep-x', 7301), row('keep-y', 7302)]).status_code == 200
+
+    accepted, errors = check(app_module, [('keep-y', 7301), ('keep-z', 7302)])
+
+    assert accepted == []
+    assert errors == {'keep-y': "Marker number 7301 is already used",
+                      'keep-z': "Marker number 7302 is already used"}
+
+
+def test_conflicting_import_is_rejected_as_a_whole(app_module, client):
+    assert import_rows(client, [row('whole-a', 7401)]).status_code == 200
+
+    response = import_rows(client, [row('whole-b', 7402), row('whole-c', 7401)])
+    assert response.status_code == 409
+    assert [error['id'] for error in response.json['errors']] == ['whole-c']
+    assert not app_module.storage.contains('markers', 'whole-b')
+
+    response = import_rows(client, [row('whole-b', 7402), row('whole-c', 7401)], skip_invalid=True)
+    assert response.status_code == 200
+    assert response.json['imported'] == 1
+    assert app_module.marker_numbers.id_of(7401) == 'whole-a'
+    assert app_module.marker_numbers.id_of(7402) == 'whole-b'
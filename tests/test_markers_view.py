@@ -0,0 +1,38 @@
+import json
+
+
+def import_markers(client, rows):
+    response = client.post('/api/markers/import', data='\n'.join(json.dumps(row) for row in rows))
+    assert response.status_code == 200, response.json
+    return response.json
+
+
+def test_clustered_markers_stay_visible(app_module, client):
+    # More markers than CLUSTER_MIN_MARKERS in one view, so it is sent as clusters
+    count = app_module.CLUSTER_MIN_MARKERS + 50
+    ids = [f"view-{i}" for i in range(count)]
+    import_markers(client, [{'id': marker_id, 'lat': 10 + (i % 20) * 0.05, 'lon': 10 + (i // 20) * 0.05}
+                            for i, marker_id in enumerate(ids)])
+
+    data = client.get('/api/markers?bbox=9,9,12,12&zoom=3').json
+
+    assert data['clusters'], "the view should be clustered"
+    assert len(data['markers']) < count
+    assert sorted(data['visible_ids']) == sorted(ids)
+
+    # The page reports those ids, and every one of them counts as visible
+    response = client.post('/visible_markers', json={'client_id': 'cluster-tab', 'seq': 1,
+                                                     'visible_ids': data['visible_ids']})
+    assert response.status_code == 200
+    assert set(ids) <= set(app_module.viewports.visible())
+    client.post('/visible_markers/close', json={'client_id': 'cluster-tab'})
+
+
+def test_unclustered_view_lists_drawn_markers_as_visible(client):
+    import_markers(client, [{'id': 'sparse-a', 'lat': -40, 'lon': 100}, {'id': 'sparse-b', 'lat': -40.5, 'lon': 100.5}])
+
+    data = client.get('/api/markers?bbox=99,-41,101,-39&zoom=5').json
+
+    assert data['clusters'] == []
+    assert sorted(data['visible_ids']) == ['sparse-a', 'sparse-b']
+    assert sorted(marker['id'] for marker in data['markers']) == ['sparse-a', 'sparse-b']
@@ -0,0 +1,36 @@
+def add_marker(client, color, marker_number):
+    response = client.post('/add_marker', json={'lat': 5, 'lon': 5, 'popup_text': 'Memory',
+                                                'color': color, 'marker_number': marker_number})
+    assert response.status_code == 200, response.json
+    return response.json['marker_id']
+
+
+def test_unknown_color_still_serves_the_memory(app_module, client):
+    marker_id = add_marker(client, 'purple', 901)
+    client.post('/add_memory', json={'marker_id': marker_id, 'memory_text': 'hello'})
+
+    response = client.get(f'/get_memory/{marker_id}?format=json')
+    assert response.status_code == 200
+    assert response.json['memory'] == 'hello'
+
+    response = client.get(f'/get_memory/{marker_id}')
+    assert response.status_code == 200
+    assert response.data == b'hello'
+
+
+def test_unknown_color_falls_back_to_the_default_led_color(app_module):
+    default = app_module.create_memory_view_array('m', '#' + app_module.DEFAULT_LED_COLOR, 1)
+    assert app_module.create_memory_view_array('m', 'purple', 1) == default
+
+
+def test_failing_trigger_does_not_fail_the_response(app_module, client, monkeypatch):
+    marker_id = add_marker(client, 'red', 902)
+    client.post('/add_memory', json={'marker_id': marker_id, 'memory_text': 'still here'})
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("LED bridge is down")
+    monkeypatch.setattr(app_module, 'create_memory_view_array', broken)
+
+    response = client.get(f'/get_memory/{marker_id}')
+    assert response.status_code == 200
+    assert response.data == b'still here'
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+from Paths import project_array, simplification_importance, encode_polyline, decode_polyline
+
+
+def reference_douglas_peucker(x, y, tolerance):
+    """Plain recursive Douglas-Peucker; returns the indices it keeps."""
+    def distance(i, start, end):
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        px, py = x[i] - x[start], y[i] - y[start]
+        chord = dx * dx + dy * dy
+        t = min(max((px * dx + py * dy) / chord, 0.0), 1.0) if chord > 0 else 0.0
+        return np.hypot(px - t * dx, py - t * dy)
+
+    def simplify(start, end):
+        if end - start < 2:
+            return []
+        distances = [distance(i, start, end) for i in range(start + 1, end)]
+        farthest = int(np.argmax(distances))
+        if distances[farthest] <= tolerance:
+            return []
+        split = start + 1 + farthest
+        return simplify(start, split) + [split] + simplify(split, end)
+
+    return [0] + simplify(0, len(x) - 1) + [len(x) - 1]
+
+
+def random_walk(seed, n=400, closed=False):
+    rng = np.random.default_rng(seed)
+    lats = 45 + np.cumsum(rng.normal(0, 0.01, n))
+    lons = 7 + np.cumsum(rng.normal(0, 0.01, n))
+    if closed:
+        lats[-1], lons[-1] = lats[0], lons[0]
+    return lats, lons
+
+
+@pytest.mark.parametrize('seed, closed', [(1, False), (2, False), (3, True)])
+def test_importance_matches_recursive_douglas_peucker(seed, closed):
+    lats, lons = random_walk(seed, closed=closed)
+    importance = simplification_importance(lats, lons)
+    x, y = project_array(lats, lons)
+
+    for tolerance in (0.0, 1e-7, 1e-6, 1e-5, 1e-4, 1e-3, 1.0):
+        expected = reference_douglas_peucker(x, y, tolerance)
+        assert np.flatnonzero(importance > tolerance).tolist() == expected, tolerance
+
+
+def test_min_tolerance_keeps_the_result_at_coarser_tolerances():
+    lats, lons = random_walk(4)
+    min_tolerance = 1e-5
+    importance = simplification_importance(lats, lons, min_tolerance=min_tolerance)
+    x, y = project_array(lats, lons)
+
+    for tolerance in (min_tolerance, 1e-4, 1e-3):
+        assert np.flatnonzero(importance > tolerance).tolist() == reference_douglas_peucker(x, y, tolerance)
+
+
+def test_short_paths_keep_every_point():
+    assert simplification_importance([], []).tolist() == []
+    assert np.isinf(simplification_importance([1.0], [2.0])).all()
+    assert np.isinf(simplification_importance([1.0, 3.0], [2.0, 4.0])).all()
+
+
+def test_encode_matches_the_reference_polyline():
+    assert encode_polyline([38.5, 40.7, 43.252], [-120.2, -120.95, -126.453]) == "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+
+
+@pytest.mark.parametrize('lats, lons', [
+    ([51.5074, -33.8688], [-0.1278, 151.2093]),  # two points
+    ([10.0, 10.0, 10.0, 10.5], [20.0, 20.0, 20.0, 20.5]),  # duplicate points
+    ([0.0], [0.0]),
+    ([89.99999, -89.99999, 0.00001], [179.99999, -179.99999, -0.00001]),
+])
+def test_encode_decode_round_trip(lats, lons):
+    decoded = decode_polyline(encode_polyline(lats, lons))
+    assert len(decoded) == len(lats)
+    np.testing.assert_allclose(decoded, list(zip(lats, lons)), atol=1e-9)
+
+
+def test_round_trip_of_a_long_path():
+    lats, lons = random_walk(5, n=2000)
+    decoded = np.array(decode_polyline(encode_polyline(lats, lons)))
+    np.testing.assert_allclose(decoded[:, 0], np.round(lats, 5), atol=1e-9)
+    np.testing.assert_allclose(decoded[:, 1], np.round(lons, 5), atol=1e-9)
@@ -0,0 +1,124 @@
+import json
+import os
+
+from Storage import JournalStorage, read_snapshot
+
+
+def crash(store):
+    """Stop a store the way a killed process would: no final compaction."""
+    store._closed = True
+    store._compact_event.set()
+    store._journal.close()
+
+
+def open_store(tmp_path, **kwargs):
+    return JournalStorage(str(tmp_path / 'store.json'), **kwargs)
+
+
+def test_journal_is_replayed_on_open(tmp_path):
+    store = open_store(tmp_path, compact_threshold=1000)
+    store.put('markers', 'a', {'lat': 1, 'lon': 2})
+    store.put('markers', 'b', {'lat': 3, 'lon': 4})
+    store.put_many('paths', [('p', {'points': 2})])
+    store.delete('markers', 'a')
+    crash(store)
+    assert not os.path.exists(tmp_path / 'store.json')
+
+    store = open_store(tmp_path)
+    assert store.items('markers') == [('b', {'lat': 3, 'lon': 4})]
+    assert store.get('paths', 'p') == {'points': 2}
+    store.close()
+
+
+def test_torn_last_record_is_dropped_and_truncated(tmp_path):
+    store = open_store(tmp_path, compact_threshold=1000)
+    store.put('markers', 'a', {'lat': 1, 'lon': 2})
+    crash(store)
+    journal = tmp_path / 'store.journal'
+    good_size = journal.stat().st_size
+    with open(journal, 'ab') as f:
+        f.write(b'{"op":"put","section":"markers","key":"b","val')
+
+    store = open_store(tmp_path, compact_threshold=1000)
+    assert store.keys('markers') == ['a']
+    assert journal.stat().st_size == good_size
+
+    # New records start on a clean line, so they survive the next open
+    store.put('markers', 'c', {'lat': 5, 'lon': 6})
+    crash(store)
+    store = open_store(tmp_path)
+    assert sorted(store.keys('markers')) == ['a', 'c']
+    store.close()
+
+
+def test_corrupt_last_record_is_dropped(tmp_path):
+    store = open_store(tmp_path, compact_threshold=1000)
+    store.put('markers', 'a', {'lat': 1, 'lon': 2})
+    crash(store)
+    with open(tmp_path / 'store.journal', 'ab') as f:
+        f.write(b'not json\n')
+
+    store = open_store(tmp_path)
+    assert store.keys('markers') == ['a']
+    store.close()
+
+
+def test_compaction_interrupted_before_the_snapshot_was_written(tmp_path):
+    store = open_store(tmp_path, compact_threshold=1000)
+    store.put('markers', 'a', {'lat': 1, 'lon': 2})
+    store.compact()
+    store.put('markers', 'b', {'lat': 3, 'lon': 4})
+    store.delete('markers', 'a')
+    crash(store)
+    # Crash right after the journal was swapped out: the snapshot is the old one,
+    # .compacting holds the records, and writers had started a new journal
+    os.replace(tmp_path / 'store.journal', tmp_path / 'store.journal.compacting')
+    with open(tmp_path / 'store.journal', 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'op': 'put', 'section': 'markers', 'key': 'c', 'value': {'lat': 5, 'lon': 6}}) + '\n')
+
+    store = open_store(tmp_path, compact_threshold=1000)
+    assert sorted(store.keys('markers')) == ['b', 'c']
+    assert not os.path.exists(tmp_path / 'store.journal.compacting')
+    # The recovered records were folded into the snapshot
+    snapshot = read_snapshot(str(tmp_path / 'store.json'))['markers']
+    assert 'b' in snapshot and 'a' not in snapshot
+    crash(store)
+
+    store = open_store(tmp_path)
+    assert sorted(store.keys('markers')) == ['b', 'c']
+    store.close()
+
+
+def test_compaction_interrupted_after_the_snapshot_was_written(tmp_path):
+    store = open_store(tmp_path, compact_threshold=1000)
+    store.put('markers', 'a', {'lat': 1, 'lon': 2})
+    store.put('markers', 'b', {'lat': 3, 'lon': 4})
+    store.delete('markers', 'a')
+    crash(store)
+    # Crash after the new snapshot was renamed but before .compacting was removed
+    os.replace(tmp_path / 'store.journal', tmp_path / 'store.journal.compacting')
+    with open(tmp_path / 'store.json', 'w', encoding='utf-8') as f:
+        json.dump({'markers': {'b': {'lat': 3, 'lon': 4}}, 'paths': {}, 'memories': {}}, f)
+    # ...and a leftover temp file of an unfinished snapshot write is ignored
+    with open(tmp_path / 'store.json.tmp', 'w', encoding='utf-8') as f:
+        f.write('{"markers": {"x"')
+
+    store = open_store(tmp_path)
+    assert store.items('markers') == [('b', {'lat': 3, 'lon': 4})]
+    assert not os.path.exists(tmp_path / 'store.journal.compacting')
+    store.close()
+
+
+def test_writes_during_and_after_compaction_are_kept(tmp_path):
+    store = open_store(tmp_path, compact_threshold=1000)
+    for i in range(50):
+        store.put('markers', f"m{i}", {'lat': i, 'lon': i})
+    store.compact()
+    assert (tmp_path / 'store.journal').stat().st_size == 0
+    store.put('markers', 'after', {'lat': 0, 'lon': 0})
+    crash(store)
+
+    store = open_store(tmp_path)
+    assert store.count('markers') == 51
+    assert store.get('markers', 'm7') == {'lat': 7, 'lon': 7}
+    store.close()
@@ -0,0 +1,120 @@
+import threading
+import time
+
+import pytest
+
+from Tiles import TileCache, TileUnavailable
+
+PNG = b'\x89PNG tile'
+
+
+class StubUpstream:
+    """Stand-in tile server: counts fetches, can fail or hold them until released."""
+
+    def __init__(self, fail=False, hold=False):
+        self.fail = fail
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        if not hold:
+            self.release.set()
+
+    def fetch(self, layer, z, x, y):
+        self.calls.append((layer, z, x, y))
+        self.started.set()
+        self.release.wait(5)
+        if self.fail:
+            raise TileUnavailable(f"{layer}/{z}/{x}/{y}: HTTP 503")
+        return PNG
+
+
+def make_cache(tmp_path, upstream, **kwargs):
+    return TileCache(str(tmp_path / 'tiles'), upstream, **kwargs)
+
+
+def test_miss_fetches_once_then_hits(tmp_path):
+    upstream = StubUpstream()
+    cache = make_cache(tmp_path, upstream)
+
+    assert cache.get('osm', 3, 1, 2) == (PNG, 'image/png')
+    assert cache.get('osm', 3, 1, 2) == (PNG, 'image/png')
+
+    assert upstream.calls == [('osm', 3, 1, 2)]
+    assert cache.get_stats()['misses'] == 1
+    assert cache.get_stats()['hits'] == 1
+
+
+def test_hit_survives_a_new_cache_on_the_same_directory(tmp_path):
+    make_cache(tmp_path, StubUpstream()).get('osm', 1, 0, 0)
+    upstream = StubUpstream(fail=True)
+
+    assert make_cache(tmp_path, upstream).get('osm', 1, 0, 0) == (PNG, 'image/png')
+    assert upstream.calls == []
+
+
+def test_concurrent_misses_share_one_fetch(tmp_path):
+    upstream = StubUpstream(hold=True)
+    cache = make_cache(tmp_path, upstream)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('osm', 5, 3, 4))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+
+    deadline = time.monotonic() + 5
+    while cache.get_stats()['coalesced'] < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    upstream.release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert results == [(PNG, 'image/png')] * 4
+    assert len(upstream.calls) == 1
+    assert cache.get_stats()['coalesced'] == 3
+
+
+def test_failure_is_cached_briefly(tmp_path):
+    upstream = StubUpstream(fail=True)
+    cache = make_cache(tmp_path, upstream, failure_ttl=0.2)
+
+    with pytest.raises(TileUnavailable):
+        cache.get('osm', 2, 1, 1)
+    with pytest.raises(TileUnavailable, match='cached failure'):
+        cache.get('osm', 2, 1, 1)
+    assert len(upstream.calls) == 1
+    assert cache.get_stats()['failure_hits'] == 1
+
+    # Once the failure expires the upstream is asked again
+    time.sleep(0.25)
+    upstream.fail = False
+    assert cache.get('osm', 2, 1, 1) == (PNG, 'image/png')
+    assert len(upstream.calls) == 2
+
+
+def test_misses_give_up_when_upstream_slots_are_taken(tmp_path):
+    upstream = StubUpstream(hold=True)
+    cache = make_cache(tmp_path, upstream, max_upstream=1, slot_wait=0.05)
+    holder = threading.Thread(target=cache.get, args=('osm', 4, 0, 0))
+    holder.start()
+    assert upstream.started.wait(5)
+
+    started = time.monotonic()
+    with pytest.raises(TileUnavailable, match='busy'):
+        cache.get('osm', 4, 1, 1)
+    assert time.monotonic() - started < 1
+
+    upstream.release.set()
+    holder.join(5)
+    # Being busy says nothing about the tile, so it is fetched on the next request
+    assert cache.get('osm', 4, 1, 1) == (PNG, 'image/png')
+    assert cache.get_stats()['upstream_busy'] == 1
+
+
+def test_invalid_tiles_are_rejected_without_fetching(tmp_path):
+    upstream = StubUpstream()
+    cache = make_cache(tmp_path, upstream)
+
+    with pytest.raises(KeyError):
+        cache.get('nope', 1, 0, 0)
+    with pytest.raises(ValueError):
+        cache.get('osm', 1, 2, 0)
+    assert upstream.calls == []
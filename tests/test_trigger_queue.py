@@ -0,0 +1,97 @@
+from Events import TriggerQueue
+
+
+def keys(batch):
+    return [trigger['key'] for _, trigger in batch]
+
+
+def push(queue, *keys_):
+    for key in keys_:
+        queue.push(key, {'key': key})
+
+
+def test_new_consumer_starts_at_the_end():
+    queue = TriggerQueue()
+    push(queue, 'a')
+    assert queue.read('bridge') == []
+    push(queue, 'b')
+    assert keys(queue.read('bridge')) == ['b']
+    assert queue.read('bridge') == []
+
+
+def test_each_consumer_has_its_own_cursor():
+    queue = TriggerQueue()
+    queue.read('bridge')
+    queue.read('poller')
+    push(queue, 'a', 'b')
+
+    assert keys(queue.read('bridge')) == ['a', 'b']
+    push(queue, 'c')
+    assert keys(queue.read('bridge')) == ['c']
+    assert keys(queue.read('poller')) == ['a', 'b', 'c']
+
+
+def test_since_overrides_the_stored_cursor():
+    queue = TriggerQueue()
+    queue.read('http')
+    first = queue.push('a', {'key': 'a'})
+    push(queue, 'b')
+    queue.read('http')
+
+    assert keys(queue.read('http', since=first)) == ['b']
+    assert keys(queue.read('http', since=0)) == ['a', 'b']
+
+
+def test_repeat_within_the_window_replaces_the_pending_trigger():
+    queue = TriggerQueue(coalesce_window=60)
+    queue.read('bridge')
+    first = queue.push('a', {'key': 'a', 'n': 1})
+    second = queue.push('a', {'key': 'a', 'n': 2})
+
+    assert first == second
+    assert queue.read('bridge') == [(first, {'key': 'a', 'n': 2})]
+    assert queue.get_stats()['overwritten'] == 1
+
+
+def test_read_returns_the_newest_trigger_per_marker():
+    queue = TriggerQueue(coalesce_window=0)
+    queue.read('bridge')
+    push(queue, 'a', 'b', 'a')
+
+    batch = queue.read('bridge')
+    assert keys(batch) == ['b', 'a']
+    assert batch[-1][0] == queue.seq
+    assert queue.get_stats()['coalesced'] == 1
+
+
+def test_overflow_stays_pending_for_the_next_read():
+    queue = TriggerQueue(coalesce_window=0, max_batch=4)
+    queue.read('bridge')
+    push(queue, 'a', 'b', 'c', 'd', 'e', 'f')
+
+    first = queue.read('bridge')
+    assert keys(first) == ['a', 'b', 'c', 'd']
+    assert queue.get_stats()['deferred'] == 2
+    assert keys(queue.read('bridge')) == ['e', 'f']
+    assert queue.read('bridge') == []
+    assert queue.get_stats()['coalesced'] == 0
+
+
+def test_overflow_keeps_a_marker_whose_older_trigger_was_passed():
+    queue = TriggerQueue(coalesce_window=0, max_batch=4)
+    queue.read('bridge')
+    push(queue, 'a', 'b', 'c', 'd', 'e', 'a')
+
+    assert keys(queue.read('bridge')) == ['b', 'c', 'd', 'e']
+    assert keys(queue.read('bridge')) == ['a']
+
+
+def test_consumer_behind_a_full_buffer_counts_missed_triggers():
+    queue = TriggerQueue(max_triggers=3, coalesce_window=0, max_batch=10)
+    queue.read('bridge')
+    push(queue, 'a', 'b', 'c', 'd', 'e')
+
+    assert keys(queue.read('bridge')) == ['c', 'd', 'e']
+    stats = queue.get_stats()
+    assert stats['missed'] == 2
+    assert stats['dropped'] == 2
@@ -0,0 +1,143 @@
+import time
+
+import pytest
+
+from Viewports import ViewportSessions, ViewportOutOfSync
+
+
+def test_union_and_intersection_follow_the_open_tabs():
+    sessions = ViewportSessions()
+    sessions.update('tab-a', ['1', '2', '3'])
+    sessions.update('tab-b', ['2', '3', '4'])
+
+    assert sessions.visible('union') == {'1', '2', '3', '4'}
+    assert sessions.visible('intersection') == {'2', '3'}
+    assert sessions.visible('primary') == {'1', '2', '3'}
+
+    sessions.update('tab-a', ['3'])
+    assert sessions.visible('union') == {'2', '3', '4'}
+    assert sessions.visible('intersection') == {'3'}
+
+
+def test_primary_claim_wins_over_the_oldest_tab():
+    sessions = ViewportSessions(mode='primary')
+    sessions.update('tab-a', ['1'])
+    assert sessions.update('tab-b', ['2'], primary=True)
+
+    assert sessions.primary_client == 'tab-b'
+    assert sessions.visible() == {'2'}
+
+
+def test_aggregate_changes_are_reported_and_versioned():
+    sessions = ViewportSessions()
+    assert sessions.update('tab-a', ['1', '2'])
+    version = sessions.version
+
+    # Already visible through tab-a: the union doesn't change
+    assert not sessions.update('tab-b', ['1'])
+    assert sessions.version == version
+    assert sessions.update('tab-b', ['1', '5'])
+    assert sessions.version == version + 1
+
+
+def test_idle_sessions_expire_after_the_ttl(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: clock[0])
+    sessions = ViewportSessions(ttl=30.0)
+    sessions.update('idle', ['1'])
+    sessions.update('active', ['2'])
+
+    clock[0] += 20
+    assert not sessions.expire()
+    sessions.touch('active')  # heartbeat
+
+    clock[0] += 15
+    assert sessions.expire()
+    assert len(sessions) == 1
+    assert sessions.visible() == {'2'}
+
+    clock[0] += 30
+    assert sessions.expire()
+    assert len(sessions) == 0
+
+
+def test_remove_forgets_a_session():
+    sessions = ViewportSessions()
+    sessions.update('tab-a', ['1', '2'])
+    sessions.update('tab-b', ['2'])
+
+    assert sessions.remove('tab-a')
+    assert sessions.visible() == {'2'}
+    assert not sessions.remove('tab-a')
+    assert sessions.session('tab-a') == set()
+
+
+def test_deltas_apply_in_sequence():
+    sessions = ViewportSessions()
+    sessions.update('tab', ['1', '2'], seq=1)
+
+    assert sessions.apply('tab', added=['3'], removed=['1'], seq=2)
+    assert sessions.session('tab') == {'2', '3'}
+
+    # A repeat of an applied seq (e.g. a retried request) changes nothing
+    assert not sessions.apply('tab', added=['9'], seq=2)
+    assert sessions.session('tab') == {'2', '3'}
+
+
+def test_gap_or_unknown_session_is_out_of_sync():
+    sessions = ViewportSessions()
+    sessions.update('tab', ['1'], seq=1)
+
+    with pytest.raises(ViewportOutOfSync) as error:
+        sessions.apply('tab', added=['2'], seq=3)
+    assert error.value.last_seq == 1
+    with pytest.raises(ViewportOutOfSync):
+        sessions.apply('new-tab', added=['2'], seq=1)
+    with pytest.raises(ViewportOutOfSync):
+        sessions.touch('tab', seq=2)
+    assert sessions.session('tab') == {'1'}
+
+
+def test_stale_delta_gets_409_then_a_full_resync(app_module, client):
+    response = client.post('/visible_markers', json={'client_id': 'delta-tab', 'seq': 1, 'visible_ids': ['d1', 'd2']})
+    assert response.status_code == 200
+    response = client.post('/visible_markers', json={'client_id': 'delta-tab', 'seq': 2, 'added': ['d3'], 'removed': ['d1']})
+    assert response.status_code == 200
+    assert app_module.viewports.session('delta-tab') == {'d2', 'd3'}
+
+    # Empty delta: heartbeat, nothing changed
+    assert client.post('/visible_markers', json={'client_id': 'delta-tab', 'seq': 2}).status_code == 204
+
+    # A lost delta (seq 3) makes seq 4 stale
+    response = client.post('/visible_markers', json={'client_id': 'delta-tab', 'seq': 4, 'added': ['d4']})
+    assert response.status_code == 409
+    assert response.json['seq'] == 2
+    assert app_module.viewports.session('delta-tab') == {'d2', 'd3'}
+
+    # The page resends its whole viewport and continues from there
+    response = client.post('/visible_markers', json={'client_id': 'delta-tab', 'seq': 5, 'visible_ids': ['d3', 'd4', 'd5']})
+    assert response.status_code == 200
+    assert app_module.viewports.session('delta-tab') == {'d3', 'd4', 'd5'}
+    response = client.post('/visible_markers', json={'client_id': 'delta-tab', 'seq': 6, 'removed': ['d5']})
+    assert response.status_code == 200
+    assert app_module.viewports.session('delta-tab') == {'d3', 'd4'}
+    client.post('/visible_markers/close', json={'client_id': 'delta-tab'})
+
+
+def test_heartbeat_of_an_expired_tab_gets_409(app_module, client):
+    client.post('/visible_markers', json={'client_id': 'expired-tab', 'seq': 1, 'visible_ids': ['e1']})
+    app_module.viewports.remove('expired-tab')  # as expire() would
+
+    response = client.post('/visible_markers', json={'client_id': 'expired-tab', 'seq': 1})
+    assert response.status_code == 409
+    assert response.json['seq'] is None
+
+
+def test_close_route_drops_the_tab(app_module, client):
+    client.post('/visible_markers', json={'client_id': 'closing-tab', 'seq': 1, 'visible_ids': ['close-1']})
+    assert 'close-1' in app_module.viewports.visible()
+
+    response = client.post('/visible_markers/close', json={'client_id': 'closing-tab'})
+    assert response.status_code == 200
+    assert 'close-1' not in app_module.viewports.visible()
+    assert app_module.viewports.session('closing-tab') == set()